@@ -0,0 +1,10 @@
+# coding: utf8
+# ===================================
+# Author: yumingmin
+# File: __init__.py
+# Cate: FastAPI
+# Create time: 2022/7/13 09:20
+# Update time:
+# ===================================
+
+"""性能测试脚本，在 fastapi-tutorial 目录下运行: python -m benchmarks.<脚本名>"""
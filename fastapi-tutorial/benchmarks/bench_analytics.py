@@ -0,0 +1,75 @@
+# coding: utf8
+# ===================================
+# Author: yumingmin
+# File: bench_analytics.py
+# Cate: FastAPI
+# Create time: 2022/7/21 15:30
+# Update time:
+# ===================================
+
+"""ORM 逐行循环 vs NumPy 向量化：计算所有省份每日新增的 7 日移动平均
+* orm：通过 ORM 读出全部 `Data` 对象，按省份在 Python 中循环计算
+* numpy(load)：`TimeSeriesStore` 首次加载全部数据的耗时
+* numpy(compute)：数据已在内存中时一次计算所有省份的耗时
+运行: python -m benchmarks.bench_analytics --rows 10000 1000000
+"""
+
+import argparse
+import os
+import tempfile
+from collections import defaultdict
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from coronavirus import analytics, models, schemas
+from coronavirus.seed import load
+from .bench_pagination import PROVINCES, timeit
+
+WINDOW = 7
+
+
+def orm_loop(db) -> dict:
+    series = defaultdict(list)
+
+    for data in db.query(models.Data).order_by(models.Data.city_id, models.Data.date):
+        series[data.city_id].append(data.confirmed)
+
+    result = {}
+
+    for city_id, confirmed in series.items():
+        new = [confirmed[0]] + [confirmed[i] - confirmed[i - 1] for i in range(1, len(confirmed))]
+        result[city_id] = [
+            sum(new[i - WINDOW + 1:i + 1]) / WINDOW if i >= WINDOW - 1 else None for i in range(len(new))
+        ]
+
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, nargs="+", default=[10_000, 1_000_000], help="总行数，每个省份 rows / 34 天")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'rows':>10} {'orm(ms)':>12} {'numpy load(ms)':>16} {'numpy compute(ms)':>18} {'speedup':>9}")
+
+    for rows in args.rows:
+        path = os.path.join(tempfile.mkdtemp(), "bench.sqlite3")
+        engine = create_engine(f"sqlite:///{path}")
+        load(engine, PROVINCES, rows // PROVINCES)
+        db = sessionmaker(bind=engine)()
+        store = analytics.TimeSeriesStore()
+
+        orm_ms = timeit(lambda: (orm_loop(db), db.expunge_all()), args.repeat)
+        load_ms = timeit(lambda: (store.clear(), store.refresh(db)), args.repeat)
+        snapshot = store.snapshot(db)
+        compute_ms = timeit(
+            lambda: analytics.compute(snapshot, schemas.Indicator.moving_average, window=WINDOW), args.repeat
+        )
+        print(f"{rows:>10} {orm_ms:>12.1f} {load_ms:>16.1f} {compute_ms:>18.1f} {orm_ms / compute_ms:>8.0f}x")
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
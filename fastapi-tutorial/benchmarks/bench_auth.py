@@ -0,0 +1,146 @@
+# coding: utf8
+# ===================================
+# Author: yumingmin
+# File: bench_auth.py
+# Cate: FastAPI
+# Create time: 2022/7/26 14:20
+# Update time:
+# ===================================
+
+"""第六章 JWT 认证接口在有无校验缓存时的吞吐量
+* 在进程内通过 ASGI 调用 `/ch06/jwt/users/me`(不经过网络)，`--tokens` 个不同 token 轮流请求，每种配置请求 `--requests` 次
+* 无缓存时把 `token_cache.maxsize` 设为 0，每个请求都执行 `jwt.decode` 和用户查询
+* 另外单独统计依赖 `jwt_get_current_user` 本身的耗时，排除路由和序列化的开销
+* 登录风暴：`--logins` 个协程不停请求 `/ch06/jwt/token`(bcrypt)的同时，统计读接口的延迟，
+  对比 bcrypt 在事件循环中直接执行(inline)和在专用线程池中执行(executor)
+运行: python -m benchmarks.bench_auth --requests 5000 --tokens 10 --logins 8
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+from contextlib import nullcontext
+from datetime import timedelta
+from unittest import mock
+
+import httpx
+from fastapi import FastAPI, Request
+
+from core import ratelimit
+from tutorial.ch06 import app06, created_access_token, jwt_get_current_user, password_hasher, token_cache
+from tutorial.ch06_users import SessionLocal
+
+
+def make_tokens(count: int):
+    # 不同的过期时间生成不同的 token
+    return [created_access_token({"sub": "john snow"}, expire_delta=timedelta(minutes=30, seconds=i)) for i in range(count)]
+
+
+async def throughput(app: FastAPI, tokens, requests: int) -> float:
+    async with httpx.AsyncClient(app=app, base_url="http://test") as client:
+        headers = [{"Authorization": f"Bearer {token}"} for token in tokens]
+        await client.post("/ch06/jwt/users/me", headers=headers[0])
+        start = time.perf_counter()
+
+        for i in range(requests):
+            response = await client.post("/ch06/jwt/users/me", headers=headers[i % len(headers)])
+            assert response.status_code == 200
+
+        return requests / (time.perf_counter() - start)
+
+
+async def dependency_us(tokens, repeat: int) -> float:
+    db = SessionLocal()
+    start = time.perf_counter()
+
+    for i in range(repeat):
+        # 每次一个新的请求，用户查询不会命中上一次请求的缓存
+        request = Request({"type": "http", "method": "POST", "path": "/", "headers": []})
+        await jwt_get_current_user(request, tokens[i % len(tokens)], db)
+
+    db.close()
+
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+async def login_storm(app: FastAPI, token: str, logins: int, seconds: float) -> dict:
+    """每 10ms 发出一个读请求，返回读请求的 p50/max 延迟(ms)和期间完成、被拒绝(503)的登录数
+    延迟从计划发出的时刻算起，包含事件循环被阻塞、读请求来不及发出的时间
+    """
+    async with httpx.AsyncClient(app=app, base_url="http://test", timeout=120) as client:
+        headers = {"Authorization": f"Bearer {token}"}
+        form = {"username": "john snow", "password": "secret"}
+        done = asyncio.Event()
+        statuses = []
+
+        async def login():
+            while not done.is_set():
+                statuses.append((await client.post("/ch06/jwt/token", data=form)).status_code)
+
+        tasks = [asyncio.ensure_future(login()) for _ in range(logins)]
+        await asyncio.sleep(0.1)
+        latencies = []
+        deadline = time.perf_counter() + seconds
+
+        while time.perf_counter() < deadline:
+            scheduled = time.perf_counter() + 0.01
+            await asyncio.sleep(0.01)
+            await client.post("/ch06/jwt/users/me", headers=headers)
+            latencies.append((time.perf_counter() - scheduled) * 1000)
+
+        done.set()
+        await asyncio.gather(*tasks)
+
+    return {
+        "p50": statistics.median(latencies),
+        "max": max(latencies),
+        "logins": statuses.count(200),
+        "rejected": statuses.count(503),
+    }
+
+
+async def inline(func, *args):
+    return func(*args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--tokens", type=int, default=10, help="轮流使用的不同 token 数")
+    parser.add_argument("--logins", type=int, default=8, help="登录风暴中并发登录的协程数")
+    parser.add_argument("--seconds", type=float, default=3.0, help="登录风暴持续的秒数")
+    args = parser.parse_args()
+
+    # 登录风暴会超过登录接口的限流，这里只比较 bcrypt 的执行方式
+    ratelimit.ENABLED = False
+    app = FastAPI()
+    app.include_router(app06, prefix="/ch06")
+    tokens = make_tokens(args.tokens)
+    maxsize = token_cache.maxsize
+
+    print(f"{'cache':<8} {'req/s':>10} {'dependency(us)':>15}")
+
+    for label, size in (("off", 0), ("on", maxsize)):
+        token_cache.maxsize = size
+        token_cache.clear()
+        rate = asyncio.run(throughput(app, tokens, args.requests))
+        cost = asyncio.run(dependency_us(tokens, args.requests))
+        print(f"{label:<8} {rate:>10.1f} {cost:>15.2f}")
+
+    token_cache.maxsize = maxsize
+
+    print(f"\n{'bcrypt':<10} {'read p50(ms)':>13} {'read max(ms)':>13} {'logins':>8} {'rejected':>9}")
+
+    for label in ("inline", "executor"):
+        # inline 模拟改动之前的行为：bcrypt 直接在事件循环中执行
+        patch = mock.patch.object(password_hasher, "run", inline) if label == "inline" else nullcontext()
+
+        with patch:
+            result = asyncio.run(login_storm(app, tokens[0], args.logins, args.seconds))
+
+        print(f"{label:<10} {result['p50']:>13.2f} {result['max']:>13.2f} {result['logins']:>8} {result['rejected']:>9}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+# coding: utf8
+# ===================================
+# Author: yumingmin
+# File: bench_compression.py
+# Cate: FastAPI
+# Create time: 2022/7/24 16:20
+# Update time:
+# ===================================
+
+"""响应压缩：每种编码下传输的字节数和每个请求消耗的 CPU 时间
+* gzip / br：`CompressionMiddleware` 在请求时压缩(gzip 级别 6，br 质量 4)
+* gzip-9 / br-11(预压缩)：`core.precompress` 构建时压缩，请求时只读文件，CPU 时间记为构建一次的耗时
+运行: python -m benchmarks.bench_compression --rows 1000
+"""
+
+import argparse
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from core.compression import ENCODINGS, Encoder
+from core.precompress import compress
+from coronavirus import crud, models, schemas, serializers
+from coronavirus.seed import load
+from .bench_pagination import PROVINCES, timeit
+
+STATIC = ("static/css/semantic.min.css", "static/js/semantic.min.js", "static/js/jquery-3.5.1/jquery-3.5.1.min.js")
+
+
+def payloads(rows: int):
+    engine = create_engine("sqlite://", poolclass=StaticPool)
+    load(engine, PROVINCES, rows // PROVINCES + 1)
+    db = sessionmaker(bind=engine)()
+    data = crud.get_data(db, limit=rows)
+    yield f"get_data({rows})", serializers.json_response(schemas.Data, data, models.Data).body
+
+    for path in STATIC:
+        with open(path, "rb") as f:
+            yield path, f.read()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=1000, help="get_data 响应的行数")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'payload':<48} {'encoding':>10} {'bytes':>10} {'ratio':>7} {'cpu(ms)':>9}")
+
+    for name, body in payloads(args.rows):
+        print(f"{name:<48} {'identity':>10} {len(body):>10} {1:>7.1%} {0:>9.2f}")
+
+        for encoding in ENCODINGS:
+            size = len(Encoder(encoding).compress(body, final=True))
+            cpu = timeit(lambda: Encoder(encoding).compress(body, final=True), args.repeat)
+            print(f"{name:<48} {encoding:>10} {size:>10} {size / len(body):>7.1%} {cpu:>9.2f}")
+
+        for encoding, label in (("gzip", "gzip-9"), ("br", "br-11")):
+            if encoding not in ENCODINGS:
+                continue
+
+            start = time.perf_counter()
+            size = len(compress(body, encoding))
+            build = (time.perf_counter() - start) * 1000
+            print(f"{name:<48} {label:>10} {size:>10} {size / len(body):>7.1%} {0:>9.2f}  (构建一次 {build:.0f}ms)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+# coding: utf8
+# ===================================
+# Author: yumingmin
+# File: bench_concurrency.py
+# Cate: FastAPI
+# Create time: 2022/7/14 15:30
+# Update time:
+# ===================================
+
+"""并发客户端数与吞吐量：同步 Session(线程池) vs AsyncSession(aiosqlite)
+每种模式各启动一个 uvicorn 进程，用不同数量的并发客户端请求 /coronavirus/get_data
+运行: python -m benchmarks.bench_concurrency --clients 1 4 16 64
+"""
+
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+from sqlalchemy import create_engine
+
+from coronavirus.seed import load
+from .bench_pagination import PROVINCES
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def wait_until_ready(url: str, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.2)
+
+    raise RuntimeError(f"{url} 没有启动")
+
+
+async def drive(url: str, clients: int, seconds: float) -> float:
+    """`clients` 个协程循环请求 `seconds` 秒，返回每秒完成的请求数"""
+    done = 0
+    deadline = time.monotonic() + seconds
+
+    async def worker(client: httpx.AsyncClient):
+        nonlocal done
+
+        while time.monotonic() < deadline:
+            response = await client.get(url)
+            response.raise_for_status()
+            done += 1
+
+    limits = httpx.Limits(max_connections=clients)
+    async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+        await asyncio.gather(*(worker(client) for _ in range(clients)))
+
+    return done / seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--days", type=int, default=1000)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), "bench.sqlite3")
+    load(create_engine(f"sqlite:///{path}"), PROVINCES, args.days)
+
+    results = {}
+
+    for mode in ("sync", "async"):
+        port = free_port()
+        env = dict(
+            os.environ,
+            CORONAVIRUS_DATABASE_URL=f"sqlite:///{path}",
+            CORONAVIRUS_DB_ASYNC=str(mode == "async").lower()
+        )
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "run:app", "--port", str(port), "--log-level", "warning"],
+            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+
+        try:
+            url = f"http://127.0.0.1:{port}/coronavirus/get_data?city=province-1&limit=100"
+            asyncio.run(wait_until_ready(url))
+            results[mode] = [asyncio.run(drive(url, clients, args.seconds)) for clients in args.clients]
+        finally:
+            server.terminate()
+            server.wait()
+
+    print(f"{'clients':>8} {'sync(req/s)':>12} {'async(req/s)':>13}")
+
+    for i, clients in enumerate(args.clients):
+        print(f"{clients:>8} {results['sync'][i]:>12.1f} {results['async'][i]:>13.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+# coding: utf8
+# ===================================
+# Author: yumingmin
+# File: bench_json.py
+# Cate: FastAPI
+# Create time: 2022/7/23 14:20
+# Update time:
+# ===================================
+
+"""列表接口的两种序列化方式：不同响应大小下把 ORM 对象序列化为响应体的耗时
+* pydantic：FastAPI 默认的路径，逐个 `from_orm` 校验 + `jsonable_encoder` + 标准库 json
+* fast：`serializers.row_serializer` 直接取字段 + `FastJSONResponse`(orjson)
+运行: python -m benchmarks.bench_json --sizes 100 1000 10000
+"""
+
+import argparse
+import json
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from coronavirus import crud, models, schemas, serializers
+from coronavirus.seed import load
+from .bench_pagination import PROVINCES, timeit
+
+
+def pydantic_path(rows) -> bytes:
+    content = jsonable_encoder([schemas.Data.from_orm(row) for row in rows])
+    return JSONResponse(content).body
+
+
+def fast_path(rows) -> bytes:
+    return serializers.json_response(schemas.Data, rows, models.Data).body
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000], help="每个响应的行数")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    engine = create_engine("sqlite://", poolclass=StaticPool)
+    load(engine, PROVINCES, max(args.sizes) // PROVINCES + 1)
+    db = sessionmaker(bind=engine)()
+
+    print(f"{'rows':>8} {'pydantic(ms)':>14} {'fast(ms)':>10} {'speedup':>9}")
+
+    for size in args.sizes:
+        rows = crud.get_data(db, limit=size)
+        assert json.loads(pydantic_path(rows)) == json.loads(fast_path(rows))
+        pydantic_ms = timeit(lambda: pydantic_path(rows), args.repeat)
+        fast_ms = timeit(lambda: fast_path(rows), args.repeat)
+        print(f"{size:>8} {pydantic_ms:>14.2f} {fast_ms:>10.2f} {pydantic_ms / fast_ms:>8.1f}x")
+
+
+if __name__ == '__main__':
+    main()
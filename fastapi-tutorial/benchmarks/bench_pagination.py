@@ -0,0 +1,68 @@
+# coding: utf8
+# ===================================
+# Author: yumingmin
+# File: bench_pagination.py
+# Cate: FastAPI
+# Create time: 2022/7/13 09:20
+# Update time:
+# ===================================
+
+"""偏移分页 vs 游标分页：不同页深下取一页数据的耗时
+运行: python -m benchmarks.bench_pagination --days 5000
+"""
+
+import argparse
+import os
+import statistics
+import tempfile
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from coronavirus import crud
+from coronavirus.seed import load
+
+PROVINCES = 34
+
+
+def timeit(func, repeat: int) -> float:
+    samples = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+
+    return statistics.median(samples) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--days", type=int, default=3000, help="每个省份的天数，总行数为 34 * days")
+    parser.add_argument("--limit", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), "bench.sqlite3")
+    engine = create_engine(f"sqlite:///{path}")
+    stats = load(engine, PROVINCES, args.days)
+    db = sessionmaker(bind=engine)()
+    print(f"写入 {stats.rows} 行，{stats.rows_per_second:.0f} 行/秒")
+
+    total = PROVINCES * args.days
+    print(f"{'page':>8} {'offset(ms)':>12} {'keyset(ms)':>12}")
+
+    depth = 1
+    while depth * args.limit < total:
+        skip = depth * args.limit
+        last = crud.get_data(db, skip=skip - 1, limit=1)[0]
+        cursor = crud.encode_cursor((last.city_id, last.date.isoformat(), last.id))
+        offset_ms = timeit(lambda: crud.get_data(db, skip=skip, limit=args.limit), args.repeat)
+        keyset_ms = timeit(lambda: crud.get_data_page(db, cursor=cursor, limit=args.limit), args.repeat)
+        print(f"{depth:>8} {offset_ms:>12.2f} {keyset_ms:>12.2f}")
+        depth *= 4
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+# coding: utf8
+# ===================================
+# Author: yumingmin
+# File: bench_ratelimit.py
+# Cate: FastAPI
+# Create time: 2022/7/26 17:30
+# Update time:
+# ===================================
+
+"""限流器本身的开销
+* store：直接调用 `acquire` 的耗时，同一个键(热点)和 `--keys` 个不同的键轮流
+* request：进程内通过 ASGI 请求一个空接口，对比不限流、什么也不做的依赖(FastAPI 解析依赖本身的开销)、
+  MemoryStore 和 SQLiteStore(跨 worker)限流时每个请求的耗时
+运行: python -m benchmarks.bench_ratelimit --repeat 20000 --keys 10000
+"""
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+import httpx
+from fastapi import Depends, FastAPI, Request
+
+from core.ratelimit import MemoryStore, Rate, RateLimiter, SQLiteStore
+
+# 足够大，压测过程中不会拒绝
+RATE = Rate(10 ** 9, 1.0)
+
+
+def store_us(store, keys, repeat: int) -> float:
+    start = time.perf_counter()
+
+    for i in range(repeat):
+        store.acquire(keys[i % len(keys)], RATE)
+
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+async def request_us(app: FastAPI, repeat: int) -> float:
+    async with httpx.AsyncClient(app=app, base_url="http://test") as client:
+        await client.get("/")
+        start = time.perf_counter()
+
+        for _ in range(repeat):
+            await client.get("/")
+
+        return (time.perf_counter() - start) / repeat * 1e6
+
+
+async def noop(request: Request):
+    pass
+
+
+def make_app(dependency=None) -> FastAPI:
+    app = FastAPI()
+    dependencies = [] if dependency is None else [Depends(dependency)]
+
+    @app.get("/", dependencies=dependencies)
+    async def index():
+        return {}
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=20000)
+    parser.add_argument("--keys", type=int, default=10000, help="轮流使用的不同键的数量")
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), "ratelimit.sqlite3")
+    stores = {"memory": MemoryStore(), "sqlite": SQLiteStore(path)}
+    keys = [f"key-{i}" for i in range(args.keys)]
+
+    print(f"{'store':<8} {'hot key(us)':>12} {f'{args.keys} keys(us)':>16}")
+
+    for name, store in stores.items():
+        print(f"{name:<8} {store_us(store, ['hot'], args.repeat):>12.2f} {store_us(store, keys, args.repeat):>16.2f}")
+
+    baseline = asyncio.run(request_us(make_app(), args.repeat // 4))
+    print(f"\n{'limiter':<8} {'request(us)':>12} {'overhead(us)':>13}")
+    print(f"{'none':<8} {baseline:>12.2f} {0:>13.2f}")
+
+    dependencies = {"noop": noop}
+    dependencies.update((name, RateLimiter("bench", RATE, store=store)) for name, store in stores.items())
+
+    for name, dependency in dependencies.items():
+        cost = asyncio.run(request_us(make_app(dependency), args.repeat // 4))
+        print(f"{name:<8} {cost:>12.2f} {cost - baseline:>13.2f}")
+
+
+if __name__ == '__main__':
+    main()
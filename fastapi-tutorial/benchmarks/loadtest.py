@@ -0,0 +1,299 @@
+# coding: utf8
+# ===================================
+# Author: yumingmin
+# File: loadtest.py
+# Cate: FastAPI
+# Create time: 2022/7/25 17:00
+# Update time:
+# ===================================
+
+"""整个应用的压测：在本机启动 `run:app`(使用预先写入数据的 SQLite 数据库)，对各个场景施加并发负载
+* 场景覆盖 coronavirus 的读接口、第五章的依赖注入接口、第六章的认证接口(包括 bcrypt 校验密码的 /jwt/token)
+* 每个场景先预热，再由 `--concurrency` 个协程循环请求 `--duration` 秒(闭环负载)，
+  统计吞吐量和 p50/p95/p99 延迟；客户端和服务端在同一台机器上，结果只用于同一环境下前后对比
+* 结果保存为 JSON(包含 git 版本和参数)，`compare` 对比两次结果，延迟或吞吐量变差超过阈值时以非 0 状态退出
+运行:
+  python -m benchmarks.loadtest run --concurrency 16 --duration 10 --output benchmarks/results/before.json
+  python -m benchmarks.loadtest run --database fixtures/coronavirus-1m.sqlite3  # 使用 `python -m coronavirus.seed` 生成的测试库
+  python -m benchmarks.loadtest compare benchmarks/results/before.json benchmarks/results/after.json --threshold 10
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Callable, List, NamedTuple, Optional
+
+import httpx
+from sqlalchemy import create_engine, func, select
+
+from .bench_concurrency import free_port, wait_until_ready
+
+
+class Scenario(NamedTuple):
+    name: str
+    method: str
+    path: str
+    headers: Optional[dict] = None
+    data: Optional[dict] = None
+    # 压测前调用一次，返回请求需要额外带上的请求头(如登录后得到的 token)
+    setup: Optional[Callable] = None
+
+
+async def jwt_login(client: httpx.AsyncClient) -> dict:
+    response = await client.post("/ch06/jwt/token", data={"username": "john snow", "password": "secret"})
+    response.raise_for_status()
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+
+SCENARIOS = [
+    Scenario("coronavirus.get_cities", "GET", "/coronavirus/get_cities"),
+    Scenario("coronavirus.get_city", "GET", "/coronavirus/get_city/province-1"),
+    Scenario("coronavirus.get_data", "GET", "/coronavirus/get_data?city=province-1&limit=100"),
+    Scenario("coronavirus.rollup_daily", "GET", "/coronavirus/rollups/nation/daily"),
+    Scenario("coronavirus.home", "GET", "/coronavirus/?limit=100"),
+    Scenario("ch05.dependency", "GET", "/ch05/dependency01?q=fastapi&page=2&limit=20"),
+    Scenario("ch05.sub_dependency", "GET", "/ch05/sub_dependency?q=fastapi&last_query=cached"),
+    Scenario(
+        "ch05.path_dependencies", "GET", "/ch05/dependency_in_path_operation",
+        headers={"X-Token": "fake-super-secret-token", "X-Key": "fake-super-secret-key"}
+    ),
+    Scenario("ch06.token", "POST", "/ch06/token", data={"username": "jay", "password": "abc"}),
+    Scenario("ch06.users_me", "GET", "/ch06/users/me", headers={"Authorization": "Bearer jay"}),
+    Scenario("ch06.jwt_token", "POST", "/ch06/jwt/token", data={"username": "john snow", "password": "secret"}),
+    Scenario("ch06.jwt_users_me", "POST", "/ch06/jwt/users/me", setup=jwt_login),
+]
+
+
+def percentile(samples: List[float], q: float) -> float:
+    """最近秩(nearest-rank)百分位，`samples` 已排序"""
+    if not samples:
+        return 0.0
+
+    index = max(0, min(len(samples) - 1, math.ceil(q / 100 * len(samples)) - 1))
+    return samples[index]
+
+
+def summarize(latencies: List[float], errors: int, seconds: float) -> dict:
+    latencies = sorted(latencies)
+    ms = [latency * 1000 for latency in latencies]
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput": round(len(latencies) / seconds, 1),
+        "mean_ms": round(sum(ms) / len(ms), 3) if ms else 0.0,
+        "p50_ms": round(percentile(ms, 50), 3),
+        "p95_ms": round(percentile(ms, 95), 3),
+        "p99_ms": round(percentile(ms, 99), 3),
+        "max_ms": round(ms[-1], 3) if ms else 0.0,
+    }
+
+
+async def drive(base_url: str, scenario: Scenario, concurrency: int, duration: float, warmup: float) -> dict:
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        headers = dict(scenario.headers or {})
+
+        if scenario.setup is not None:
+            headers.update(await scenario.setup(client))
+
+        latencies, errors = [], 0
+        recording = False
+        deadline = time.monotonic() + warmup
+
+        async def worker():
+            nonlocal errors
+
+            while time.monotonic() < deadline:
+                start = time.perf_counter()
+
+                try:
+                    response = await client.request(scenario.method, scenario.path, headers=headers, data=scenario.data)
+                    ok = response.status_code < 400
+                except httpx.HTTPError:
+                    ok = False
+
+                if not recording:
+                    continue
+
+                if ok:
+                    latencies.append(time.perf_counter() - start)
+                else:
+                    errors += 1
+
+        if warmup > 0:
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+        recording = True
+        started = time.monotonic()
+        deadline = started + duration
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+        return summarize(latencies, errors, time.monotonic() - started)
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def start_server(database_url: str, workers: int, port: int) -> subprocess.Popen:
+    env = dict(
+        os.environ,
+        CORONAVIRUS_ENV="prod",
+        CORONAVIRUS_DATABASE_URL=database_url,
+        CORONAVIRUS_SYNC_WORKER="false",
+        # 压测登录接口时不限流
+        RATE_LIMIT_ENABLED="false",
+    )
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "run:app", "--port", str(port), "--workers", str(workers),
+         "--log-level", "warning", "--no-access-log"],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+
+
+def run(args) -> dict:
+    # 导入 coronavirus 会初始化默认数据库，只在压测时导入，compare 不需要
+    from coronavirus import models
+    from coronavirus.seed import load
+
+    if args.database:
+        path = args.database
+    else:
+        path = os.path.join(tempfile.mkdtemp(), "loadtest.sqlite3")
+        load(create_engine(f"sqlite:///{path}"), args.provinces, args.days)
+
+    engine = create_engine(f"sqlite:///{path}")
+
+    with engine.connect() as conn:
+        rows = conn.execute(select(func.count()).select_from(models.Data)).scalar()
+
+    engine.dispose()
+    print(f"测试数据 {rows} 行: {path}")
+
+    scenarios = [scenario for scenario in SCENARIOS if not args.only or any(name in scenario.name for name in args.only)]
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    server = start_server(f"sqlite:///{path}", args.workers, port)
+    results = {}
+
+    try:
+        asyncio.run(wait_until_ready(base_url + "/docs"))
+        print(f"{'scenario':<30} {'req/s':>9} {'p50(ms)':>9} {'p95(ms)':>9} {'p99(ms)':>9} {'errors':>7}")
+
+        for scenario in scenarios:
+            result = asyncio.run(drive(base_url, scenario, args.concurrency, args.duration, args.warmup))
+            results[scenario.name] = result
+            print(f"{scenario.name:<30} {result['throughput']:>9.1f} {result['p50_ms']:>9.2f} "
+                  f"{result['p95_ms']:>9.2f} {result['p99_ms']:>9.2f} {result['errors']:>7}")
+    finally:
+        server.terminate()
+        server.wait()
+
+    return {
+        "meta": {
+            "revision": git_revision(),
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "concurrency": args.concurrency,
+            "duration": args.duration,
+            "workers": args.workers,
+            "rows": rows,
+        },
+        "scenarios": results,
+    }
+
+
+# 对比时检查的指标：True 表示越大越好
+METRICS = {"throughput": True, "p50_ms": False, "p95_ms": False, "p99_ms": False}
+
+
+def compare(before: dict, after: dict, threshold: float) -> List[str]:
+    """打印每个场景各指标的变化，返回变差超过 `threshold`% 的 "场景.指标" 列表"""
+    regressions = []
+    print(f"{before['meta'].get('revision')} -> {after['meta'].get('revision')}")
+    print(f"{'scenario':<30} {'metric':<11} {'before':>10} {'after':>10} {'change':>8}")
+
+    for name, old in before["scenarios"].items():
+        new = after["scenarios"].get(name)
+
+        if new is None:
+            continue
+
+        for metric, higher_is_better in METRICS.items():
+            if not old[metric]:
+                continue
+
+            change = (new[metric] - old[metric]) / old[metric] * 100
+            worse = -change if higher_is_better else change
+            flag = "  !" if worse > threshold else ""
+
+            if flag:
+                regressions.append(f"{name}.{metric}")
+
+            print(f"{name:<30} {metric:<11} {old[metric]:>10.2f} {new[metric]:>10.2f} {change:>+7.1f}%{flag}")
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="启动服务并压测，结果写到 --output")
+    run_parser.add_argument("--concurrency", type=int, default=16, help="并发的客户端协程数")
+    run_parser.add_argument("--duration", type=float, default=10.0, help="每个场景压测的秒数")
+    run_parser.add_argument("--warmup", type=float, default=2.0, help="每个场景预热的秒数，不计入结果")
+    run_parser.add_argument("--workers", type=int, default=1, help="uvicorn worker 进程数")
+    run_parser.add_argument("--provinces", type=int, default=34, help="生成的省份数")
+    run_parser.add_argument("--days", type=int, default=1000, help="每个省份的天数")
+    run_parser.add_argument("--database", help="使用已有的 SQLite 测试库，不再生成数据")
+    run_parser.add_argument("--only", nargs="*", help="只运行名称包含这些字符串的场景")
+    run_parser.add_argument("--output", help="结果 JSON 文件的路径")
+
+    compare_parser = commands.add_parser("compare", help="对比两次压测结果")
+    compare_parser.add_argument("before")
+    compare_parser.add_argument("after")
+    compare_parser.add_argument("--threshold", type=float, default=10.0, help="变差超过多少百分比视为性能回退")
+
+    args = parser.parse_args()
+
+    if args.command == "run":
+        result = run(args)
+
+        if args.output:
+            os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+
+            with open(args.output, "w") as f:
+                json.dump(result, f, ensure_ascii=False, indent=2)
+
+            print(f"结果已保存到 {args.output}")
+        return
+
+    with open(args.before) as f:
+        before = json.load(f)
+
+    with open(args.after) as f:
+        after = json.load(f)
+
+    regressions = compare(before, after, args.threshold)
+
+    if regressions:
+        print(f"性能回退(超过 {args.threshold}%): {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
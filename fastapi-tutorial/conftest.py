@@ -0,0 +1,24 @@
+# coding: utf8
+# ===================================
+# Author: yumingmin
+# File: conftest.py
+# Cate: FastAPI
+# Create time: 2022/7/27 10:00
+# Update time:
+# ===================================
+
+"""pytest 的全局配置
+* 各模块在导入时就按环境变量创建数据库引擎，所以要在测试文件导入 run 之前把数据库指向临时目录，
+  避免测试读写开发用的 coronavirus.sqlite3 和 ch06_users.sqlite3
+* 已经设置了这些环境变量时(如指向其他测试库)保持不变
+"""
+
+import os
+import tempfile
+
+TEST_DB_DIR = tempfile.mkdtemp(prefix="fastapi-tutorial-test-")
+
+os.environ.setdefault("CORONAVIRUS_DATABASE_URL", f"sqlite:///{os.path.join(TEST_DB_DIR, 'coronavirus.sqlite3')}")
+os.environ.setdefault("CH06_DATABASE_URL", f"sqlite:///{os.path.join(TEST_DB_DIR, 'ch06_users.sqlite3')}")
+# 后台同步任务会访问外部数据源，测试中不启动
+os.environ.setdefault("CORONAVIRUS_SYNC_WORKER", "false")
@@ -0,0 +1,14 @@
+# coding: utf8
+# ================================
+# Author: yumingmin
+# Cate: FastAPI
+# Create Time: 2022/7/23
+# Update Time:
+# ================================
+
+"""整个应用共用的组件(响应类、中间件等)，由 run.py 装配"""
+
+from .compression import CompressionMiddleware
+from .responses import FastJSONResponse
+from .staticfiles import PrecompressedStaticFiles
+from .timing import TimingMiddleware, instrument_engine, instrument_routes
@@ -0,0 +1,199 @@
+# coding: utf8
+# ===================================
+# Author: yumingmin
+# File: compression.py
+# Cate: FastAPI
+# Create time: 2022/7/24 09:30
+# Update time:
+# ===================================
+
+"""响应压缩
+* `CompressionMiddleware` 是纯 ASGI 中间件：按 `Accept-Encoding` 协商 br / gzip，只压缩规则中列出的内容类型，
+  并且响应体小于该类型的最小字节数时不压缩(压缩小响应得不偿失)
+* 流式响应(StreamingResponse、FileResponse)逐块压缩，每块之后 flush，不会把整个响应缓冲在内存里
+* 已经带 `Content-Encoding` 的响应(如预压缩的静态文件)原样返回
+* brotli 是可选依赖，没有安装时只使用 gzip
+* 压缩后的响应体与原来不同，强 ETag 改为弱 ETag(W/"...")，条件请求使用弱比较，仍然可以返回 304
+"""
+
+import zlib
+from typing import Dict, Iterable, Optional, Tuple
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+# 按优先级排列，协商时 q 值相同则优先 br
+ENCODINGS = ("br", "gzip") if brotli is not None else ("gzip",)
+
+# 内容类型(不含参数) -> 最小压缩字节数，以 "/" 结尾的键匹配整个大类
+CONTENT_TYPES = {
+    "text/": 500,
+    "application/json": 500,
+    "application/javascript": 500,
+    "application/x-ndjson": 500,
+    "application/xml": 500,
+    "image/svg+xml": 500,
+}
+
+
+def parse_accept_encoding(value: str) -> Dict[str, float]:
+    """`gzip;q=0.8, br` -> {"gzip": 0.8, "br": 1.0}"""
+    accepted = {}
+
+    for item in value.split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+
+        if name:
+            accepted[name.strip().lower()] = quality
+
+    return accepted
+
+
+def negotiate(accept_encoding: str, available: Iterable[str] = ENCODINGS) -> Optional[str]:
+    """从 `available` 中选出客户端接受且 q 值最高的编码，都不接受时返回 None"""
+    accepted = parse_accept_encoding(accept_encoding)
+    best, best_quality = None, 0.0
+
+    for encoding in available:
+        quality = accepted.get(encoding, accepted.get("*", 0.0))
+
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+
+    return best
+
+
+def minimum_size(content_type: Optional[str], rules: Dict[str, int]) -> Optional[int]:
+    """内容类型对应的最小压缩字节数，不在规则中时返回 None(不压缩)"""
+    if not content_type:
+        return None
+
+    mime = content_type.split(";")[0].strip().lower()
+
+    if mime in rules:
+        return rules[mime]
+
+    return rules.get(mime.split("/")[0] + "/")
+
+
+class Encoder:
+    """gzip / br 的流式压缩器；`compress(data, final=False)` 返回可以立即发送的字节"""
+
+    def __init__(self, encoding: str, gzip_level: int = 6, brotli_quality: int = 4):
+        self.encoding = encoding
+
+        if encoding == "br":
+            self._brotli = brotli.Compressor(quality=brotli_quality)
+        else:
+            self._zlib = zlib.compressobj(gzip_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data: bytes, final: bool = False) -> bytes:
+        if self.encoding == "br":
+            return self._brotli.process(data) + (self._brotli.finish() if final else self._brotli.flush())
+
+        return self._zlib.compress(data) + self._zlib.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+
+class CompressionMiddleware:
+    def __init__(
+        self,
+        app: ASGIApp,
+        content_types: Dict[str, int] = None,
+        gzip_level: int = 6,
+        brotli_quality: int = 4,
+        encodings: Tuple[str, ...] = ENCODINGS
+    ):
+        self.app = app
+        self.content_types = CONTENT_TYPES if content_types is None else content_types
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.encodings = tuple(encoding for encoding in encodings if encoding in ENCODINGS)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or scope["method"] == "HEAD":
+            await self.app(scope, receive, send)
+            return
+
+        encoding = negotiate(Headers(scope=scope).get("accept-encoding", ""), self.encodings)
+
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        responder = CompressionResponder(self, encoding, send)
+        await self.app(scope, receive, responder.send)
+
+
+class CompressionResponder:
+    """推迟发送 `http.response.start`，拿到第一块响应体后再决定是否压缩"""
+
+    def __init__(self, middleware: CompressionMiddleware, encoding: str, send: Send):
+        self.middleware = middleware
+        self.encoding = encoding
+        self._send = send
+        self.start = None
+        self.encoder = None
+        self.passthrough = False
+
+    async def send(self, message: Message):
+        if message["type"] == "http.response.start":
+            self.start = message
+        elif message["type"] != "http.response.body" or self.passthrough:
+            await self._send(message)
+        elif self.encoder is None:
+            await self.first_body(message)
+        else:
+            more_body = message.get("more_body", False)
+            body = self.encoder.compress(message.get("body", b""), final=not more_body)
+            await self._send({"type": "http.response.body", "body": body, "more_body": more_body})
+
+    async def first_body(self, message: Message):
+        start, self.start = self.start, None
+        headers = MutableHeaders(raw=start["headers"])
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        minimum = minimum_size(headers.get("content-type"), self.middleware.content_types)
+
+        if minimum is not None:
+            headers.add_vary_header("Accept-Encoding")
+
+        if (
+            minimum is None
+            or "content-encoding" in headers
+            or start["status"] in (204, 304)
+            or (not more_body and len(body) < minimum)
+        ):
+            self.passthrough = True
+            await self._send(start)
+            await self._send(message)
+            return
+
+        self.encoder = Encoder(self.encoding, self.middleware.gzip_level, self.middleware.brotli_quality)
+        body = self.encoder.compress(body, final=not more_body)
+        headers["Content-Encoding"] = self.encoding
+
+        if "content-length" in headers:
+            del headers["content-length"]
+
+        if not more_body:
+            headers["Content-Length"] = str(len(body))
+
+        etag = headers.get("etag")
+
+        if etag and not etag.startswith("W/"):
+            headers["ETag"] = "W/" + etag
+
+        await self._send(start)
+        await self._send({"type": "http.response.body", "body": body, "more_body": more_body})
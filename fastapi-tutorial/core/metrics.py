@@ -0,0 +1,447 @@
+# coding: utf8
+# ===================================
+# Author: yumingmin
+# File: metrics.py
+# Cate: FastAPI
+# Create time: 2022/7/25 09:30
+# Update time:
+# ===================================
+
+"""Prometheus 文本格式的监控指标，`GET /metrics` 返回
+* `Counter` / `Gauge` / `Histogram` 按标签值创建子指标，每个子指标一把锁：同一个子指标可能被多个线程更新
+  (连接池指标在线程池和同步 worker 线程中更新)，`+=` 不是原子操作；不同子指标之间互不等待，没有竞争时加锁的开销不到 1us
+* `MetricsMiddleware` 统计每个路由的请求数和耗时，`instrument_routes` 统计每个路由正在处理的请求数；
+  路由标签使用路由模板(如 `/coronavirus/get_city/{city}`)，没有匹配到路由的请求记为 `<unmatched>`
+* 多个 uvicorn worker：设置环境变量 `METRICS_DIR` 指向一个共享目录，每个进程定期(以及被抓取时)把自己的指标写到
+  `metrics-<pid>.json`，`/metrics` 读取目录中的所有文件后合并：计数器和直方图累加，已退出进程的计数仍然保留；
+  `live=True` 的 Gauge(正在处理的请求数、连接池状态)只累加仍在运行的进程
+* 没有设置 `METRICS_DIR` 时只返回当前进程的指标
+"""
+
+import bisect
+import json
+import logging
+import os
+import threading
+from collections import defaultdict
+from time import perf_counter_ns
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+from fastapi.routing import APIRoute
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.routing import BaseRoute, Mount
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Family(NamedTuple):
+    """一个指标的所有样本：(样本名, 标签, 值)，样本名带 `_bucket` / `_sum` / `_count` 等后缀"""
+    name: str
+    type: str
+    documentation: str
+    samples: List[Tuple[str, Labels, float]]
+    live: bool = False
+
+
+class _Value:
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1.0):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+
+class _HistogramValue:
+    __slots__ = ("upper_bounds", "counts", "sum", "_lock")
+
+    def __init__(self, upper_bounds: Sequence[float]):
+        self.upper_bounds = upper_bounds
+        self.counts = [0] * (len(upper_bounds) + 1)  # 最后一个是 +Inf
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        i = bisect.bisect_left(self.upper_bounds, value)
+
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def snapshot(self) -> Tuple[List[int], float]:
+        """(各桶计数, 总和)，两者来自同一时刻，`_count` 与 `_sum` 一致"""
+        with self._lock:
+            return list(self.counts), self.sum
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        registry: Optional["Registry"] = None,
+        live: bool = False
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.live = live
+        self._children: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+
+        if not self.labelnames:
+            self._children[()] = self._new_child()
+
+        (REGISTRY if registry is None else registry).register(self)
+
+    def _new_child(self):
+        return _Value()
+
+    def labels(self, *values: str):
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+
+        if child is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError(f"{self.name} 需要标签 {self.labelnames}")
+
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+
+        return child
+
+    def _samples(self) -> Iterator[Tuple[str, Labels, float]]:
+        for key, child in list(self._children.items()):
+            yield self.name, tuple(zip(self.labelnames, key)), child.value
+
+    def collect(self) -> Family:
+        return Family(self.name, self.type, self.documentation, list(self._samples()), self.live)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1.0):
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def inc(self, amount: float = 1.0):
+        self.labels().inc(amount)
+
+    def dec(self, amount: float = 1.0):
+        self.labels().dec(amount)
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), registry=None,
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.upper_bounds = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramValue(self.upper_bounds)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def _samples(self) -> Iterator[Tuple[str, Labels, float]]:
+        for key, child in list(self._children.items()):
+            labels = tuple(zip(self.labelnames, key))
+            counts, total = child.snapshot()
+            cumulative = 0
+
+            for upper_bound, count in zip(self.upper_bounds + (float("inf"),), counts):
+                cumulative += count
+                yield self.name + "_bucket", labels + (("le", format_value(upper_bound)),), cumulative
+
+            yield self.name + "_sum", labels, total
+            yield self.name + "_count", labels, cumulative
+
+
+class Registry:
+    """进程内所有指标；`collectors` 在每次导出时调用，用于读取连接池、缓存等已有对象的状态
+
+    :param directory: 多进程共享目录，为 None 时只导出当前进程的指标
+    :param flush_interval: 后台线程写出当前进程指标的间隔(秒)
+    """
+
+    def __init__(self, directory: Optional[str] = None, flush_interval: float = 5.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._metrics: Dict[str, Metric] = {}
+        self._collectors: List[Callable[[], Iterable[Family]]] = []
+        self._derived: List[Callable[[Dict[str, Family]], Iterable[Family]]] = []
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def register(self, metric: Metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"指标 {metric.name} 已经注册")
+
+        self._metrics[metric.name] = metric
+
+    def register_collector(self, collector: Callable[[], Iterable[Family]]):
+        self._collectors.append(collector)
+
+    def register_derived(self, derive: Callable[[Dict[str, Family]], Iterable[Family]]):
+        """由合并后的指标计算新指标(如缓存命中率)，不能在各进程中分别计算后再合并"""
+        self._derived.append(derive)
+
+    def collect(self) -> List[Family]:
+        families = [metric.collect() for metric in list(self._metrics.values())]
+
+        for collector in self._collectors:
+            try:
+                families.extend(collector())
+            except Exception:
+                logger.exception("读取监控指标出错: %r", collector)
+
+        return families
+
+    # 多进程：每个进程写自己的文件，导出时合并
+    @property
+    def path(self) -> str:
+        return os.path.join(self.directory, f"metrics-{os.getpid()}.json")
+
+    def flush(self):
+        """把当前进程的指标写到共享目录，先写临时文件再替换，读取方不会读到写了一半的文件"""
+        if self.directory is None:
+            return
+
+        snapshot = {"pid": os.getpid(), "families": [
+            [family.name, family.type, family.documentation, family.samples, family.live] for family in self.collect()
+        ]}
+        temp = f"{self.path}.tmp"
+
+        with open(temp, "w") as f:
+            json.dump(snapshot, f)
+
+        os.replace(temp, self.path)
+
+    def load(self) -> Iterator[Tuple[int, List[Family]]]:
+        for name in os.listdir(self.directory):
+            if not (name.startswith("metrics-") and name.endswith(".json")):
+                continue
+
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+
+            families = [
+                Family(name, type_, documentation, [(s, tuple(map(tuple, labels)), v) for s, labels, v in samples], live)
+                for name, type_, documentation, samples, live in snapshot["families"]
+            ]
+            yield snapshot["pid"], families
+
+    def merged(self) -> Dict[str, Family]:
+        if self.directory is None:
+            processes = [(os.getpid(), self.collect())]
+        else:
+            self.flush()
+            processes = list(self.load())
+
+        merged: Dict[str, Family] = {}
+        values: Dict[str, Dict[Tuple[str, Labels], float]] = defaultdict(lambda: defaultdict(float))
+
+        for pid, families in processes:
+            alive = pid_alive(pid)
+
+            for family in families:
+                merged.setdefault(family.name, family._replace(samples=[]))
+
+                if family.live and not alive:
+                    continue
+
+                for sample_name, labels, value in family.samples:
+                    values[family.name][sample_name, labels] += value
+
+        for name, family in merged.items():
+            family.samples.extend((sample_name, labels, value) for (sample_name, labels), value in values[name].items())
+
+        for derive in self._derived:
+            for family in derive(merged):
+                merged[family.name] = family
+
+        return merged
+
+    def render(self) -> str:
+        lines = []
+
+        for family in sorted(self.merged().values(), key=lambda family: family.name):
+            lines.append(f"# HELP {family.name} {escape(family.documentation)}")
+            lines.append(f"# TYPE {family.name} {family.type}")
+
+            for sample_name, labels, value in family.samples:
+                if labels:
+                    label_text = ",".join(f'{key}="{escape(str(label))}"' for key, label in labels)
+                    lines.append(f"{sample_name}{{{label_text}}} {format_value(value)}")
+                else:
+                    lines.append(f"{sample_name} {format_value(value)}")
+
+        return "\n".join(lines) + "\n"
+
+    # 后台定期写出，进程退出时写最后一次
+    def start(self):
+        if self.directory is None or self._thread is not None:
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._loop, name="metrics-flush", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+
+        self._stopping.set()
+        self._thread.join()
+        self._thread = None
+        self.flush()
+
+    def _loop(self):
+        while not self._stopping.wait(self.flush_interval):
+            try:
+                self.flush()
+            except OSError:
+                logger.exception("写出监控指标失败")
+
+
+def pid_alive(pid: int) -> bool:
+    if pid == os.getpid():
+        return True
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+    return True
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", r"\\").replace("\n", r"\n").replace('"', r'\"')
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+
+    if float(value).is_integer():
+        return str(int(value))
+
+    return repr(float(value))
+
+
+REGISTRY = Registry(os.environ.get("METRICS_DIR"))
+
+REQUESTS = Counter("http_requests_total", "HTTP 请求数", ("method", "route", "status"))
+LATENCY = Histogram("http_request_duration_seconds", "HTTP 请求耗时(秒)", ("method", "route"))
+IN_FLIGHT = Gauge("http_requests_in_flight", "正在处理的 HTTP 请求数", ("method", "route"), live=True)
+
+
+def route_label(scope: Scope) -> str:
+    """`instrument_routes` 记录的路由模板；挂载的子应用(如 /static)使用挂载路径"""
+    route = scope.get("route_path")
+
+    if route is not None:
+        return route
+
+    if "endpoint" in scope:
+        return scope.get("root_path") or scope["path"]
+
+    return "<unmatched>"
+
+
+class MetricsMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = perf_counter_ns()
+        status = 500
+
+        async def send_wrapper(message: Message):
+            nonlocal status
+
+            if message["type"] == "http.response.start":
+                status = message["status"]
+
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = route_label(scope)
+            REQUESTS.labels(scope["method"], route, status).inc()
+            LATENCY.labels(scope["method"], route).observe((perf_counter_ns() - start) / 1e9)
+
+
+def _counted_route_app(app: ASGIApp, path: str) -> ASGIApp:
+    async def route_app(scope: Scope, receive: Receive, send: Send):
+        scope["route_path"] = path
+        in_flight = IN_FLIGHT.labels(scope["method"], path)
+        in_flight.inc()
+
+        try:
+            await app(scope, receive, send)
+        finally:
+            in_flight.dec()
+
+    return route_app
+
+
+def instrument_routes(routes: Iterable[BaseRoute]):
+    """为已经注册的 APIRoute 统计正在处理的请求数，并记录路由模板供 `MetricsMiddleware` 使用"""
+    for route in routes:
+        if isinstance(route, Mount):
+            instrument_routes(route.routes)
+
+        if not isinstance(route, APIRoute) or getattr(route, "_counted", False):
+            continue
+
+        route.app = _counted_route_app(route.app, route.path_format)
+        route._counted = True
+
+
+async def metrics_endpoint(request: Request) -> Response:
+    """读取共享目录中的文件，在线程池中执行"""
+    return Response(await run_in_threadpool(REGISTRY.render), media_type=CONTENT_TYPE)
@@ -0,0 +1,81 @@
+# coding: utf8
+# ===================================
+# Author: yumingmin
+# File: precompress.py
+# Cate: FastAPI
+# Create time: 2022/7/24 11:40
+# Update time:
+# ===================================
+
+"""为静态文件生成预压缩的 .gz / .br 文件，部署前执行一次
+* 只处理文本类文件(css、js、svg、html 等)，小于 `--minimum-size` 的文件跳过
+* 使用最高压缩级别：只在构建时压缩一次，请求时不再消耗 CPU
+* 预压缩文件比原文件新时跳过，可以重复执行；生成的文件不提交到仓库(见 .gitignore)
+运行: python -m core.precompress static
+"""
+
+import argparse
+import gzip
+import os
+from typing import Iterator, Tuple
+
+from .compression import brotli
+
+EXTENSIONS = (".css", ".js", ".map", ".svg", ".html", ".htm", ".json", ".txt", ".xml", ".eot", ".ttf")
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(data, quality=11)
+
+    return gzip.compress(data, compresslevel=9, mtime=0)  # mtime=0 让相同的输入得到相同的输出
+
+
+def iter_sources(directory: str, minimum_size: int) -> Iterator[str]:
+    for root, _, files in os.walk(directory):
+        for name in sorted(files):
+            path = os.path.join(root, name)
+
+            if name.lower().endswith(EXTENSIONS) and os.path.getsize(path) >= minimum_size:
+                yield path
+
+
+def precompress(directory: str, minimum_size: int = 1024, force: bool = False) -> Iterator[Tuple[str, int, int]]:
+    """逐个生成预压缩文件，产出 (文件路径, 原始字节数, 压缩后字节数)"""
+    encodings = {"gzip": ".gz", "br": ".br"} if brotli is not None else {"gzip": ".gz"}
+
+    for path in iter_sources(directory, minimum_size):
+        with open(path, "rb") as f:
+            data = None
+
+            for encoding, suffix in encodings.items():
+                target = path + suffix
+
+                if not force and os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(path):
+                    continue
+
+                data = data if data is not None else f.read()
+                compressed = compress(data, encoding)
+
+                with open(target, "wb") as out:
+                    out.write(compressed)
+
+                yield target, len(data), len(compressed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("directory", nargs="?", default="static")
+    parser.add_argument("--minimum-size", type=int, default=1024)
+    parser.add_argument("--force", action="store_true", help="忽略修改时间，全部重新生成")
+    args = parser.parse_args()
+
+    if brotli is None:
+        print("没有安装 brotli，只生成 .gz 文件")
+
+    for target, size, compressed in precompress(args.directory, args.minimum_size, args.force):
+        print(f"{target}: {size} -> {compressed} ({compressed / size:.1%})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,254 @@
+# coding: utf8
+# ===================================
+# Author: yumingmin
+# File: profiler.py
+# Cate: FastAPI
+# Create time: 2022/7/25 15:00
+# Update time:
+# ===================================
+
+"""SQL 分析，基于引擎的 before/after_cursor_execute 事件，替代只适合开发环境的 `echo=True`
+* 每个请求(或用 `profiler.profile("...")` 包住的一段代码，如同步任务)统计语句数和 SQL 总耗时，并按语句文本分组
+* 疑似 N+1：同一个请求中同一条语句(参数不同)逐条执行了 `n_plus_one_threshold` 次以上，结束时记一条警告日志；
+  executemany 的批量执行(批量 INSERT/UPDATE 每批一次)不算在内
+* 慢查询：超过 `slow_threshold` 秒的语句按 `sample_rate` 采样，连同绑定参数写到 `sql.slow` 日志
+* `debug=True` 时响应头带上 `X-SQL-Profile`(语句数、耗时、疑似 N+1 的语句数)和 `X-SQL-Profile-Id`，
+  最近的分析结果可以通过 `/debug/sql/{profile_id}` 查看，只用于开发环境
+"""
+
+import itertools
+import logging
+import random
+import threading
+from collections import OrderedDict
+from contextvars import ContextVar
+from time import perf_counter_ns
+from typing import Dict, List, Optional
+
+from sqlalchemy import event
+from starlette.datastructures import MutableHeaders
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+logger = logging.getLogger(__name__)
+slow_logger = logging.getLogger("sql.slow")
+
+# 日志中语句和参数的最大长度
+MAX_TEXT = 1000
+
+_current: ContextVar[Optional["Profile"]] = ContextVar("sql_profile", default=None)
+_ids = itertools.count(1)
+
+
+def truncate(value, limit: int = MAX_TEXT) -> str:
+    text = value if isinstance(value, str) else repr(value)
+    return text if len(text) <= limit else text[:limit] + "..."
+
+
+class Profile:
+    """一个请求中执行的 SQL：按语句文本分组的 [次数, 总耗时(纳秒), 最长耗时(纳秒), 其中 executemany 的次数]"""
+
+    __slots__ = ("id", "label", "count", "elapsed", "statements", "slow")
+
+    def __init__(self, label: str):
+        self.id = next(_ids)
+        self.label = label
+        self.count = 0
+        self.elapsed = 0
+        self.statements: Dict[str, List[int]] = {}
+        self.slow: List[dict] = []
+
+    def record(self, statement: str, elapsed: int, executemany: bool = False):
+        self.count += 1
+        self.elapsed += elapsed
+        stats = self.statements.get(statement)
+
+        if stats is None:
+            self.statements[statement] = [1, elapsed, elapsed, int(executemany)]
+        else:
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+            stats[3] += executemany
+
+    def repeated(self, threshold: int) -> Dict[str, int]:
+        """逐条执行(不含 executemany)次数达到 `threshold` 的语句，即疑似 N+1"""
+        repeated = {statement: stats[0] - stats[3] for statement, stats in self.statements.items()}
+        return {statement: count for statement, count in repeated.items() if count >= threshold}
+
+    def summary(self, threshold: int) -> str:
+        return f"statements={self.count}; time={self.elapsed / 1e6:.3f}ms; n_plus_one={len(self.repeated(threshold))}"
+
+    def to_dict(self, threshold: int) -> dict:
+        statements = sorted(self.statements.items(), key=lambda item: item[1][1], reverse=True)
+        return {
+            "id": self.id,
+            "label": self.label,
+            "statements": self.count,
+            "time_ms": round(self.elapsed / 1e6, 3),
+            "n_plus_one": self.repeated(threshold),
+            "slow": self.slow,
+            "by_statement": [
+                {
+                    "statement": statement, "count": count, "executemany": batches,
+                    "time_ms": round(total / 1e6, 3), "max_ms": round(top / 1e6, 3)
+                }
+                for statement, (count, total, top, batches) in statements
+            ],
+        }
+
+
+class profile_scope:
+    """`with profiler.profile("sync_job:1") as profile:`，请求之外的代码也按请求的方式统计"""
+
+    def __init__(self, profiler: "SQLProfiler", label: str):
+        self.profiler = profiler
+        self.profile = Profile(label)
+
+    def __enter__(self) -> Profile:
+        self.token = _current.set(self.profile)
+        return self.profile
+
+    def __exit__(self, *exc_info):
+        _current.reset(self.token)
+        self.profiler.finish(self.profile)
+
+
+class SQLProfiler:
+    """
+    :param slow_threshold: 慢查询阈值(秒)
+    :param sample_rate: 慢查询日志的采样比例，1.0 表示全部记录
+    :param n_plus_one_threshold: 同一请求中同一语句执行多少次判定为疑似 N+1
+    :param debug: 是否在响应头中返回分析结果，并保留最近 `history` 个请求的结果
+    """
+
+    def __init__(
+        self,
+        slow_threshold: float = 0.1,
+        sample_rate: float = 1.0,
+        n_plus_one_threshold: int = 5,
+        debug: bool = False,
+        history: int = 100
+    ):
+        self.configure(slow_threshold, sample_rate, n_plus_one_threshold, debug, history)
+
+    def configure(
+        self,
+        slow_threshold: float = 0.1,
+        sample_rate: float = 1.0,
+        n_plus_one_threshold: int = 5,
+        debug: bool = False,
+        history: int = 100
+    ):
+        self.slow_threshold = int(slow_threshold * 1e9)
+        self.sample_rate = sample_rate
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self.debug = debug
+        self.history = history
+        self.recent: "OrderedDict[int, Profile]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def profile(self, label: str) -> profile_scope:
+        return profile_scope(self, label)
+
+    def finish(self, profile: Profile):
+        for statement, count in profile.repeated(self.n_plus_one_threshold).items():
+            logger.warning("疑似 N+1：%s 中同一语句执行了 %d 次: %s", profile.label, count, truncate(statement, 200))
+
+        if self.debug:
+            with self._lock:
+                self.recent[profile.id] = profile
+
+                while len(self.recent) > self.history:
+                    self.recent.popitem(last=False)
+
+    # 引擎事件：开始时间压栈，同一连接上的语句不会交叉执行
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("profiler_start", []).append(perf_counter_ns())
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = perf_counter_ns() - conn.info["profiler_start"].pop()
+        profile = _current.get()
+
+        if profile is not None:
+            profile.record(statement, elapsed, executemany)
+
+        if elapsed >= self.slow_threshold and random.random() < self.sample_rate:
+            self.log_slow(profile, statement, parameters, elapsed)
+
+    def handle_error(self, exception_context):
+        starts = exception_context.connection.info.get("profiler_start") if exception_context.connection else None
+
+        if starts:
+            starts.pop()
+
+    def log_slow(self, profile: Optional[Profile], statement: str, parameters, elapsed: int):
+        label = profile.label if profile is not None else "-"
+        slow_logger.warning(
+            "慢查询 %.1fms [%s]: %s 参数: %s", elapsed / 1e6, label, truncate(statement), truncate(parameters)
+        )
+
+        if profile is not None and self.debug:
+            profile.slow.append({
+                "statement": truncate(statement),
+                "parameters": truncate(parameters),
+                "time_ms": round(elapsed / 1e6, 3)
+            })
+
+    def instrument_engine(self, engine):
+        """注册到引擎上，异步引擎注册到其内部的同步引擎"""
+        engine = getattr(engine, "sync_engine", engine)
+
+        if event.contains(engine, "before_cursor_execute", self.before_cursor_execute):
+            return
+
+        event.listen(engine, "before_cursor_execute", self.before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", self.after_cursor_execute)
+        event.listen(engine, "handle_error", self.handle_error)
+
+
+class SQLProfileMiddleware:
+    """每个请求一个 `Profile`，标签为 `METHOD 路径`"""
+
+    def __init__(self, app: ASGIApp, profiler: SQLProfiler):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        profiler = self.profiler
+
+        with profiler.profile(f"{scope['method']} {scope['path']}") as profile:
+            if not profiler.debug:
+                await self.app(scope, receive, send)
+                return
+
+            async def send_wrapper(message: Message):
+                if message["type"] == "http.response.start":
+                    headers = MutableHeaders(scope=message)
+                    headers["X-SQL-Profile"] = profile.summary(profiler.n_plus_one_threshold)
+                    headers["X-SQL-Profile-Id"] = str(profile.id)
+
+                await send(message)
+
+            await self.app(scope, receive, send_wrapper)
+
+
+def profile_endpoint(profiler: SQLProfiler):
+    """`/debug/sql/{profile_id:int}`：返回最近请求的完整分析结果，只在 debug 时注册"""
+    async def endpoint(request: Request):
+        profile = profiler.recent.get(request.path_params["profile_id"])
+
+        if profile is None:
+            return JSONResponse({"detail": "分析结果不存在或已过期"}, status_code=404)
+
+        return JSONResponse(profile.to_dict(profiler.n_plus_one_threshold))
+
+    return endpoint
+
+
+profiler = SQLProfiler()
@@ -0,0 +1,288 @@
+# coding: utf8
+# ===================================
+# Author: yumingmin
+# File: ratelimit.py
+# Cate: FastAPI
+# Create time: 2022/7/26 16:00
+# Update time:
+# ===================================
+
+"""令牌桶限流，用于登录、同步数据等开销大的接口
+* 每个键(如客户端 IP、登录的用户名)一个令牌桶：容量为 `Rate.capacity`，每秒补充 `Rate.per_second` 个令牌，
+  每个请求消耗一个，令牌不足时返回 429 和 `Retry-After`
+* `RateLimiter` 用作依赖 `dependencies=[Depends(limiter)]`，键由 `key` 函数从请求中取出，可以读取表单(如用户名)；
+  `RateLimitMiddleware` 在路由之前按路径前缀限流，只能使用不读取请求体的键(如 IP)
+* `MemoryStore`：按键的哈希分片，每个分片一把锁，不同键之间很少互相等待；已补满的桶等同于不存在，键过多时清理
+* `SQLiteStore`：多个 uvicorn worker 共用一个 SQLite 文件，每次取令牌是一条 UPSERT ... RETURNING 语句，
+  由 SQLite 的写锁保证原子性；设置环境变量 `RATE_LIMIT_DB` 时默认使用，否则每个进程单独限流。
+  一次约 20us，直接在事件循环中执行(放到线程池的切换开销远大于语句本身)，等待写锁最多 `timeout` 秒，
+  超时则放行并记录警告，限流存储出问题时不影响接口本身
+* 环境变量 `RATE_LIMIT_ENABLED=false` 时关闭所有限流(如压测)
+"""
+
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+from typing import Awaitable, Callable, Dict, Iterable, NamedTuple, Optional, Tuple
+
+from fastapi import HTTPException, status
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from .metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.environ.get("RATE_LIMIT_ENABLED", "true").lower() not in ("false", "0", "no")
+
+PERIODS = {"second": 1.0, "minute": 60.0, "hour": 3600.0, "day": 86400.0}
+
+REJECTIONS = Counter("rate_limit_rejections_total", "被限流拒绝的请求数", ("limiter",))
+
+
+class Rate(NamedTuple):
+    """`period` 秒内平均允许 `limit` 个请求，最多连续 `burst` 个(默认等于 `limit`)"""
+    limit: int
+    period: float
+    burst: Optional[int] = None
+
+    @property
+    def capacity(self) -> float:
+        return float(self.burst or self.limit)
+
+    @property
+    def per_second(self) -> float:
+        return self.limit / self.period
+
+    @classmethod
+    def parse(cls, text: Optional[str]) -> Optional["Rate"]:
+        """`"10/minute"`、`"1/second"`；为空时返回 None，表示不限流"""
+        if not text:
+            return None
+
+        limit, _, period = text.partition("/")
+
+        if period not in PERIODS:
+            raise ValueError(f"无效的限流配置 {text!r}，应为 <次数>/{'|'.join(PERIODS)}")
+
+        return cls(int(limit), PERIODS[period])
+
+
+class Decision(NamedTuple):
+    allowed: bool
+    remaining: float
+    # 被拒绝时，还需要等待多少秒才有足够的令牌
+    retry_after: float
+
+
+def take(tokens: float, elapsed: float, rate: Rate, cost: float) -> Tuple[float, Decision]:
+    """补充 `elapsed` 秒的令牌后尝试取出 `cost` 个，返回 (剩余令牌数, 结果)"""
+    tokens = min(rate.capacity, tokens + elapsed * rate.per_second)
+
+    if tokens >= cost:
+        return tokens - cost, Decision(True, tokens - cost, 0.0)
+
+    return tokens, Decision(False, tokens, (cost - tokens) / rate.per_second)
+
+
+class MemoryStore:
+    """当前进程内的令牌桶
+
+    :param shards: 分片数，每个分片一把锁
+    :param max_keys: 桶的数量上限，超过时先清理已补满的桶，仍然超过时丢弃最早创建的桶
+    """
+
+    def __init__(self, shards: int = 16, max_keys: int = 100_000):
+        self._shards = [({}, threading.Lock()) for _ in range(shards)]
+        self._max_keys = max(1, max_keys // shards)
+
+    def acquire(self, key: str, rate: Rate, cost: float = 1.0) -> Decision:
+        buckets, lock = self._shards[hash(key) % len(self._shards)]
+        now = time.monotonic()
+
+        with lock:
+            # 桶的状态：[令牌数, 更新时间, 补满的时间]
+            bucket = buckets.get(key)
+
+            if bucket is None:
+                tokens, decision = take(rate.capacity, 0.0, rate, cost)
+                buckets[key] = [tokens, now, now + (rate.capacity - tokens) / rate.per_second]
+
+                if len(buckets) > self._max_keys:
+                    self._prune(buckets, now)
+            else:
+                bucket[0], decision = take(bucket[0], now - bucket[1], rate, cost)
+                bucket[1] = now
+                bucket[2] = now + (rate.capacity - bucket[0]) / rate.per_second
+
+        return decision
+
+    def _prune(self, buckets: Dict[str, list], now: float):
+        for key in [key for key, bucket in buckets.items() if bucket[2] <= now]:
+            del buckets[key]
+
+        for key in list(buckets)[:len(buckets) - self._max_keys]:
+            del buckets[key]
+
+    def clear(self):
+        for buckets, lock in self._shards:
+            with lock:
+                buckets.clear()
+
+
+class SQLiteStore:
+    """多个进程共用的令牌桶，保存在 SQLite 文件中；时间使用 `time.time()`，各进程一致
+
+    :param path: 数据库文件，所有 worker 使用同一个路径
+    :param prune_every: 每个连接每执行多少次清理一次已补满的桶
+    """
+
+    def __init__(self, path: str, timeout: float = 0.1, prune_every: int = 1000):
+        self.path = path
+        self.timeout = timeout
+        self.prune_every = prune_every
+        self._local = threading.local()
+        self._connection().execute(
+            "CREATE TABLE IF NOT EXISTS rate_limit_buckets ("
+            "key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL, full_at REAL NOT NULL, "
+            "allowed INTEGER NOT NULL)"
+        )
+
+    def _connection(self) -> sqlite3.Connection:
+        # 每个线程一个连接；isolation_level=None 即自动提交，每条语句是一个事务
+        conn = getattr(self._local, "conn", None)
+
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # 限流状态丢失的代价只是短时间内多放过一些请求，不需要每次提交都刷盘
+            conn.execute("PRAGMA synchronous=OFF")
+            self._local.conn = conn
+            self._local.calls = 0
+
+        return conn
+
+    def acquire(self, key: str, rate: Rate, cost: float = 1.0) -> Decision:
+        conn = self._connection()
+        now = time.time()
+        params = {"key": key, "now": now, "capacity": rate.capacity, "rate": rate.per_second, "cost": cost}
+        # 新建的桶是满的；已有的桶先按经过的时间补充令牌(不超过容量)，足够时再扣除。SET 中的列都是更新前的值
+        available = "min(:capacity, tokens + (:now - updated) * :rate)"
+        remaining = f"{available} - (CASE WHEN {available} >= :cost THEN :cost ELSE 0 END)"
+        try:
+            tokens, allowed = conn.execute(
+                "INSERT INTO rate_limit_buckets (key, tokens, updated, full_at, allowed) "
+                "VALUES (:key, :capacity - :cost, :now, :now + :cost / :rate, 1) "
+                f"ON CONFLICT (key) DO UPDATE SET tokens = {remaining}, updated = :now, "
+                f"full_at = :now + (:capacity - ({remaining})) / :rate, allowed = {available} >= :cost "
+                "RETURNING tokens, allowed",
+                params
+            ).fetchone()
+        except sqlite3.OperationalError as exc:
+            logger.warning("限流存储 %s 不可用，放行请求: %s", self.path, exc)
+            return Decision(True, 0.0, 0.0)
+
+        self._local.calls += 1
+
+        if self._local.calls % self.prune_every == 0:
+            conn.execute("DELETE FROM rate_limit_buckets WHERE full_at <= ?", (now,))
+
+        if allowed:
+            return Decision(True, tokens, 0.0)
+
+        return Decision(False, tokens, (cost - tokens) / rate.per_second)
+
+    def clear(self):
+        self._connection().execute("DELETE FROM rate_limit_buckets")
+
+
+def default_store():
+    path = os.environ.get("RATE_LIMIT_DB")
+    return SQLiteStore(path) if path else MemoryStore()
+
+
+STORE = default_store()
+
+KeyFunc = Callable[[Request], Awaitable[Optional[str]]]
+
+
+async def client_ip(request: Request) -> Optional[str]:
+    return request.client.host if request.client else None
+
+
+async def form_username(request: Request) -> Optional[str]:
+    """OAuth2 密码模式表单中的用户名；FastAPI 已经解析过表单，这里读取的是缓存"""
+    form = await request.form()
+    return form.get("username") or None
+
+
+class RateLimiter:
+    """
+    :param name: 限流器名称，作为桶的键前缀和监控指标的标签
+    :param rate: 为 None 时不限流
+    :param key: 从请求中取出限流的键，返回 None 时不限流
+    :param store: 默认使用 `STORE`
+    """
+
+    def __init__(self, name: str, rate: Optional[Rate], key: KeyFunc = client_ip, store=None):
+        self.name = name
+        self.rate = rate
+        self.key = key
+        self.store = STORE if store is None else store
+        self._rejections = REJECTIONS.labels(name)
+
+    async def hit(self, request: Request) -> Optional[Decision]:
+        """取一个令牌，返回被拒绝时的结果，允许时返回 None"""
+        if not ENABLED or self.rate is None:
+            return None
+
+        key = await self.key(request)
+
+        if key is None:
+            return None
+
+        decision = self.store.acquire(f"{self.name}:{key}", self.rate)
+
+        if decision.allowed:
+            return None
+
+        self._rejections.inc()
+        return decision
+
+    async def __call__(self, request: Request):
+        decision = await self.hit(request)
+
+        if decision is not None:
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Too many requests",
+                headers={"Retry-After": str(math.ceil(decision.retry_after))}
+            )
+
+
+class RateLimitMiddleware:
+    """对路径以 `prefixes` 中任一前缀开头的请求限流"""
+
+    def __init__(self, app: ASGIApp, limiter: RateLimiter, prefixes: Iterable[str]):
+        self.app = app
+        self.limiter = limiter
+        self.prefixes = tuple(prefixes)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] == "http" and scope["path"].startswith(self.prefixes):
+            decision = await self.limiter.hit(Request(scope))
+
+            if decision is not None:
+                response = JSONResponse(
+                    {"detail": "Too many requests"},
+                    status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                    headers={"Retry-After": str(math.ceil(decision.retry_after))}
+                )
+                await response(scope, receive, send)
+                return
+
+        await self.app(scope, receive, send)
@@ -0,0 +1,45 @@
+# coding: utf8
+# ===================================
+# Author: yumingmin
+# File: responses.py
+# Cate: FastAPI
+# Create time: 2022/7/23 10:10
+# Update time:
+# ===================================
+
+"""应用默认的 JSON 响应类
+* 安装了 orjson 时用 orjson 序列化，比标准库 json 快一个数量级，并且原生支持 date/datetime、NumPy 数组
+* 没有安装 orjson 时退回标准库 json，输出格式相同(紧凑、不转义中文、date/datetime 为 ISO 格式)
+* 序列化耗时记入 `Server-Timing` 的 render 阶段
+"""
+
+import json
+from datetime import date, datetime
+from typing import Any
+
+from fastapi.responses import JSONResponse
+
+from .timing import phase
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+def _default(value: Any):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        with phase("render"):
+            if orjson is not None:
+                return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+
+            return json.dumps(
+                content, ensure_ascii=False, allow_nan=False, separators=(",", ":"), default=_default
+            ).encode("utf-8")
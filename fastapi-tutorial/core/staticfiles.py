@@ -0,0 +1,65 @@
+# coding: utf8
+# ===================================
+# Author: yumingmin
+# File: staticfiles.py
+# Cate: FastAPI
+# Create time: 2022/7/24 11:00
+# Update time:
+# ===================================
+
+"""优先返回预压缩文件的静态文件目录
+* 请求 `js/semantic.min.js` 且客户端接受 br 时，如果存在 `js/semantic.min.js.br` 就直接返回它，不在每次请求时压缩
+* 预压缩文件由 `python -m core.precompress static` 生成，比原文件旧时视为过期，退回原文件(再由压缩中间件处理)
+"""
+
+import stat
+
+import anyio
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+from starlette.types import Scope
+
+from .compression import ENCODINGS, negotiate
+
+# 编码 -> 预压缩文件的后缀
+SUFFIXES = {"br": ".br", "gzip": ".gz"}
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    async def get_response(self, path: str, scope: Scope) -> Response:
+        response = await super().get_response(path, scope)
+
+        if not isinstance(response, FileResponse) or response.status_code != 200:
+            return response
+
+        request_headers = Headers(scope=scope)
+        source = response.stat_result
+        available = list(ENCODINGS)
+
+        while available:
+            encoding = negotiate(request_headers.get("accept-encoding", ""), available)
+
+            if encoding is None:
+                break
+
+            available.remove(encoding)
+            full_path, stat_result = await anyio.to_thread.run_sync(self.lookup_path, path + SUFFIXES[encoding])
+
+            if stat_result is None or not stat.S_ISREG(stat_result.st_mode) or stat_result.st_mtime < source.st_mtime:
+                continue
+
+            compressed = FileResponse(
+                full_path,
+                stat_result=stat_result,
+                method=scope["method"],
+                media_type=response.media_type,
+                headers={"Content-Encoding": encoding, "Vary": "Accept-Encoding"}
+            )
+
+            if self.is_not_modified(compressed.headers, request_headers):
+                return NotModifiedResponse(compressed.headers)
+
+            return compressed
+
+        return response
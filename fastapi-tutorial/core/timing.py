@@ -0,0 +1,215 @@
+# coding: utf8
+# ===================================
+# Author: yumingmin
+# File: timing.py
+# Cate: FastAPI
+# Create time: 2022/7/24 18:30
+# Update time:
+# ===================================
+
+"""请求耗时统计，结果写到 `Server-Timing` 和 `X-Process-Time` 响应头
+* `TimingMiddleware` 是纯 ASGI 中间件，不像 `@app.middleware("http")` 那样为每个请求创建任务、包装响应流，
+  流式响应也能正常逐块发送；计时使用单调的 `time.perf_counter_ns()`
+* 每个请求在 contextvar 中持有一个 `Timings`，各阶段按栈记录，嵌套的阶段从外层扣除，互不重复计算：
+  - total: 从收到请求到发出 `http.response.start` 的时间(流式响应之后发送的部分不计入)
+  - db: SQL 执行时间，来自引擎的 before/after_cursor_execute 事件，需要用 `instrument_engine` 注册
+  - validation: FastAPI 解析、校验请求参数、解析依赖、校验和编码 response_model 的时间，需要用 `instrument_routes` 注册
+  - render: 响应体序列化(JSON、模板)的时间，由 `phase("render")` 标记
+* 线程池中执行的同步路由函数会复制 contextvar，记录到同一个 `Timings`；请求之外(如后台同步线程)的 SQL 不做记录
+"""
+
+import asyncio
+import functools
+from contextvars import ContextVar
+from time import perf_counter_ns
+from typing import Callable, Dict, Iterable, List, Optional
+
+from fastapi.routing import APIRoute
+from sqlalchemy import event
+from starlette.datastructures import MutableHeaders
+from starlette.routing import BaseRoute, Mount
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# Server-Timing 中输出的阶段，按顺序排列
+METRICS = ("db", "validation", "render")
+
+_current: ContextVar[Optional["Timings"]] = ContextVar("timings", default=None)
+
+
+class Timings:
+    """一个请求的各阶段耗时(纳秒)，同一时刻只有栈顶的阶段在计时"""
+
+    __slots__ = ("start", "phases", "_stack", "_since")
+
+    def __init__(self):
+        self.start = perf_counter_ns()
+        self.phases: Dict[str, int] = dict.fromkeys(METRICS, 0)
+        self._stack: List[str] = []
+        self._since = self.start
+
+    def enter(self, name: str):
+        now = perf_counter_ns()
+
+        if self._stack:
+            top = self._stack[-1]
+            self.phases[top] = self.phases.get(top, 0) + now - self._since
+
+        self._stack.append(name)
+        self._since = now
+
+    def exit(self, name: str):
+        if name not in self._stack:
+            return
+
+        now = perf_counter_ns()
+        top = self._stack[-1]
+        self.phases[top] = self.phases.get(top, 0) + now - self._since
+        self._since = now
+
+        # 内层阶段异常退出时可能没有配对的 exit，一并出栈
+        while self._stack.pop() != name:
+            pass
+
+    def server_timing(self, total: int) -> str:
+        metrics = [f"total;dur={total / 1e6:.3f}"]
+        metrics.extend(f"{name};dur={self.phases[name] / 1e6:.3f}" for name in METRICS)
+        return ", ".join(metrics)
+
+
+def current() -> Optional[Timings]:
+    return _current.get()
+
+
+class phase:
+    """`with phase("render"): ...`，不在请求中时什么也不做"""
+
+    __slots__ = ("name", "timings")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.timings = _current.get()
+
+        if self.timings is not None:
+            self.timings.enter(self.name)
+
+    def __exit__(self, *exc_info):
+        if self.timings is not None:
+            self.timings.exit(self.name)
+
+
+class TimingMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timings = Timings()
+        token = _current.set(timings)
+
+        async def send_wrapper(message: Message):
+            if message["type"] == "http.response.start":
+                total = perf_counter_ns() - timings.start
+                headers = MutableHeaders(scope=message)
+                headers.append("Server-Timing", timings.server_timing(total))
+                headers["X-Process-Time"] = str(total / 1e9)
+
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _current.reset(token)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    timings = _current.get()
+
+    if timings is not None:
+        timings.enter("db")
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    timings = _current.get()
+
+    if timings is not None:
+        timings.exit("db")
+
+
+def _handle_error(exception_context):
+    timings = _current.get()
+
+    if timings is not None:
+        timings.exit("db")
+
+
+def instrument_engine(engine):
+    """在引擎上注册 SQL 计时事件，异步引擎注册到其内部的同步引擎"""
+    engine = getattr(engine, "sync_engine", engine)
+
+    if event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+        return
+
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(engine, "handle_error", _handle_error)
+
+
+def _timed_endpoint(call: Callable) -> Callable:
+    """路由函数本身的耗时记为 "app" 阶段(不输出)，从 validation 中扣除"""
+    if asyncio.iscoroutinefunction(call):
+        @functools.wraps(call)
+        async def endpoint(*args, **kwargs):
+            with phase("app"):
+                return await call(*args, **kwargs)
+    else:
+        @functools.wraps(call)
+        def endpoint(*args, **kwargs):
+            with phase("app"):
+                return call(*args, **kwargs)
+
+    return endpoint
+
+
+def _timed_route_app(app: ASGIApp) -> ASGIApp:
+    """路由处理从开始到发出 `http.response.start` 记为 validation，扣除其中的 app、db、render 阶段"""
+    async def route_app(scope: Scope, receive: Receive, send: Send):
+        timings = _current.get()
+
+        if timings is None:
+            await app(scope, receive, send)
+            return
+
+        async def send_wrapper(message: Message):
+            if message["type"] == "http.response.start":
+                timings.exit("validation")
+
+            await send(message)
+
+        timings.enter("validation")
+
+        try:
+            await app(scope, receive, send_wrapper)
+        finally:
+            timings.exit("validation")
+
+    return route_app
+
+
+def instrument_routes(routes: Iterable[BaseRoute]):
+    """为已经注册的 APIRoute 加上 validation 计时，在所有 `include_router` 之后调用"""
+    for route in routes:
+        if isinstance(route, Mount):
+            instrument_routes(route.routes)
+
+        if not isinstance(route, APIRoute) or getattr(route, "_timed", False):
+            continue
+
+        # FastAPI 在请求时才读取 `dependant.call`，替换后仍按原来的同步/异步方式调用
+        route.dependant.call = _timed_endpoint(route.dependant.call)
+        route.app = _timed_route_app(route.app)
+        route._timed = True
@@ -0,0 +1,251 @@
+# coding: utf8
+# ===================================
+# Author: yumingmin
+# File: analytics.py
+# Cate: FastAPI
+# Create time: 2022/7/21 10:05
+# Update time:
+# ===================================
+
+"""基于 NumPy 的省份时间序列分析
+* `TimeSeriesStore` 把所有省份的 confirmed/deaths/recovered 读入一个 (3, 省份数, 天数) 的 int64 数组，日期轴连续，
+  缺失的日期用前一天的累计数填充
+* 增量刷新：只读取 id 大于上次最大 id 的新行，以及 `sync_state` 中哈希变化(同步修改过)的省份；全量同步重建城市后整体重新加载
+* 指标一次对所有省份向量化计算：每日新增、移动平均、日均增长率、翻倍天数
+"""
+
+import threading
+import time
+from datetime import date
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+import numpy as np
+from sqlalchemy import String, func, or_, select, type_coerce
+from sqlalchemy.orm import Session
+
+from . import models, schemas
+from .config import settings
+
+METRICS = [metric.value for metric in schemas.Metric]
+
+# 日期按字符串读出，由 NumPy 批量解析，省去逐行构造 `datetime.date` 对象
+COLUMNS = (
+    models.Data.city_id,
+    type_coerce(models.Data.date, String).label("date"),
+    models.Data.confirmed,
+    models.Data.deaths,
+    models.Data.recovered
+)
+
+
+class Snapshot(NamedTuple):
+    """某一时刻的全部序列，创建后不再修改，刷新时生成新的快照"""
+    city_ids: np.ndarray  # (P,) 升序
+    provinces: List[str]
+    start: np.datetime64  # 日期轴的第一天，没有数据时为 None
+    values: np.ndarray  # (3, P, D)，原始值，缺失为 -1
+    cumulative: np.ndarray  # (3, P, D)，缺失值用前一天填充
+    max_id: int
+    hashes: Dict[int, str]
+
+    @property
+    def dates(self) -> np.ndarray:
+        return self.start + np.arange(self.values.shape[-1]) if self.start is not None else np.array([], "M8[D]")
+
+
+def forward_fill(values: np.ndarray) -> np.ndarray:
+    """沿最后一维用前一个非缺失值填充，开头的缺失值为 0"""
+    days = np.arange(values.shape[-1])
+    index = np.maximum.accumulate(np.where(values >= 0, days, -1), axis=-1)
+    filled = np.take_along_axis(values, np.maximum(index, 0), axis=-1)
+    return np.where(index >= 0, filled, 0)
+
+
+def build(
+    cities: Dict[int, str],
+    rows: Iterable[tuple],
+    max_id: int,
+    hashes: Dict[int, str],
+    previous: Optional[Snapshot] = None,
+    reset: Iterable[int] = ()
+) -> Snapshot:
+    """由 (city_id, date, confirmed, deaths, recovered) 行生成快照；传入 `previous` 时在其基础上更新，`reset` 中的省份先清空"""
+    columns = list(zip(*rows)) or [(), (), (), (), ()]
+    city_col = np.array(columns[0], dtype=np.int64)
+    day_col = np.array(columns[1], dtype="M8[D]")
+    metric_cols = np.array(columns[2:], dtype=np.int64)
+
+    city_ids = np.array(sorted(cities), dtype=np.int64)
+    bounds = list(day_col[[day_col.argmin(), day_col.argmax()]]) if len(day_col) else []
+
+    if previous is not None and previous.start is not None:
+        bounds += [previous.start, previous.start + previous.values.shape[-1] - 1]
+
+    start = min(bounds) if bounds else None
+    days = int((max(bounds) - start).astype(int)) + 1 if bounds else 0
+    values = np.full((len(METRICS), len(city_ids), days), -1, dtype=np.int64)
+
+    if previous is not None and previous.start is not None:
+        # 旧快照中仍然存在的省份，复制到新数组中对应的行和列
+        keep = np.isin(previous.city_ids, city_ids)
+        offset = int((previous.start - start).astype(int))
+        target = np.searchsorted(city_ids, previous.city_ids[keep])
+        values[:, target, offset:offset + previous.values.shape[-1]] = previous.values[:, keep]
+
+    values[:, np.searchsorted(city_ids, np.fromiter(reset, dtype=np.int64))] = -1
+
+    if len(city_col):
+        values[:, np.searchsorted(city_ids, city_col), (day_col - start).astype(int)] = metric_cols
+
+    return Snapshot(
+        city_ids=city_ids,
+        provinces=[cities[city_id] for city_id in city_ids.tolist()],
+        start=start,
+        values=values,
+        cumulative=forward_fill(values),
+        max_id=max_id,
+        hashes=hashes
+    )
+
+
+class TimeSeriesStore:
+    """进程内的序列缓存，线程安全；读请求通过 `snapshot` 获取，最多每 `refresh_interval` 秒检查一次数据库"""
+
+    def __init__(self, refresh_interval: float = settings.analytics_refresh_interval):
+        self.refresh_interval = refresh_interval
+        self._snapshot = None
+        self._refreshed_at = float("-inf")
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._snapshot is not None
+
+    def snapshot(self, db: Session) -> Snapshot:
+        if self._snapshot is None or time.monotonic() - self._refreshed_at >= self.refresh_interval:
+            return self.refresh(db)
+
+        return self._snapshot
+
+    def refresh(self, db: Session) -> Snapshot:
+        with self._lock:
+            previous = self._snapshot
+            cities = dict(db.query(models.City.id, models.City.province))
+            hashes = dict(db.query(models.SyncState.city_id, models.SyncState.content_hash))
+            max_id = db.query(func.max(models.Data.id)).scalar() or 0
+
+            if previous is None or max_id < previous.max_id or not set(previous.city_ids.tolist()) <= cities.keys():
+                # 首次加载，或者全量同步删除了数据
+                rows = db.execute(select(*COLUMNS).where(models.Data.city_id.isnot(None))).all()
+                snapshot = build(cities, rows, max_id, hashes)
+            else:
+                changed = [city_id for city_id, digest in hashes.items() if previous.hashes.get(city_id) != digest]
+                statement = select(*COLUMNS).where(
+                    models.Data.city_id.isnot(None),
+                    or_(models.Data.id > previous.max_id, models.Data.city_id.in_(changed))
+                )
+                rows = db.execute(statement).all() if max_id > previous.max_id or changed else []
+                snapshot = build(cities, rows, max_id, hashes, previous, reset=changed)
+
+            self._snapshot = snapshot
+            self._refreshed_at = time.monotonic()
+            return snapshot
+
+    def clear(self):
+        with self._lock:
+            self._snapshot = None
+
+
+def new_cases(cumulative: np.ndarray) -> np.ndarray:
+    """每日新增，第一天为当天的累计数"""
+    return np.diff(cumulative, axis=-1, prepend=0)
+
+
+def moving_average(values: np.ndarray, window: int = 7) -> np.ndarray:
+    """尾随 `window` 天的平均值，不足 `window` 天的位置为 NaN"""
+    out = np.full(values.shape, np.nan)
+
+    if window <= values.shape[-1]:
+        total = np.cumsum(values, axis=-1, dtype=np.float64)
+        total[..., window:] = total[..., window:] - total[..., :-window]
+        out[..., window - 1:] = total[..., window - 1:] / window
+
+    return out
+
+
+def growth_rate(cumulative: np.ndarray, window: int = 7) -> np.ndarray:
+    """近 `window` 天的日均复合增长率 (c[t] / c[t - window]) ** (1 / window) - 1，基数为 0 时为 NaN"""
+    out = np.full(cumulative.shape, np.nan)
+
+    if window < cumulative.shape[-1]:
+        base = cumulative[..., :-window].astype(np.float64)
+        ratio = np.divide(cumulative[..., window:], base, out=np.full(base.shape, np.nan), where=base > 0)
+        out[..., window:] = np.power(ratio, 1.0 / window) - 1
+
+    return out
+
+
+def doubling_time(cumulative: np.ndarray, window: int = 7) -> np.ndarray:
+    """按近 `window` 天的增长率计算的翻倍天数，没有增长时为 NaN"""
+    rate = growth_rate(cumulative, window)
+    out = np.full(rate.shape, np.nan)
+    np.divide(np.log(2), np.log1p(rate, where=rate > 0, out=np.zeros(rate.shape)), out=out, where=rate > 0)
+    return out
+
+
+def compute(
+    snapshot: Snapshot,
+    indicator: schemas.Indicator,
+    metric: schemas.Metric = schemas.Metric.confirmed,
+    window: int = 7,
+    city: str = None,
+    start: date = None,
+    end: date = None
+) -> Optional[dict]:
+    """对所有省份(或 `city` 一个省份)计算指标，再截取 [start, end]；省份不存在时返回 None"""
+    cumulative = snapshot.cumulative[METRICS.index(metric.value)]
+    provinces = snapshot.provinces
+
+    if city is not None:
+        if city not in provinces:
+            return None
+
+        row = provinces.index(city)
+        cumulative, provinces = cumulative[row:row + 1], [city]
+
+    if indicator == schemas.Indicator.new_cases:
+        result = new_cases(cumulative)
+    elif indicator == schemas.Indicator.moving_average:
+        result = moving_average(new_cases(cumulative), window)
+    elif indicator == schemas.Indicator.growth_rate:
+        result = growth_rate(cumulative, window)
+    else:
+        result = doubling_time(cumulative, window)
+
+    dates = snapshot.dates
+    mask = np.ones(len(dates), dtype=bool)
+
+    if start is not None:
+        mask &= dates >= np.datetime64(start, "D")
+
+    if end is not None:
+        mask &= dates <= np.datetime64(end, "D")
+
+    result = result[:, mask]
+
+    if result.dtype.kind == "f":
+        result = np.round(result, 6)
+        series = [[None if value != value else value for value in row] for row in result.tolist()]  # NaN -> null
+    else:
+        series = result.tolist()
+
+    return {
+        "indicator": indicator,
+        "metric": metric,
+        "window": window,
+        "dates": dates[mask].astype(str).tolist(),
+        "series": dict(zip(provinces, series))
+    }
+
+
+store = TimeSeriesStore()
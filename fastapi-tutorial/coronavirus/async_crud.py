@@ -0,0 +1,70 @@
+# coding: utf8
+# ===================================
+# Author: yumingmin
+# File: async_crud.py
+# Cate: FastAPI
+# Create time: 2022/7/14 10:40
+# Update time:
+# ===================================
+
+"""`crud` 中函数的异步版本，供 `async def` 路由使用
+* 传入 `AsyncSession` 时，通过 `AsyncSession.run_sync` 在 aiosqlite 上执行，查询期间不阻塞事件循环
+* 传入同步 `Session` 时，放到线程池中执行
+* 两种方式执行的都是 `crud` 中同一份查询代码
+"""
+
+from datetime import date
+from functools import wraps
+from typing import AsyncIterator, Callable, Union
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from . import crud, rollups
+
+
+async def run(db: Union[Session, AsyncSession], func: Callable, *args, **kwargs):
+    """执行 `func(session, *args, **kwargs)`，session 为同步 Session"""
+    if isinstance(db, AsyncSession):
+        return await db.run_sync(func, *args, **kwargs)
+
+    return await run_in_threadpool(func, db, *args, **kwargs)
+
+
+def asyncify(func: Callable) -> Callable:
+    @wraps(func)
+    async def wrapper(db: Union[Session, AsyncSession], *args, **kwargs):
+        return await run(db, func, *args, **kwargs)
+
+    return wrapper
+
+
+commit = asyncify(Session.commit)
+rollback = asyncify(Session.rollback)
+
+get_city = asyncify(crud.get_city)
+get_city_by_name = asyncify(crud.get_city_by_name)
+get_cities = asyncify(crud.get_cities)
+get_cities_page = asyncify(crud.get_cities_page)
+create_city = asyncify(crud.create_city)
+get_data = asyncify(crud.get_data)
+get_data_page = asyncify(crud.get_data_page)
+create_city_data = asyncify(crud.create_city_data)
+
+get_nation_daily = asyncify(rollups.get_nation_daily)
+get_nation_weekly = asyncify(rollups.get_nation_weekly)
+get_province_weekly = asyncify(rollups.get_province_weekly)
+
+
+async def iter_export_partitions(
+    db: AsyncSession, city: str = None, start: date = None, end: date = None, size: int = crud.BULK_CHUNK_SIZE
+) -> AsyncIterator[list]:
+    """`crud.iter_export_partitions` 的异步版本，使用 `AsyncSession.stream` 逐批读取"""
+    result = await db.stream(crud.export_statement(city, start, end))
+
+    try:
+        async for partition in result.partitions(size):
+            yield partition
+    finally:
+        await result.close()
@@ -0,0 +1,133 @@
+# coding: utf8
+# ===================================
+# Author: yumingmin
+# File: cache.py
+# Cate: FastAPI
+# Create time: 2022/7/16 09:55
+# Update time:
+# ===================================
+
+"""进程内缓存
+* `TTLCache`：LRU + 过期时间，记录命中/未命中次数，线程安全(同步路由和 run_in_threadpool 都在线程池中执行)
+* `VersionedCache`：在 TTLCache 基础上对比数据库中的版本号，其他 worker 写入后，最多 `check_interval` 秒内本进程的缓存就会失效
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+from sqlalchemy.orm import Session
+
+from .config import settings
+from .versions import CITY, get_version
+
+MISSING = object()
+
+
+class TTLCache:
+    def __init__(self, maxsize: int = 1024, ttl: float = 300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._data.get(key, MISSING)
+
+            if item is not MISSING and item[0] > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return item[1]
+
+            if item is not MISSING:
+                del self._data[key]
+
+            self.misses += 1
+            return default
+
+    def set(self, key: Hashable, value: Any):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> dict:
+        return {"size": len(self), "hits": self.hits, "misses": self.misses, "hit_ratio": self.hit_ratio}
+
+
+class VersionedCache(TTLCache):
+    """缓存的数据与 `versions` 中名为 `name` 的版本号绑定"""
+
+    def __init__(self, name: str, maxsize: int = 1024, ttl: float = 300.0, check_interval: float = 1.0):
+        super().__init__(maxsize, ttl)
+        self.name = name
+        self.check_interval = check_interval
+        self._version = None
+        self._checked_at = float("-inf")
+
+    @property
+    def version_expired(self) -> bool:
+        """为 True 时下一次 `check_version` 会查询数据库"""
+        return time.monotonic() - self._checked_at >= self.check_interval
+
+    def check_version(self, db: Session):
+        """距离上次检查超过 `check_interval` 秒时读取一次版本号，版本变化则清空缓存"""
+        now = time.monotonic()
+
+        if now - self._checked_at < self.check_interval:
+            return
+
+        version = self.load_version(db)
+
+        if version != self._version:
+            self.clear()
+            self._version = version
+
+        self._checked_at = now
+
+    def load_version(self, db: Session):
+        return get_version(db, self.name)
+
+    def get_or_load(self, db: Session, key: Hashable, loader: Callable[[], Optional[Any]]) -> Optional[Any]:
+        """读穿(read-through)：未命中时调用 loader 从数据库加载，结果为 None 时不缓存"""
+        self.check_version(db)
+        value = self.get(key, MISSING)
+
+        if value is MISSING:
+            value = loader()
+
+            if value is not None:
+                self.set(key, value)
+
+        return value
+
+    def invalidate(self):
+        """本进程写入后调用：清空缓存，并在下次访问时重新读取版本号"""
+        self.clear()
+        self._checked_at = float("-inf")
+
+
+city_cache = VersionedCache(
+    CITY,
+    maxsize=settings.city_cache_size,
+    ttl=settings.city_cache_ttl,
+    check_interval=settings.cache_version_check_interval
+)
@@ -0,0 +1,85 @@
+# coding: utf8
+# ===================================
+# Author: yumingmin
+# File: config.py
+# Cate: FastAPI
+# Create time: 2022/7/14 10:12
+# Update time: 2022/7/16 10:05
+# ===================================
+
+"""coronavirus 应用的配置
+* 使用 pydantic 的 `BaseSettings`，每一项都可以通过 `CORONAVIRUS_` 前缀的环境变量覆盖，如 `CORONAVIRUS_DB_ASYNC=true`
+* `CORONAVIRUS_ENV=prod` 时默认关闭 SQL 日志(echo)，开发环境默认打开
+"""
+
+from typing import Optional
+
+from pydantic import BaseSettings
+
+
+class Settings(BaseSettings):
+    env: str = "dev"
+    database_url: str = "sqlite:///./coronavirus.sqlite3"
+    # 为 True 时路由使用 aiosqlite 驱动的 AsyncSession，否则使用同步 Session 并在线程池中执行
+    db_async: bool = False
+    # 不设置时跟随 env，开发环境为 True，生产环境为 False
+    db_echo: Optional[bool] = None
+
+    # 连接池
+    db_pool_size: int = 5
+    db_max_overflow: int = 10
+    db_pool_timeout: float = 30.0
+    db_pool_recycle: int = -1
+    # SQLAlchemy 编译后语句的缓存条数，0 表示关闭
+    db_statement_cache_size: int = 500
+
+    # SQLite PRAGMA，在每个新连接建立时设置
+    sqlite_journal_mode: str = "WAL"
+    sqlite_synchronous: str = "NORMAL"
+    sqlite_mmap_size: int = 256 * 1024 * 1024
+    # 负数表示 KiB，-65536 即 64MB 的页缓存
+    sqlite_cache_size: int = -65536
+    sqlite_busy_timeout: int = 5000
+
+    # 城市查询缓存：条数上限、过期时间(秒)；每隔 cache_version_check_interval 秒从数据库读一次版本号
+    city_cache_size: int = 1024
+    city_cache_ttl: float = 300.0
+    cache_version_check_interval: float = 1.0
+
+    # HTTP 响应缓存：条数上限(0 表示只做条件请求，不缓存响应体)、过期时间(秒)、单个响应体的大小上限(字节)
+    response_cache_size: int = 256
+    response_cache_ttl: float = 300.0
+    response_cache_max_body: int = 1024 * 1024
+
+    # 同步任务：是否在本进程启动 worker 线程、空闲时轮询任务表的间隔(秒)、
+    # 执行中的任务超过多少秒没有上报进度就认为 worker 已退出，重新排队(应大于一次全量同步的耗时)
+    sync_worker: bool = True
+    sync_poll_interval: float = 5.0
+    sync_job_stale_after: float = 600.0
+
+    # 分析模块的内存序列最多每隔多少秒检查一次数据库中的新数据
+    analytics_refresh_interval: float = 1.0
+
+    # SQL 分析：慢查询阈值(秒)、慢查询日志的采样比例、同一请求中同一语句执行多少次判定为疑似 N+1；
+    # sql_profile_debug 为 True 时响应头带上分析结果并开放 /debug/sql 接口，未设置时只在开发环境打开
+    sql_slow_query_threshold: float = 0.1
+    sql_slow_query_sample_rate: float = 1.0
+    sql_n_plus_one_threshold: int = 5
+    sql_profile_debug: Optional[bool] = None
+
+    # 同步数据接口每个客户端 IP 的限流，如 "6/minute"，为空时不限流
+    sync_rate_limit: str = "6/minute"
+
+    class Config:
+        env_prefix = "CORONAVIRUS_"
+
+    @property
+    def echo(self) -> bool:
+        return self.env == "dev" if self.db_echo is None else self.db_echo
+
+    @property
+    def profile_debug(self) -> bool:
+        return self.env == "dev" if self.sql_profile_debug is None else self.sql_profile_debug
+
+
+settings = Settings()
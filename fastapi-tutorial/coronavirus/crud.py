@@ -7,40 +7,302 @@
 # Update time: 
 # ===================================
 
+import base64
+import json
+import time
+from datetime import date
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from sqlalchemy import bindparam, func, insert, select, tuple_, update
 from sqlalchemy.orm import Session
-from . import models, schemas
+from . import models, rollups, schemas
+from .cache import city_cache
+from .http_cache import response_cache
+from .versions import CITY, DATA, bump_version
+
+# 批量写入时每个分块的行数，SQLite 单条语句的绑定参数有上限，分块后用 executemany 插入
+BULK_CHUNK_SIZE = 1000
+
 
+def _city_snapshot(city: Optional[models.City]) -> Optional[schemas.City]:
+    return schemas.City.from_orm(city) if city is not None else None
 
-def get_city(db: Session, city_id: int):
-    return db.query(models.City).filter(models.City.id == city_id).first()
 
+def get_city(db: Session, city_id: int) -> Optional[schemas.City]:
+    """城市数据很少变化，读取时经过进程内缓存，返回的是 `schemas.City` 快照而不是 ORM 对象"""
+    return city_cache.get_or_load(
+        db, ("id", city_id),
+        lambda: _city_snapshot(db.query(models.City).filter(models.City.id == city_id).first())
+    )
 
-def get_city_by_name(db: Session, name: str):
-    return db.query(models.City).filter(models.City.province == name).first()
+
+def get_city_by_name(db: Session, name: str) -> Optional[schemas.City]:
+    return city_cache.get_or_load(
+        db, ("province", name),
+        lambda: _city_snapshot(db.query(models.City).filter(models.City.province == name).first())
+    )
 
 
 def get_cities(db: Session, skip: int = 0, limit: int = 10):
-    return db.query(models.City).offset(skip).limit(limit).all()
+    """偏移分页，仅为兼容保留，页数越深扫描的行越多"""
+    return db.query(models.City).order_by(models.City.id).offset(skip).limit(limit).all()
+
+
+def _cities_page_query(db: Session, cursor: Optional[str] = None):
+    query = db.query(models.City).order_by(models.City.id)
+
+    if cursor:
+        (last_id,) = decode_cursor(cursor, CITY_CURSOR)
+        query = query.filter(models.City.id > last_id)
+
+    return query
+
+
+def get_cities_page(db: Session, cursor: Optional[str] = None, limit: int = 10):
+    """游标分页，按 `id` 排序，返回 (cities, next_cursor)"""
+    cities = _cities_page_query(db, cursor).limit(limit + 1).all()
+    return _page(cities, limit, lambda city: (city.id,))
 
 
 def create_city(db: Session, city: schemas.CreateCity):
     db_city = models.City(**city.dict())
     db.add(db_city)
+    bump_version(db, CITY, DATA)
     db.commit()
+    city_cache.invalidate()
+    response_cache.invalidate()
     db.refresh(db_city)
     return db_city
 
 
-def get_data(db: Session, city: str = None, skip: int = 0, limit: int = 10):
+# 页面展示用的扁平字段，与城市 JOIN 后一条查询取出，避免逐行懒加载 `Data.city` 造成的 N+1 查询
+DATA_ROW_COLUMNS = (
+    models.Data.id,
+    models.Data.city_id,
+    models.City.province,
+    models.Data.date,
+    models.Data.confirmed,
+    models.Data.deaths,
+    models.Data.recovered,
+    models.Data.update_at,
+)
+
+
+def _data_query(db: Session, city: str = None, rows: bool = False):
+    """`rows=True` 时查询 `DATA_ROW_COLUMNS` 投影，返回 Row 而不是 ORM 对象"""
+    query = db.query(*DATA_ROW_COLUMNS) if rows else db.query(models.Data)
+
+    if city or rows:
+        # 用 JOIN 代替 `Data.city.has(province=city)` 生成的 EXISTS 相关子查询
+        query = query.join(models.City, models.Data.city_id == models.City.id)
+
     if city:
-        return db.query(models.Data).filter(models.Data.city.has(province=city))
+        query = query.filter(models.City.province == city)
+
+    return query.order_by(models.Data.city_id, models.Data.date, models.Data.id)
+
+
+def get_data(db: Session, city: str = None, skip: int = 0, limit: int = 10, rows: bool = False):
+    """偏移分页，仅为兼容保留"""
+    return _data_query(db, city, rows).offset(skip).limit(limit).all()
+
+
+def _data_page_query(db: Session, city: str = None, cursor: Optional[str] = None, rows: bool = False):
+    query = _data_query(db, city, rows)
 
-    return db.query(models.Data).offset(skip).limit(limit).all()
+    if cursor:
+        city_id, day, last_id = decode_cursor(cursor, DATA_CURSOR)
+        key = tuple_(models.Data.city_id, models.Data.date, models.Data.id)
+        query = query.filter(key > tuple_(city_id, day, last_id))
+
+    return query
+
+
+def get_data_page(db: Session, city: str = None, cursor: Optional[str] = None, limit: int = 10, rows: bool = False):
+    """游标分页，按 `(city_id, date, id)` 排序，返回 (data, next_cursor)"""
+    data = _data_page_query(db, city, cursor, rows).limit(limit + 1).all()
+    return _page(data, limit, lambda row: (row.city_id, row.date.isoformat(), row.id))
+
+
+def export_statement(city: str = None, start: date = None, end: date = None):
+    """导出数据用的 Core 查询，字段同 `DATA_ROW_COLUMNS`，日期范围包含两端"""
+    stmt = select(*DATA_ROW_COLUMNS).join_from(models.Data, models.City, models.Data.city_id == models.City.id)
+
+    if city:
+        stmt = stmt.where(models.City.province == city)
+
+    if start:
+        stmt = stmt.where(models.Data.date >= start)
+
+    if end:
+        stmt = stmt.where(models.Data.date <= end)
+
+    return stmt.order_by(models.Data.city_id, models.Data.date, models.Data.id)
+
+
+def iter_export_partitions(db: Session, city: str = None, start: date = None, end: date = None, size: int = BULK_CHUNK_SIZE):
+    """服务端游标逐批读取，每次只在内存中保留 `size` 行"""
+    result = db.execute(export_statement(city, start, end).execution_options(stream_results=True))
+
+    try:
+        yield from result.partitions(size)
+    finally:
+        result.close()
 
 
 def create_city_data(db: Session, data: schemas.CreateData, city_id: int):
     db_data = models.Data(**data.dict(), city_id=city_id)
     db.add(db_data)
+    db.flush()
+    rollups.apply(db, added=[dict(data.dict(), city_id=city_id)])
+    bump_version(db, DATA)
     db.commit()
+    response_cache.invalidate()
     db.refresh(db_data)
     return db_data
+
+
+"""游标分页(Keyset Pagination)
+* `offset(skip)` 需要先扫描并丢弃前 skip 行，页数越深越慢
+* 游标分页记住上一页最后一行的排序键，下一页直接用 `WHERE (排序键) > (上一页最后的键)` 从索引定位，每页的代价与页数无关
+* 游标对客户端是不透明的字符串 (base64 编码的 JSON)，解码时逐个校验排序键的类型，日期以 ISO 格式的字符串保存
+"""
+
+# 各分页接口游标中排序键的类型
+CITY_CURSOR = (int,)
+DATA_CURSOR = (int, date, int)
+
+
+def encode_cursor(key: Tuple) -> str:
+    return base64.urlsafe_b64encode(json.dumps(key, separators=(",", ":")).encode()).decode().rstrip("=")
+
+
+def _cursor_value(value, kind: type):
+    # bool 是 int 的子类，需要排除
+    if kind is int and type(value) is int:
+        return value
+
+    if kind is date and isinstance(value, str):
+        return date.fromisoformat(value)
+
+    raise ValueError("Invalid cursor")
+
+
+def decode_cursor(cursor: str, types: Tuple[type, ...]) -> Tuple:
+    """按 `types` 校验并转换排序键，游标不合法时抛出 ValueError"""
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+
+    if not isinstance(key, list) or len(key) != len(types):
+        raise ValueError("Invalid cursor")
+
+    return tuple(_cursor_value(value, kind) for value, kind in zip(key, types))
+
+
+def _page(rows: list, limit: int, key) -> Tuple[list, Optional[str]]:
+    """查询时多取一行，用来判断是否还有下一页"""
+    if len(rows) <= limit:
+        return rows, None
+
+    rows = rows[:limit]
+    return rows, encode_cursor(key(rows[-1]))
+
+
+"""批量写入(Bulk Ingest)
+* 逐行调用 `create_city` / `create_city_data` 会为每一行单独 `commit()` + `refresh()`，同步大量数据时非常慢
+* 批量接口按分块校验数据，再用 `insert()` + 参数列表的方式 (executemany) 写入，整个过程只提交一次事务
+* 批量写入不回读 (refresh) 每一行，需要主键时再一次性查询
+"""
+
+
+def _chunked(rows: Iterable[dict], size: int) -> Iterator[List[dict]]:
+    iterator = iter(rows)
+
+    while True:
+        chunk = list(islice(iterator, size))
+
+        if not chunk:
+            return
+
+        yield chunk
+
+
+def bulk_create_cities(db: Session, cities: Iterable[dict], chunk_size: int = BULK_CHUNK_SIZE, commit: bool = True):
+    """批量写入城市，`cities` 中每一项的字段与 `schemas.CreateCity` 一致
+    `commit=False` 时由调用方提交事务，并在提交后调用 `city_cache.invalidate()` 和 `response_cache.invalidate()`
+    """
+    start = time.perf_counter()
+    rows = 0
+
+    for chunk in _chunked(cities, chunk_size):
+        values = [schemas.CreateCity(**city).dict() for city in chunk]
+        db.execute(insert(models.City), values)
+        rows += len(values)
+
+    if rows:
+        bump_version(db, CITY, DATA)
+
+    if commit:
+        db.commit()
+        city_cache.invalidate()
+        response_cache.invalidate()
+
+    return schemas.IngestStats(rows=rows, seconds=time.perf_counter() - start)
+
+
+def bulk_create_city_data(db: Session, data: Iterable[dict], chunk_size: int = BULK_CHUNK_SIZE, commit: bool = True):
+    """批量写入数据，`data` 中每一项为 `schemas.CreateData` 的字段加上 `city_id`"""
+    start = time.perf_counter()
+    rows = 0
+
+    for chunk in _chunked(data, chunk_size):
+        values = [dict(schemas.CreateData(**row).dict(), city_id=row["city_id"]) for row in chunk]
+        db.execute(insert(models.Data), values)
+        rollups.apply(db, added=values)
+        rows += len(values)
+
+    if rows:
+        bump_version(db, DATA)
+
+    if commit:
+        db.commit()
+        response_cache.invalidate()
+
+    return schemas.IngestStats(rows=rows, seconds=time.perf_counter() - start)
+
+
+def get_city_ids(db: Session) -> Dict[str, int]:
+    """一次性查询所有城市的主键，返回 {province: id}"""
+    return dict(db.query(models.City.province, models.City.id).all())
+
+
+def bulk_update_city_data(db: Session, changes: List[Tuple[dict, dict]], chunk_size: int = BULK_CHUNK_SIZE):
+    """批量修改数据，`changes` 中每一项为 (旧行, 新行)，旧行需要包含 `id`；不提交事务"""
+    start = time.perf_counter()
+    # 绑定参数不能与 SET 子句中的列同名
+    table = models.Data.__table__
+    stmt = (
+        update(table)
+        .where(table.c.id == bindparam("_id"))
+        .values(
+            confirmed=bindparam("_confirmed"),
+            deaths=bindparam("_deaths"),
+            recovered=bindparam("_recovered"),
+            update_at=func.now()
+        )
+    )
+
+    for chunk in _chunked(changes, chunk_size):
+        db.execute(stmt, [
+            {"_id": old["id"], "_confirmed": new["confirmed"], "_deaths": new["deaths"], "_recovered": new["recovered"]}
+            for old, new in chunk
+        ])
+        rollups.apply(db, added=[new for _, new in chunk], removed=[old for old, _ in chunk])
+
+    if changes:
+        bump_version(db, DATA)
+
+    return schemas.IngestStats(rows=len(changes), seconds=time.perf_counter() - start)
@@ -0,0 +1,45 @@
+# coding: utf8
+# ===================================
+# Author: yumingmin
+# File: export.py
+# Cate: FastAPI
+# Create time: 2022/7/17 15:20
+# Update time:
+# ===================================
+
+"""数据导出的编码：每批行编码成一段字节，交给 `StreamingResponse` 边查询边发送"""
+
+import csv
+import io
+import json
+from datetime import date, datetime
+from typing import Sequence
+
+# 导出的字段，与 `crud.DATA_ROW_COLUMNS` 的顺序一致
+FIELDS = ("id", "city_id", "province", "date", "confirmed", "deaths", "recovered", "update_at")
+
+MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv; charset=utf-8",
+}
+
+
+def _value(value):
+    return value.isoformat() if isinstance(value, (date, datetime)) else value
+
+
+def encode_ndjson(rows: Sequence) -> bytes:
+    lines = (
+        json.dumps(dict(zip(FIELDS, map(_value, row))), ensure_ascii=False, separators=(",", ":"))
+        for row in rows
+    )
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def encode_csv(rows: Sequence) -> bytes:
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows([_value(value) for value in row] for row in rows)
+    return buffer.getvalue().encode("utf-8")
+
+
+ENCODERS = {"ndjson": encode_ndjson, "csv": encode_csv}
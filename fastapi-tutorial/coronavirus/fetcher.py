@@ -0,0 +1,156 @@
+# coding: utf8
+# ===================================
+# Author: yumingmin
+# File: fetcher.py
+# Cate: FastAPI
+# Create time: 2022/7/12 20:15
+# Update time:
+# ===================================
+
+"""异步流式拉取上游 (JHU) 疫情数据
+* 使用 `httpx.AsyncClient` 复用连接，设置超时，请求失败时按指数退避重试
+* `locations` 数组边下载边解析，每解析出一个 location 就交给后续的写入步骤，不需要把整个 JSON 读入内存
+"""
+
+import asyncio
+import codecs
+import json
+import logging
+import re
+from typing import AsyncIterator, List, Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+JHU_URL = "https://coronavirus-tracker-api.herokuapp.com/v2/locations"
+
+
+class LocationsParser:
+    """增量解析 `{"latest": {...}, "locations": [{...}, {...}]}` 中的 `locations` 数组
+
+    每次 `feed()` 传入一段字节，返回这段数据里已经完整的 location 对象；已解析的部分会从缓冲区丢弃
+    """
+    _start = re.compile(r'"locations"\s*:\s*\[')
+
+    def __init__(self):
+        self._decoder = json.JSONDecoder()
+        self._text = codecs.getincrementaldecoder("utf-8")()
+        self._buffer = ""
+        self._started = False
+        self.done = False
+
+    def feed(self, chunk: bytes) -> List[dict]:
+        self._buffer += self._text.decode(chunk)
+        items = []
+
+        if not self._started:
+            match = self._start.search(self._buffer)
+
+            if match is None:
+                return items
+
+            self._buffer = self._buffer[match.end():]
+            self._started = True
+
+        pos = 0
+        length = len(self._buffer)
+
+        while not self.done:
+            while pos < length and self._buffer[pos] in " \t\r\n,":
+                pos += 1
+
+            if pos == length:
+                break
+
+            if self._buffer[pos] == "]":
+                self.done = True
+                pos += 1
+                break
+
+            try:
+                item, pos = self._decoder.raw_decode(self._buffer, pos)
+            except json.JSONDecodeError:
+                break  # 对象还不完整，等待下一段数据
+
+            items.append(item)
+
+        self._buffer = self._buffer[pos:]
+        return items
+
+    def close(self):
+        if not self.done:
+            raise ValueError("上游数据中的 locations 数组不完整")
+
+
+class JHUFetcher:
+    """复用同一个 `httpx.AsyncClient` 的上游数据拉取器，推荐用 `async with` 管理连接
+
+    :param url: 上游接口地址，测试时可以替换成本地的 HTTP 服务
+    :param retries: 失败后的最大重试次数
+    :param backoff: 第 n 次重试前等待 `backoff * 2 ** (n - 1)` 秒
+    """
+
+    def __init__(
+        self,
+        url: str = JHU_URL,
+        timeout: float = 30.0,
+        retries: int = 3,
+        backoff: float = 0.5,
+        chunk_size: int = 64 * 1024,
+        client: Optional[httpx.AsyncClient] = None
+    ):
+        self.url = url
+        self.retries = retries
+        self.backoff = backoff
+        self.chunk_size = chunk_size
+        self._client = client or httpx.AsyncClient(
+            timeout=httpx.Timeout(timeout, connect=10.0),
+            limits=httpx.Limits(max_keepalive_connections=2)
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def aclose(self):
+        await self._client.aclose()
+
+    async def locations(self, country_code: str = "CN", timelines: bool = True) -> AsyncIterator[dict]:
+        """逐个产出 location；如果下载中途断开，重试时会跳过已经产出过的部分"""
+        params = {"source": "jhu", "country_code": country_code, "timelines": str(timelines).lower()}
+        yielded = 0
+        attempt = 0
+
+        while True:
+            try:
+                parser = LocationsParser()
+                seen = 0
+
+                async with self._client.stream("GET", self.url, params=params) as response:
+                    response.raise_for_status()
+
+                    async for chunk in response.aiter_bytes(self.chunk_size):
+                        for location in parser.feed(chunk):
+                            seen += 1
+
+                            if seen > yielded:
+                                yielded += 1
+                                yield location
+
+                parser.close()
+                return
+            except (httpx.TransportError, httpx.HTTPStatusError, ValueError) as exc:
+                if isinstance(exc, httpx.HTTPStatusError) and exc.response.status_code < 500:
+                    raise
+
+                attempt += 1
+
+                if attempt > self.retries:
+                    raise
+
+                delay = self.backoff * 2 ** (attempt - 1)
+                logger.warning("拉取 %s 失败(%s)，%.1fs 后第 %d 次重试", self.url, exc, delay, attempt)
+                await asyncio.sleep(delay)
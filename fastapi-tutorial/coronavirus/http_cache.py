@@ -0,0 +1,155 @@
+# coding: utf8
+# ===================================
+# Author: yumingmin
+# File: http_cache.py
+# Cate: FastAPI
+# Create time: 2022/7/22 09:40
+# Update time:
+# ===================================
+
+"""HTTP 条件请求(ETag / Last-Modified)与响应缓存
+* 读接口的响应只由 (路由, 查询参数, `data` 版本号) 决定，ETag 由这三者计算，是强校验器(strong validator)
+* 版本号由 `response_cache` 在进程内保存，最多每 `cache_version_check_interval` 秒读一次数据库，
+  客户端带 `If-None-Match` / `If-Modified-Since` 且数据没有变化时直接返回 304，不执行任何查询
+* `response_cache` 同时缓存序列化后的响应体，键为 (路由, 查询参数, 版本号)，版本号变化时整体失效
+* 用法：路由器使用 `ConditionalRoute`，需要缓存的 GET 路由加上调用 `precondition` 的依赖
+"""
+
+import hashlib
+from datetime import timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Callable, Dict, NamedTuple, Optional
+
+from fastapi.routing import APIRoute
+from sqlalchemy.orm import Session
+from starlette.requests import Request
+from starlette.responses import Response
+
+from .cache import VersionedCache
+from .config import settings
+from .versions import DATA, get_version_info
+
+
+class Validators(NamedTuple):
+    key: tuple
+    etag: str
+    last_modified: Optional[str]
+
+    @property
+    def headers(self) -> Dict[str, str]:
+        headers = {"ETag": self.etag, "Cache-Control": "no-cache"}
+
+        if self.last_modified:
+            headers["Last-Modified"] = self.last_modified
+
+        return headers
+
+
+class ShortCircuit(Exception):
+    """由 `precondition` 抛出，`ConditionalRoute` 捕获后直接返回 `response`，不再执行路由函数"""
+
+    def __init__(self, response: Response):
+        self.response = response
+
+
+class ResponseCache(VersionedCache):
+    """版本号为 (value, update_at)，同时用于计算 ETag 和 Last-Modified"""
+
+    def load_version(self, db: Session):
+        return get_version_info(db, self.name)
+
+    def validators(self, request: Request) -> Validators:
+        value, modified = self._version
+        params = tuple(sorted(request.query_params.multi_items()))
+        key = (request.url.path, params, value)
+        etag = '"%s"' % hashlib.sha1(repr(key).encode()).hexdigest()
+        last_modified = format_datetime(modified.replace(tzinfo=timezone.utc), usegmt=True) if modified else None
+        return Validators(key, etag, last_modified)
+
+    def store(self, key: tuple, response: Response):
+        if self.maxsize and len(response.body) <= settings.response_cache_max_body:
+            self.set(key, (response.body, list(response.raw_headers)))
+
+    def load(self, key: tuple) -> Optional[Response]:
+        item = self.get(key)
+
+        if item is None:
+            return None
+
+        response = Response(item[0])
+        response.raw_headers = list(item[1])
+        return response
+
+
+def not_modified(request: Request, validators: Validators) -> bool:
+    """`If-None-Match` 优先；没有时才比较 `If-Modified-Since`"""
+    if_none_match = request.headers.get("if-none-match")
+
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        # If-None-Match 使用弱比较，忽略 W/ 前缀
+        return "*" in tags or validators.etag in (tag[2:] if tag.startswith("W/") else tag for tag in tags)
+
+    if_modified_since = request.headers.get("if-modified-since")
+
+    if if_modified_since is None or validators.last_modified is None:
+        return False
+
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+
+    return parsedate_to_datetime(validators.last_modified) <= since
+
+
+def precondition(request: Request):
+    """在路由函数之前执行：记录校验器；可以返回 304 或命中响应缓存时抛出 `ShortCircuit`
+
+    调用前需要先通过 `response_cache.check_version(db)` 确保版本号已加载
+    """
+    validators = response_cache.validators(request)
+    request.state.http_cache = validators
+
+    if not_modified(request, validators):
+        raise ShortCircuit(Response(status_code=304, headers=validators.headers))
+
+    cached = response_cache.load(validators.key)
+
+    if cached is not None:
+        raise ShortCircuit(cached)
+
+
+class ConditionalRoute(APIRoute):
+    """为经过 `precondition` 的 GET 路由加上 ETag / Last-Modified，并缓存 200 响应的响应体；其他路由不受影响"""
+
+    def get_route_handler(self) -> Callable:
+        handler = super().get_route_handler()
+
+        async def route_handler(request: Request) -> Response:
+            try:
+                response = await handler(request)
+            except ShortCircuit as exc:
+                return exc.response
+
+            validators = getattr(request.state, "http_cache", None)
+
+            # 流式响应没有 body，不缓存
+            if validators is not None and response.status_code == 200 and hasattr(response, "body"):
+                response.headers.update(validators.headers)
+                response_cache.store(validators.key, response)
+
+            return response
+
+        return route_handler
+
+
+response_cache = ResponseCache(
+    DATA,
+    maxsize=settings.response_cache_size,
+    ttl=settings.response_cache_ttl,
+    check_interval=settings.cache_version_check_interval
+)
@@ -0,0 +1,269 @@
+# coding: utf8
+# ===================================
+# Author: yumingmin
+# File: jobs.py
+# Cate: FastAPI
+# Create time: 2022/7/20 14:40
+# Update time:
+# ===================================
+
+"""持久化的同步任务队列
+* 同步请求只在 `sync_job` 表中登记一个任务，由专门的 `SyncWorker` 线程领取执行，每个任务使用自己的 session
+* 合并重复请求：同一数据源已有排队中的任务时直接返回它，不会重复同步
+* 领取任务是一条带状态条件的 UPDATE，配合 (source, status) 上的部分唯一索引，多个进程的 worker 同时领取时只有一个成功
+* 执行中的任务超过 `sync_job_stale_after` 秒没有上报进度，说明 worker 已经退出(进程重启、崩溃)，任务会被重新排队
+* 进度和心跳用单独的 session 写入并立即提交，全量同步的长事务不影响其他 worker 和 `/sync_jobs/{id}` 看到最新进度。
+  SQLite 同一时间只允许一个写事务，全量同步提交之前心跳无法写入，使用 SQLite 时 `sync_job_stale_after` 应大于全量同步的耗时
+"""
+
+import asyncio
+import logging
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Optional, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm import Session
+
+from core.profiler import profiler
+
+from . import analytics, metrics, models, schemas
+from .config import settings
+from .database import SessionLocal
+from .sync import SYNC_BATCH_SIZE, bg_task
+
+logger = logging.getLogger(__name__)
+
+JHU = "jhu"
+
+QUEUED = schemas.SyncJobStatus.queued.value
+RUNNING = schemas.SyncJobStatus.running.value
+SUCCEEDED = schemas.SyncJobStatus.succeeded.value
+FAILED = schemas.SyncJobStatus.failed.value
+
+# 写入进度时等待 SQLite 写锁的毫秒数，拿不到锁就跳过这一次上报
+PROGRESS_LOCK_TIMEOUT = 50
+
+
+def utcnow() -> datetime:
+    return datetime.utcnow()
+
+
+def get_job(db: Session, job_id: int) -> Optional[schemas.SyncJob]:
+    job = db.query(models.SyncJob).get(job_id)
+    return schemas.SyncJob.from_orm(job) if job is not None else None
+
+
+def enqueue(
+    db: Session, url: str, mode: schemas.SyncMode = schemas.SyncMode.incremental, source: str = JHU
+) -> Tuple[schemas.SyncJob, bool]:
+    """登记一个同步任务并提交，返回 (任务, 是否新建)
+
+    已有排队中的任务时合并到该任务；请求全量同步而排队中的是增量同步时，把它升级为全量同步
+    """
+    for _ in range(3):
+        job = db.query(models.SyncJob).filter(models.SyncJob.source == source, models.SyncJob.status == QUEUED).first()
+
+        if job is not None:
+            if mode == schemas.SyncMode.full and job.mode != mode.value:
+                job.mode = mode.value
+                db.commit()
+
+            return schemas.SyncJob.from_orm(job), False
+
+        job = models.SyncJob(source=source, url=url, mode=mode.value, status=QUEUED, created_at=utcnow())
+        db.add(job)
+
+        try:
+            db.commit()
+        except IntegrityError:
+            db.rollback()  # 其他请求同时登记了排队中的任务，重新读取后合并
+            continue
+
+        return schemas.SyncJob.from_orm(job), True
+
+    raise RuntimeError(f"无法登记 {source} 同步任务")
+
+
+def claim(db: Session, worker: str) -> Optional[models.SyncJob]:
+    """按登记顺序领取一个排队中的任务；同一数据源已有执行中的任务时跳过"""
+    queued = db.query(models.SyncJob.id).filter(models.SyncJob.status == QUEUED).order_by(models.SyncJob.id).all()
+
+    for job_id, in queued:
+        now = utcnow()
+
+        try:
+            claimed = db.query(models.SyncJob).filter(
+                models.SyncJob.id == job_id, models.SyncJob.status == QUEUED
+            ).update(
+                {"status": RUNNING, "worker": worker, "started_at": now, "heartbeat_at": now},
+                synchronize_session=False
+            )
+            db.commit()
+        except IntegrityError:
+            db.rollback()
+            continue
+
+        if claimed:
+            return db.query(models.SyncJob).get(job_id)
+
+    return None
+
+
+def requeue_stale(db: Session, stale_after: float = settings.sync_job_stale_after) -> int:
+    """把超过 `stale_after` 秒没有上报进度的执行中任务重新排队，返回处理的任务数
+
+    同一数据源已经有排队中的任务时，重新排队的结果和它重复，直接标记为失败
+    """
+    deadline = utcnow() - timedelta(seconds=stale_after)
+    stale = db.query(models.SyncJob).filter(
+        models.SyncJob.status == RUNNING, models.SyncJob.heartbeat_at < deadline
+    ).all()
+
+    for job in stale:
+        logger.warning("同步任务 %r 的 worker %s 已失联，重新排队", job, job.worker)
+        job.status, job.worker, job.started_at, job.heartbeat_at = QUEUED, None, None, None
+        job.locations = job.rows = job.skipped = 0
+
+        try:
+            db.commit()
+        except IntegrityError:
+            db.rollback()
+            job.status, job.finished_at, job.error = FAILED, utcnow(), "worker 失联，已合并到排队中的任务"
+            db.commit()
+
+    return len(stale)
+
+
+def report(job_id: int, session_factory: Callable[[], Session] = SessionLocal) -> Callable:
+    """生成 `bg_task` 的进度回调，每次上报用 `session_factory` 新建 session 写入进度和心跳并立即提交
+
+    上报是尽力而为的：写锁被占用时(如 SQLite 上全量同步的事务还没提交)最多等待 `PROGRESS_LOCK_TIMEOUT` 毫秒，
+    仍然拿不到就跳过，不拖慢同步本身
+    """
+    def progress(stats: schemas.IngestStats, locations: int):
+        with session_factory() as db:
+            sqlite = db.get_bind().dialect.name == "sqlite"
+
+            if sqlite:
+                busy_timeout = db.execute(text("PRAGMA busy_timeout")).scalar()
+                db.execute(text(f"PRAGMA busy_timeout = {PROGRESS_LOCK_TIMEOUT}"))
+
+            try:
+                try:
+                    values = {"locations": locations, "rows": stats.rows, "skipped": stats.skipped, "heartbeat_at": utcnow()}
+                    db.query(models.SyncJob).filter(models.SyncJob.id == job_id).update(values, synchronize_session=False)
+                finally:
+                    # 提交或回滚后连接会还给连接池，要在这之前恢复
+                    if sqlite:
+                        db.execute(text(f"PRAGMA busy_timeout = {busy_timeout}"))
+
+                db.commit()
+            except OperationalError as exc:
+                db.rollback()
+                logger.debug("同步任务 #%d 的进度暂时无法写入: %s", job_id, exc)
+
+    return progress
+
+
+def finish(db: Session, job_id: int, status: str, stats: schemas.IngestStats = None, error: str = None):
+    values = {"status": status, "finished_at": utcnow(), "heartbeat_at": utcnow(), "error": error}
+
+    if stats is not None:
+        values.update(rows=stats.rows, skipped=stats.skipped)
+
+    db.query(models.SyncJob).filter(models.SyncJob.id == job_id).update(values, synchronize_session=False)
+    db.commit()
+
+
+class SyncWorker:
+    """专用的同步线程，循环执行 `run_once`；没有任务时等待 `poll_interval` 秒，或被 `notify` 唤醒
+
+    :param session_factory: 每次领取和执行任务都新建 session，不使用请求中的 session
+    """
+
+    def __init__(
+        self,
+        session_factory: Callable[[], Session] = SessionLocal,
+        poll_interval: float = settings.sync_poll_interval,
+        stale_after: float = settings.sync_job_stale_after,
+        batch_size: int = SYNC_BATCH_SIZE
+    ):
+        self.session_factory = session_factory
+        self.poll_interval = poll_interval
+        self.stale_after = stale_after
+        self.batch_size = batch_size
+        self.name = f"{socket.gethostname()}:{os.getpid()}"
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._loop, name="sync-worker", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = None):
+        """等待正在执行的任务结束后退出"""
+        if self._thread is None:
+            return
+
+        self._stopping.set()
+        self._wake.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def notify(self):
+        """有新任务时唤醒 worker，不必等到下一次轮询"""
+        self._wake.set()
+
+    def _loop(self):
+        while not self._stopping.is_set():
+            try:
+                job = self.run_once()
+            except Exception:
+                logger.exception("同步 worker 执行出错")
+                job = None
+
+            if job is None:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+
+    def run_once(self) -> Optional[schemas.SyncJob]:
+        """领取并执行一个任务，返回执行后的任务；没有可执行的任务时返回 None"""
+        with self.session_factory() as db:
+            requeue_stale(db, self.stale_after)
+            job = claim(db, self.name)
+
+            if job is None:
+                return None
+
+            job_id, source, url, mode = job.id, job.source, job.url, schemas.SyncMode(job.mode)
+
+        with self.session_factory() as db:
+            start = time.perf_counter()
+
+            try:
+                # 同步任务不在请求中，单独统计 SQL，重复执行的语句同样会报告疑似 N+1
+                with profiler.profile(f"sync_job:{job_id}"):
+                    progress = report(job_id, self.session_factory)
+                    stats = asyncio.run(bg_task(url, db, self.batch_size, mode, progress=progress))
+            except Exception as exc:
+                logger.exception("同步任务 #%d 失败", job_id)
+                finish(db, job_id, FAILED, error=repr(exc))
+                metrics.observe_sync_job(source, mode.value, FAILED, time.perf_counter() - start, 0)
+            else:
+                finish(db, job_id, SUCCEEDED, stats)
+                metrics.observe_sync_job(source, mode.value, SUCCEEDED, time.perf_counter() - start, stats.rows)
+
+                if analytics.store.loaded:
+                    analytics.store.refresh(db)  # 只读取本次同步新增和修改的省份
+
+            return get_job(db, job_id)
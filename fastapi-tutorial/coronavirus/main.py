@@ -7,23 +7,34 @@
 # Update time: 
 # ===================================
 
-import requests
+from datetime import date
 from typing import List
-from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks, Request, status
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, status
+from fastapi.responses import StreamingResponse
 from fastapi.templating import Jinja2Templates
-from pydantic import HttpUrl
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
-from . import crud, schemas
-from .database import engine, Base, SessionLocal
-from .models import City, Data
+from core.ratelimit import Rate, RateLimiter
+from core.responses import FastJSONResponse
+from core.timing import phase
 
-application = APIRouter()
+from . import analytics, async_crud, crud, export, http_cache, jobs, migrations, models, schemas, serializers
+from .config import settings
+from .database import engine, async_engine, SessionLocal, AsyncSessionLocal
+from .fetcher import JHU_URL
+
+# 游标分页时，下一页的游标通过响应头返回，没有下一页时不返回
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+application = APIRouter(route_class=http_cache.ConditionalRoute)
 template = Jinja2Templates(directory="./templates")
-Base.metadata.create_all(bind=engine)
+migrations.upgrade(engine)
+sync_worker = jobs.SyncWorker()
 
 
-def get_db():
+def get_sync_db():
     db = SessionLocal()
 
     try:
@@ -32,9 +43,67 @@ def get_db():
         db.close()
 
 
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+@application.on_event("startup")
+def start_sync_worker():
+    """每个进程各启动一个同步 worker 线程，多个 worker 之间通过任务表协调"""
+    if settings.sync_worker:
+        sync_worker.start()
+
+
+@application.on_event("shutdown")
+def stop_sync_worker():
+    sync_worker.stop()
+
+
+@application.on_event("shutdown")
+async def dispose_engines():
+    """关闭连接池，aiosqlite 的每个连接都有一个后台线程，不关闭时进程无法退出"""
+    engine.dispose()
+
+    if async_engine is not None:
+        await async_engine.dispose()
+
+
+# 在配置阶段决定路由使用异步还是同步的 session，路由中统一通过 `async_crud` 访问数据库
+get_db = get_async_db if settings.db_async else get_sync_db
+
+
+async def conditional_get(request: Request, db: Session = Depends(get_db)):
+    """读接口的条件请求：数据版本没有变化时直接返回 304 或缓存的响应体，不执行路由函数"""
+    if http_cache.response_cache.version_expired:
+        await async_crud.run(db, http_cache.response_cache.check_version)
+
+    http_cache.precondition(request)
+
+
+# 加在只读的 GET 路由上，响应带 ETag / Last-Modified
+conditional = [Depends(conditional_get)]
+
+
+def check_cursor(cursor: str, types):
+    """在查询之前校验游标，无效时返回 400；查询和序列化中的错误仍然是 500"""
+    if not cursor:
+        return
+
+    try:
+        crud.decode_cursor(cursor, types)
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+
+def cursor_headers(next_cursor: str = None):
+    """下一页的游标通过响应头返回，没有下一页时不返回"""
+    return {NEXT_CURSOR_HEADER: next_cursor} if next_cursor else None
+
+
 @application.post("/create_city", response_model=schemas.ReadCity)
 async def create_city(city: schemas.CreateCity, db: Session = Depends(get_db)):
-    db_city = crud.get_city_by_name(db, name=city.province)
+    db_city = await async_crud.get_city_by_name(db, name=city.province)
 
     if db_city:
         raise HTTPException(
@@ -42,12 +111,12 @@ async def create_city(city: schemas.CreateCity, db: Session = Depends(get_db)):
             detail="City already registered!"
         )
 
-    return crud.create_city(db=db, city=city)
+    return await async_crud.create_city(db, city=city)
 
 
-@application.get("/get_city/{city}", response_model=schemas.ReadCity)
+@application.get("/get_city/{city}", response_model=schemas.ReadCity, dependencies=conditional)
 async def get_city(city: str, db: Session = Depends(get_db)):
-    db_city = crud.get_city_by_name(db, name=city)
+    db_city = await async_crud.get_city_by_name(db, name=city)
 
     if db_city is None:
         raise HTTPException(status_code=404, detail="City not found")
@@ -55,77 +124,189 @@ async def get_city(city: str, db: Session = Depends(get_db)):
     return db_city
 
 
-@application.get("/get_cities", response_model=List[schemas.ReadCity])
-async def get_cities(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    cities = crud.get_cities(db, skip=skip, limit=limit)
-    return cities
+@application.get("/get_cities", response_model=List[schemas.ReadCity], dependencies=conditional)
+async def get_cities(
+    cursor: str = None,
+    skip: int = Query(None, ge=0, description="偏移分页(兼容模式)，传入 skip 时忽略 cursor"),
+    limit: int = Query(100, ge=1),
+    db: Session = Depends(get_db)
+):
+    """默认使用游标分页，下一页的游标在 `X-Next-Cursor` 响应头中"""
+    if skip is not None:
+        cities, next_cursor = await async_crud.get_cities(db, skip=skip, limit=limit), None
+    else:
+        check_cursor(cursor, crud.CITY_CURSOR)
+        cities, next_cursor = await async_crud.get_cities_page(db, cursor=cursor, limit=limit)
+
+    return serializers.json_response(schemas.ReadCity, cities, models.City, cursor_headers(next_cursor))
 
 
 @application.post("/create_data", response_model=schemas.ReadData)
 async def create_data_for_city(city: str, data: schemas.CreateData, db: Session = Depends(get_db)):
-    db_city = crud.get_city_by_name(db, name=city)
-    data = crud.create_city_data(db, data, city_id=db_city.id)
+    db_city = await async_crud.get_city_by_name(db, name=city)
+    data = await async_crud.create_city_data(db, data, city_id=db_city.id)
     return data
 
 
-@application.get("/get_data")
-def get_data(city: str = None, skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    data = crud.get_data(db, city, skip, limit)
-    return data
+@application.get("/get_data", response_model=List[schemas.Data], dependencies=conditional)
+async def get_data(
+    city: str = None,
+    cursor: str = None,
+    skip: int = Query(None, ge=0, description="偏移分页(兼容模式)，传入 skip 时忽略 cursor"),
+    limit: int = Query(100, ge=1),
+    db: Session = Depends(get_db)
+):
+    """默认使用游标分页，下一页的游标在 `X-Next-Cursor` 响应头中"""
+    if skip is not None:
+        data, next_cursor = await async_crud.get_data(db, city, skip, limit), None
+    else:
+        check_cursor(cursor, crud.DATA_CURSOR)
+        data, next_cursor = await async_crud.get_data_page(db, city=city, cursor=cursor, limit=limit)
+
+    return serializers.json_response(schemas.Data, data, models.Data, cursor_headers(next_cursor))
+
+
+@application.get("/rollups/nation/daily", response_model=List[schemas.NationTotal], dependencies=conditional)
+async def get_nation_daily(start: date = None, end: date = None, db: Session = Depends(get_db)):
+    """全国每天的累计数，从汇总表读取"""
+    rows = await async_crud.get_nation_daily(db, start, end)
+    return serializers.json_response(schemas.NationTotal, rows, models.NationDaily)
+
+
+@application.get("/rollups/nation/weekly", response_model=List[schemas.NationTotal], dependencies=conditional)
+async def get_nation_weekly(start: date = None, end: date = None, db: Session = Depends(get_db)):
+    """全国每周最后一天的累计数，`date` 为所在周的周一"""
+    return await async_crud.get_nation_weekly(db, start, end)
+
+
+@application.get("/rollups/provinces/weekly", response_model=List[schemas.ProvinceWeekly], dependencies=conditional)
+async def get_province_weekly(city: str = None, start: date = None, end: date = None, db: Session = Depends(get_db)):
+    """各省份每周最后一天的累计数"""
+    city_id = None
+
+    if city:
+        db_city = await async_crud.get_city_by_name(db, name=city)
+
+        if db_city is None:
+            raise HTTPException(status_code=404, detail="City not found")
+
+        city_id = db_city.id
+
+    rows = await async_crud.get_province_weekly(db, city_id, start, end)
+    return serializers.json_response(schemas.ProvinceWeekly, rows, models.ProvinceWeekly)
+
+
+@application.get("/analytics/{indicator}", response_model=schemas.AnalyticsSeries, dependencies=conditional)
+async def get_analytics(
+    indicator: schemas.Indicator,
+    metric: schemas.Metric = schemas.Metric.confirmed,
+    window: int = Query(7, ge=1, le=90),
+    city: str = None,
+    start: date = None,
+    end: date = None,
+    db: Session = Depends(get_db)
+):
+    """所有省份(或指定省份)的每日新增、新增的移动平均、日均增长率、翻倍天数，基于内存中的 NumPy 序列计算"""
+    snapshot = await async_crud.run(db, analytics.store.snapshot)
+    result = await run_in_threadpool(analytics.compute, snapshot, indicator, metric, window, city, start, end)
+
+    if result is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="City not found")
+
+    # 结果由 NumPy 数组直接生成，不再逐个元素校验
+    return FastJSONResponse(result)
+
+
+@application.get("/export")
+async def export_data(
+    fmt: schemas.ExportFormat = Query(schemas.ExportFormat.ndjson, alias="format"),
+    city: str = None,
+    start: date = None,
+    end: date = None,
+    db: Session = Depends(get_db)
+):
+    """以 NDJSON 或 CSV 流式导出数据
+    * 数据库端逐批读取，每批编码后立即发送，内存占用与导出的总行数无关
+    * `start` / `end` 为日期范围，包含两端
+    """
+    encode = export.ENCODERS[fmt]
+
+    if isinstance(db, AsyncSession):
+        async def body():
+            if fmt == schemas.ExportFormat.csv:
+                yield export.encode_csv([export.FIELDS])
+
+            async for partition in async_crud.iter_export_partitions(db, city, start, end):
+                yield encode(partition)
+    else:
+        # 同步生成器由 StreamingResponse 放到线程池中迭代
+        def body():
+            if fmt == schemas.ExportFormat.csv:
+                yield export.encode_csv([export.FIELDS])
 
+            for partition in crud.iter_export_partitions(db, city, start, end):
+                yield encode(partition)
 
-def bg_task(url: HttpUrl, db: Session):
-    """这里注意一个坑，不要在后台任务的参数中 db: Session = Depends(get_db) 这样导入依赖"""
-    city_data = requests.get(url=f"{url}?source=jhu&country_code=CN&timelines=false")
+    return StreamingResponse(
+        body(),
+        media_type=export.MEDIA_TYPES[fmt],
+        headers={"Content-Disposition": f'attachment; filename="coronavirus.{fmt.value}"'}
+    )
 
-    if 200 == city_data.status_code:
-        db.query(City).delete()  # 同步数据前先清空原有数据
 
-        for location in city_data.json()["locations"]:
-            city = {
-                "province": location["province"],
-                "country": location["country"],
-                "country_code": "CN",
-                "country_population": location["country_population"]
-            }
-            crud.create_city(db, city=schemas.CreateCity(**city))
+# 同步任务会请求远程接口并写入大量数据，按客户端 IP 限流
+sync_limiter = RateLimiter("coronavirus_sync", Rate.parse(settings.sync_rate_limit))
 
-    coronavirus_data = requests.get(url=f"{url}?source=jhu&country_code=CN&timelines=true")
 
-    if 200 == coronavirus_data.status_code:
-        db.query(Data).delete()
+@application.get(
+    "/sync_coronavirus_data/jhu", response_model=schemas.SyncJobAccepted, status_code=status.HTTP_202_ACCEPTED,
+    dependencies=[Depends(sync_limiter)]
+)
+async def sync_coronavirus_data(mode: schemas.SyncMode = schemas.SyncMode.incremental, db: Session = Depends(get_db)):
+    """从 Johns Hopkins University 同步 COVID-19 数据，默认增量同步，`mode=full` 时清空后全量同步
+    * 只登记同步任务，由后台 worker 执行；已有排队中的任务时合并，返回同一个 job_id
+    * 通过 /sync_jobs/{job_id} 查询进度
+    """
+    job, created = await async_crud.run(db, jobs.enqueue, JHU_URL, mode)
+    sync_worker.notify()
+    message = "正在后台同步数据..." if created else "已有排队中的同步任务，请稍候..."
+    return {"message": message, "job_id": job.id}
 
-        for city in coronavirus_data.json()["locations"]:
-            db_city = crud.get_city_by_name(db, name=city["province"])
 
-            for date, confirmed in city["timelines"]["confirmed"]["timeline"].items():
-                data = {
-                    "date": date.split("T")[0],
-                    "confirmed": confirmed,
-                    "deaths": city["timelines"]["deaths"]["timeline"][date],
-                    "recovered": 0
-                }
-                crud.create_city_data(db, data=schemas.CreateData(**data), city_id=db_city.id)
+@application.get("/sync_jobs/{job_id}", response_model=schemas.SyncJob)
+async def get_sync_job(job_id: int, db: Session = Depends(get_db)):
+    job = await async_crud.run(db, jobs.get_job, job_id)
 
+    if job is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Sync job not found")
 
-@application.get("/sync_coronavirus_data/jhu")
-async def sync_coronavirus_data(background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
-    """从 Johns Hopkins University 同步 COVID-19 数据"""
-    background_tasks.add_task(bg_task, "https://coronavirus-tracker-api.herokuapp.com/v2/locations", db)
-    return {"message": "正在后台同步数据..."}
+    return job
 
 
-@application.get("/")
+@application.get("/", dependencies=conditional)
 async def coronavirus(
     request: Request,
     city: str = None,
-    skip: int = 0,
-    limit: int = 100,
+    cursor: str = None,
+    skip: int = Query(None, ge=0),
+    limit: int = Query(100, ge=1),
     db: Session = Depends(get_db)
 ):
-    data = crud.get_data(db, city, skip, limit)
-    return template.TemplateResponse("home.html", {
-        "request": request,
-        "data": data,
-        "sync_data_url": "/coronavirus/sync_coronavirus_data/jhu"
-    })
+    next_cursor = None
+
+    # 查询扁平的投影 (rows=True)，模板中不会再触发 `Data.city` 的懒加载
+    if skip is not None:
+        data = await async_crud.get_data(db, city, skip, limit, rows=True)
+    else:
+        check_cursor(cursor, crud.DATA_CURSOR)
+        data, next_cursor = await async_crud.get_data_page(db, city=city, cursor=cursor, limit=limit, rows=True)
+
+    # 模板渲染的耗时记入 Server-Timing 的 render 阶段
+    with phase("render"):
+        return template.TemplateResponse("home.html", {
+            "request": request,
+            "data": data,
+            "city": city,
+            "next_cursor": next_cursor,
+            "sync_data_url": "/coronavirus/sync_coronavirus_data/jhu"
+        }, headers=cursor_headers(next_cursor))
@@ -0,0 +1,124 @@
+# coding: utf8
+# ===================================
+# Author: yumingmin
+# File: metrics.py
+# Cate: FastAPI
+# Create time: 2022/7/25 10:40
+# Update time:
+# ===================================
+
+"""新冠病毒追踪器的监控指标，注册到 `core.metrics.REGISTRY`
+* 连接池：签出次数、新建连接数、等待连接的耗时和超时次数(计数器)，以及导出时读取的池大小、已签出、溢出连接数(Gauge)
+* 同步任务：每个任务的耗时(按数据源、模式、结果)和写入的行数
+* 缓存：城市缓存和响应缓存的命中、未命中次数，命中率由合并后的计数器计算
+"""
+
+from time import perf_counter_ns
+from typing import Dict, Iterator
+
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+from core.metrics import REGISTRY, Counter, Family, Histogram
+
+from .cache import city_cache
+from .http_cache import response_cache
+
+POOL_CHECKOUTS = Counter("db_pool_checkouts_total", "从连接池签出连接的次数", ("pool",))
+POOL_CONNECTS = Counter("db_pool_connects_total", "连接池新建数据库连接的次数", ("pool",))
+POOL_WAIT = Histogram(
+    "db_pool_wait_seconds", "从连接池获取连接的等待时间(秒)", ("pool",),
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0)
+)
+POOL_TIMEOUTS = Counter("db_pool_timeouts_total", "等待连接超过 pool_timeout 的次数", ("pool",))
+
+SYNC_JOB_DURATION = Histogram(
+    "sync_job_duration_seconds", "同步任务的执行时间(秒)", ("source", "mode", "status"),
+    buckets=(1.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0)
+)
+SYNC_JOB_ROWS = Counter("sync_job_rows_total", "同步任务写入的数据行数", ("source",))
+
+CACHES = {"city": city_cache, "response": response_cache}
+
+_pools: Dict[str, object] = {}
+
+
+def instrument_pool(engine, name: str = "default"):
+    """在引擎的连接池上注册事件；等待时间通过包装连接池的 `_do_get` 测量(签出前没有可用的事件)"""
+    if name in _pools:
+        return
+
+    pool = getattr(engine, "sync_engine", engine).pool
+    _pools[name] = pool
+    checkouts, connects = POOL_CHECKOUTS.labels(name), POOL_CONNECTS.labels(name)
+    wait, timeouts = POOL_WAIT.labels(name), POOL_TIMEOUTS.labels(name)
+
+    event.listen(pool, "checkout", lambda *args: checkouts.inc())
+    event.listen(pool, "connect", lambda *args: connects.inc())
+    do_get = pool._do_get
+
+    def timed_do_get():
+        start = perf_counter_ns()
+
+        try:
+            return do_get()
+        except PoolTimeoutError:
+            timeouts.inc()
+            raise
+        finally:
+            wait.observe((perf_counter_ns() - start) / 1e9)
+
+    pool._do_get = timed_do_get
+
+
+def collect_pools() -> Iterator[Family]:
+    samples = {"size": [], "checked_out": [], "overflow": []}
+
+    for name, pool in _pools.items():
+        if not isinstance(pool, QueuePool):
+            continue
+
+        labels = (("pool", name),)
+        samples["size"].append(("db_pool_size", labels, pool.size()))
+        samples["checked_out"].append(("db_pool_checked_out", labels, pool.checkedout()))
+        samples["overflow"].append(("db_pool_overflow", labels, max(pool.overflow(), 0)))
+
+    yield Family("db_pool_size", "gauge", "连接池的大小(pool_size)", samples["size"], live=True)
+    yield Family("db_pool_checked_out", "gauge", "已签出的连接数", samples["checked_out"], live=True)
+    yield Family("db_pool_overflow", "gauge", "超出 pool_size 的溢出连接数", samples["overflow"], live=True)
+
+
+def collect_caches() -> Iterator[Family]:
+    hits = [("cache_hits_total", (("cache", name),), cache.hits) for name, cache in CACHES.items()]
+    misses = [("cache_misses_total", (("cache", name),), cache.misses) for name, cache in CACHES.items()]
+    sizes = [("cache_size", (("cache", name),), len(cache)) for name, cache in CACHES.items()]
+
+    yield Family("cache_hits_total", "counter", "缓存命中次数", hits)
+    yield Family("cache_misses_total", "counter", "缓存未命中次数", misses)
+    yield Family("cache_size", "gauge", "缓存中的条目数", sizes, live=True)
+
+
+def cache_hit_ratio(families: Dict[str, Family]) -> Iterator[Family]:
+    """进程启动以来的命中率，由所有进程累加后的命中、未命中次数计算"""
+    if "cache_hits_total" not in families or "cache_misses_total" not in families:
+        return
+
+    misses = {labels: value for _, labels, value in families["cache_misses_total"].samples}
+    samples = []
+
+    for _, labels, hits in families["cache_hits_total"].samples:
+        total = hits + misses.get(labels, 0)
+        samples.append(("cache_hit_ratio", labels, hits / total if total else 0.0))
+
+    yield Family("cache_hit_ratio", "gauge", "缓存命中率(所有进程合计)", samples)
+
+
+def observe_sync_job(source: str, mode: str, status: str, seconds: float, rows: int):
+    SYNC_JOB_DURATION.labels(source, mode, status).observe(seconds)
+    SYNC_JOB_ROWS.labels(source).inc(rows)
+
+
+REGISTRY.register_collector(collect_pools)
+REGISTRY.register_collector(collect_caches)
+REGISTRY.register_derived(cache_hit_ratio)
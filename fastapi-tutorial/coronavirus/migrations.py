@@ -0,0 +1,56 @@
+# coding: utf8
+# ===================================
+# Author: yumingmin
+# File: migrations.py
+# Cate: FastAPI
+# Create time: 2022/7/13 14:05
+# Update time:
+# ===================================
+
+"""数据库结构升级
+* `Base.metadata.create_all` 只会创建不存在的表，已经存在的表不会补建后来新增的列和索引
+* `upgrade` 为所有已存在的表补建缺失的列(只支持可以为空的列)和索引，创建缺失的版本号记录，汇总表为空时从数据表重建，可以重复执行
+* 运行: python -m coronavirus.migrations
+"""
+
+from sqlalchemy import MetaData, inspect
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from .database import Base, engine as default_engine
+from .rollups import rebuild_if_empty
+from .versions import ensure_versions
+
+
+def add_missing_columns(engine: Engine, metadata: MetaData = Base.metadata):
+    """`metadata` 默认是 coronavirus 的表，其他模块(如 ch06 的用户表)可以传入自己的 metadata"""
+    inspector = inspect(engine)
+    quote = engine.dialect.identifier_preparer.quote
+
+    with engine.begin() as conn:
+        for table in metadata.sorted_tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+
+            for column in table.columns:
+                if column.name not in existing:
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    conn.exec_driver_sql(
+                        f"ALTER TABLE {quote(table.name)} ADD COLUMN {quote(column.name)} {column_type}"
+                    )
+
+
+def upgrade(engine: Engine = default_engine):
+    Base.metadata.create_all(bind=engine)
+    add_missing_columns(engine)
+
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+
+    with Session(bind=engine) as db:
+        ensure_versions(db)
+        rebuild_if_empty(db)
+
+
+if __name__ == '__main__':
+    upgrade()
@@ -13,7 +13,7 @@
 * SQLAlchemy 基本知识 Autoflush 和 Autocommit: https://zhuanlan.zhihu.com/p/48994990
 """
 
-from sqlalchemy import Column, String, Integer, BigInteger, Date, DateTime, ForeignKey, func
+from sqlalchemy import Column, String, Integer, BigInteger, Date, DateTime, ForeignKey, Index, Text, func, text
 from sqlalchemy.orm import relationship
 from .database import Base
 
@@ -50,5 +50,98 @@ class Data(Base):
 
     # __mapper_args__ = {"order_by": date.desc()}
 
+    # 按城市查询、按 (city_id, date, id) 游标分页都走这个索引，SQLite 的二级索引自带 rowid(即 id)
+    __table_args__ = (
+        Index("ix_data_city_id_date", "city_id", "date"),
+    )
+
+    def __repr__(self):
+        return f"{repr(self.date)}: 确诊 {self.confirmed} 例"
+
+
+class Version(Base):
+    """数据版本号，写入时加 1，各个 worker 通过比较版本号判断进程内的缓存是否过期"""
+    __tablename__ = "version"
+    name = Column(String(50), primary_key=True, comment="数据名称，如 city")
+    value = Column(BigInteger, default=0, nullable=False, comment="版本号")
+    update_at = Column(DateTime, comment="最近一次修改的时间(UTC)")
+
+    def __repr__(self):
+        return f"{self.name}: v{self.value}"
+
+
+"""汇总表(Rollup)
+* 数据都是累计值，省份按周汇总时取该周最后一天的累计值，全国按天汇总时对各省份当天的累计值求和
+* 由 `coronavirus.rollups` 在写入数据时增量维护
+"""
+
+
+class ProvinceWeekly(Base):
+    __tablename__ = "rollup_province_weekly"
+    city_id = Column(Integer, ForeignKey("city.id"), primary_key=True, comment="所属省/直辖市")
+    week = Column(Date, primary_key=True, comment="所在周的周一")
+    as_of = Column(Date, nullable=False, comment="该周已有数据的最后一天")
+    confirmed = Column(BigInteger, default=0, nullable=False, comment="截至 as_of 的确诊数量")
+    deaths = Column(BigInteger, default=0, nullable=False, comment="截至 as_of 的死亡数量")
+    recovered = Column(BigInteger, default=0, nullable=False, comment="截至 as_of 的痊愈数量")
+
+    def __repr__(self):
+        return f"{self.city_id}@{self.week}: 确诊 {self.confirmed} 例"
+
+
+class NationDaily(Base):
+    __tablename__ = "rollup_nation_daily"
+    date = Column(Date, primary_key=True, comment="数据日期")
+    confirmed = Column(BigInteger, default=0, nullable=False, comment="各省份确诊数量之和")
+    deaths = Column(BigInteger, default=0, nullable=False, comment="各省份死亡数量之和")
+    recovered = Column(BigInteger, default=0, nullable=False, comment="各省份痊愈数量之和")
+    provinces = Column(Integer, default=0, nullable=False, comment="当天有数据的省份数量")
+
     def __repr__(self):
         return f"{repr(self.date)}: 确诊 {self.confirmed} 例"
+
+
+class SyncState(Base):
+    """增量同步时每个省份的同步进度"""
+    __tablename__ = "sync_state"
+    city_id = Column(Integer, ForeignKey("city.id"), primary_key=True, comment="所属省/直辖市")
+    last_date = Column(Date, comment="已同步的最后一天")
+    content_hash = Column(String(64), nullable=False, comment="截至 last_date 的 timeline 内容哈希")
+    update_at = Column(DateTime, server_default=func.now(), onupdate=func.now(), comment="更新时间")
+
+    def __repr__(self):
+        return f"{self.city_id}: 同步至 {self.last_date}"
+
+
+class SyncJob(Base):
+    """后台同步任务，状态：queued -> running -> succeeded / failed"""
+    __tablename__ = "sync_job"
+    __table_args__ = (
+        # 同一数据源最多一个排队中、一个执行中的任务：重复的同步请求合并到已有任务，多个 worker 同时领取时只有一个能成功
+        Index(
+            "uq_sync_job_source_queued", "source", unique=True,
+            sqlite_where=text("status = 'queued'"), postgresql_where=text("status = 'queued'")
+        ),
+        Index(
+            "uq_sync_job_source_running", "source", unique=True,
+            sqlite_where=text("status = 'running'"), postgresql_where=text("status = 'running'")
+        ),
+        Index("ix_sync_job_status_id", "status", "id"),
+    )
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    source = Column(String(50), nullable=False, comment="数据源")
+    url = Column(String(500), nullable=False, comment="上游接口地址")
+    mode = Column(String(20), nullable=False, comment="同步方式：incremental / full")
+    status = Column(String(20), nullable=False, comment="任务状态")
+    locations = Column(Integer, nullable=False, default=0, comment="已处理的 location 数")
+    rows = Column(Integer, nullable=False, default=0, comment="已写入的行数")
+    skipped = Column(Integer, nullable=False, default=0, comment="跳过的未变化省份数")
+    error = Column(Text, comment="失败原因")
+    worker = Column(String(100), comment="执行任务的 worker")
+    created_at = Column(DateTime, nullable=False, comment="创建时间(UTC)")
+    started_at = Column(DateTime, comment="开始执行时间(UTC)")
+    heartbeat_at = Column(DateTime, comment="最近一次上报进度的时间(UTC)")
+    finished_at = Column(DateTime, comment="结束时间(UTC)")
+
+    def __repr__(self):
+        return f"#{self.id} {self.source}({self.mode}): {self.status}"
@@ -0,0 +1,40 @@
+# coding: utf8
+# ===================================
+# Author: yumingmin
+# File: query_plan.py
+# Cate: FastAPI
+# Create time: 2022/7/13 14:30
+# Update time:
+# ===================================
+
+"""SQLite 查询计划检查，供测试和性能脚本使用
+* `EXPLAIN QUERY PLAN` 中 `SCAN <表名>` 且没有 `USING ... INDEX` 表示全表扫描
+* `USE TEMP B-TREE FOR ORDER BY` 表示排序没有走索引，需要把结果全部取出后再排序
+"""
+
+from typing import List
+
+from sqlalchemy.orm import Query, Session
+
+
+def explain(db: Session, query: Query) -> List[str]:
+    """返回查询计划每一步的描述；查询计划与参数的取值无关，所有参数都用 NULL 代替"""
+    connection = db.connection()
+    compiled = query.statement.compile(dialect=connection.dialect)
+    params = (None,) * len(compiled.positiontup or ())
+    rows = connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {compiled}", params).fetchall()
+    return [row[-1] for row in rows]
+
+
+def full_scans(plan: List[str]) -> List[str]:
+    return [
+        step for step in plan
+        if (step.startswith("SCAN") and "USING" not in step) or step.startswith("USE TEMP B-TREE")
+    ]
+
+
+def assert_indexed(db: Session, query: Query):
+    """查询计划中出现全表扫描或临时排序时抛出 AssertionError"""
+    plan = explain(db, query)
+    bad = full_scans(plan)
+    assert not bad, f"查询没有走索引: {bad}\n{query.statement}\n" + "\n".join(plan)
@@ -0,0 +1,296 @@
+# coding: utf8
+# ===================================
+# Author: yumingmin
+# File: rollups.py
+# Cate: FastAPI
+# Create time: 2022/7/18 10:30
+# Update time:
+# ===================================
+
+"""汇总表的增量维护、重建和一致性检查
+* 写入数据时调用 `apply`，只更新受影响的桶(省份-周、全国-天)，汇总查询的代价从 O(数据行数) 变为 O(桶数)
+* `apply` 不提交事务，和数据在同一个事务中提交
+* 运行: python -m coronavirus.rollups rebuild | check
+"""
+
+import sys
+from collections import defaultdict
+from datetime import date, timedelta
+from typing import Dict, Iterable, List, Tuple
+
+from sqlalchemy.orm import Session
+
+from . import models
+from .http_cache import response_cache
+from .versions import DATA, bump_version
+
+FIELDS = ("confirmed", "deaths", "recovered")
+# IN 查询每批的参数个数，低于 SQLite 的绑定参数上限
+IN_CHUNK_SIZE = 500
+
+
+def week_of(day: date) -> date:
+    """所在周的周一"""
+    return day - timedelta(days=day.weekday())
+
+
+def _as_date(value) -> date:
+    return value if isinstance(value, date) else date.fromisoformat(str(value))
+
+
+def _in_chunks(values: Iterable) -> Iterable[List]:
+    values = list(values)
+
+    for i in range(0, len(values), IN_CHUNK_SIZE):
+        yield values[i:i + IN_CHUNK_SIZE]
+
+
+def apply(db: Session, added: Iterable[dict] = (), removed: Iterable[dict] = ()):
+    """把新增/删除的数据行合并到汇总表，每一行包含 city_id、date 和 FIELDS 中的字段
+    修改一行数据等价于删除旧值再新增新值，调用前数据表的修改需要已经 flush
+    """
+    nation = defaultdict(lambda: [0, 0, 0, 0])
+    latest: Dict[Tuple[int, date], Tuple] = {}
+    recompute = set()
+
+    for row in added:
+        day = _as_date(row["date"])
+        values = tuple(row.get(field) or 0 for field in FIELDS)
+        delta = nation[day]
+
+        for i, value in enumerate(values):
+            delta[i] += value
+
+        delta[3] += 1
+        key = (row["city_id"], week_of(day))
+
+        if key not in latest or latest[key][0] <= day:
+            latest[key] = (day, values)
+
+    for row in removed:
+        day = _as_date(row["date"])
+        delta = nation[day]
+
+        for i, field in enumerate(FIELDS):
+            delta[i] -= row.get(field) or 0
+
+        delta[3] -= 1
+        recompute.add((row["city_id"], week_of(day)))
+
+    _apply_nation(db, nation)
+    _apply_weekly(db, latest, recompute)
+    db.flush()
+
+
+def _apply_nation(db: Session, nation: dict):
+    existing = {}
+
+    for days in _in_chunks(nation):
+        existing.update(
+            (bucket.date, bucket)
+            for bucket in db.query(models.NationDaily).filter(models.NationDaily.date.in_(days))
+        )
+
+    for day, (confirmed, deaths, recovered, provinces) in nation.items():
+        bucket = existing.get(day)
+
+        if bucket is None:
+            bucket = models.NationDaily(date=day, confirmed=0, deaths=0, recovered=0, provinces=0)
+            db.add(bucket)
+
+        bucket.confirmed += confirmed
+        bucket.deaths += deaths
+        bucket.recovered += recovered
+        bucket.provinces += provinces
+
+        if bucket.provinces <= 0:
+            if bucket in db.new:
+                db.expunge(bucket)
+            else:
+                db.delete(bucket)
+
+
+def _apply_weekly(db: Session, latest: dict, recompute: set):
+    keys = set(latest) | recompute
+    existing = {}
+
+    for city_ids in _in_chunks({city_id for city_id, _ in keys}):
+        weeks = {week for _, week in keys}
+        query = db.query(models.ProvinceWeekly).filter(
+            models.ProvinceWeekly.city_id.in_(city_ids),
+            models.ProvinceWeekly.week.between(min(weeks), max(weeks))
+        )
+        existing.update(((bucket.city_id, bucket.week), bucket) for bucket in query)
+
+    for key, (day, values) in latest.items():
+        bucket = existing.get(key)
+
+        if bucket is None:
+            bucket = models.ProvinceWeekly(city_id=key[0], week=key[1], as_of=day)
+            existing[key] = bucket
+            db.add(bucket)
+        elif bucket.as_of > day:
+            continue
+
+        bucket.as_of = day
+        bucket.confirmed, bucket.deaths, bucket.recovered = values
+
+    for city_id, week in recompute - set(latest):
+        # 删除的行可能正是该周最后一天，从数据表中(走 city_id, date 索引)重新取该周最后一天
+        row = (
+            db.query(models.Data)
+            .filter(models.Data.city_id == city_id, models.Data.date.between(week, week + timedelta(days=6)))
+            .order_by(models.Data.date.desc())
+            .first()
+        )
+        bucket = existing.get((city_id, week))
+
+        if row is None:
+            if bucket is not None:
+                db.delete(bucket)
+            continue
+
+        if bucket is None:
+            bucket = models.ProvinceWeekly(city_id=city_id, week=week)
+            db.add(bucket)
+
+        bucket.as_of = row.date
+        bucket.confirmed, bucket.deaths, bucket.recovered = row.confirmed, row.deaths, row.recovered
+
+
+def clear(db: Session):
+    db.query(models.ProvinceWeekly).delete()
+    db.query(models.NationDaily).delete()
+
+
+"""重建和一致性检查"""
+
+
+def compute(db: Session) -> Tuple[dict, dict]:
+    """从数据表完整计算一遍汇总结果，返回 (nation, weekly)，按 (city_id, date) 顺序流式读取"""
+    nation = defaultdict(lambda: [0, 0, 0, 0])
+    weekly = {}
+    query = db.query(
+        models.Data.city_id, models.Data.date, models.Data.confirmed, models.Data.deaths, models.Data.recovered
+    ).order_by(models.Data.city_id, models.Data.date)
+
+    for city_id, day, *values in query.yield_per(1000):
+        bucket = nation[day]
+
+        for i, value in enumerate(values):
+            bucket[i] += value
+
+        bucket[3] += 1
+        weekly[(city_id, week_of(day))] = (day, *values)
+
+    return dict(nation), weekly
+
+
+def rebuild(db: Session, commit: bool = True):
+    """重建汇总表，同时更新 DATA 版本号，缓存的汇总查询响应随之失效"""
+    nation, weekly = compute(db)
+    clear(db)
+    db.bulk_insert_mappings(models.NationDaily, [
+        {"date": day, "confirmed": c, "deaths": d, "recovered": r, "provinces": n}
+        for day, (c, d, r, n) in nation.items()
+    ])
+    db.bulk_insert_mappings(models.ProvinceWeekly, [
+        {"city_id": city_id, "week": week, "as_of": day, "confirmed": c, "deaths": d, "recovered": r}
+        for (city_id, week), (day, c, d, r) in weekly.items()
+    ])
+    bump_version(db, DATA)
+
+    if commit:
+        db.commit()
+        response_cache.invalidate()
+
+
+def check(db: Session) -> List[str]:
+    """对比汇总表和数据表，返回不一致之处的描述，为空表示一致"""
+    nation, weekly = compute(db)
+    problems = []
+    stored = {
+        bucket.date: [bucket.confirmed, bucket.deaths, bucket.recovered, bucket.provinces]
+        for bucket in db.query(models.NationDaily)
+    }
+
+    for day in sorted(set(nation) | set(stored), key=str):
+        if nation.get(day) != stored.get(day):
+            problems.append(f"nation {day}: 期望 {nation.get(day)}，实际 {stored.get(day)}")
+
+    stored = {
+        (bucket.city_id, bucket.week): (bucket.as_of, bucket.confirmed, bucket.deaths, bucket.recovered)
+        for bucket in db.query(models.ProvinceWeekly)
+    }
+
+    for key in sorted(set(weekly) | set(stored), key=str):
+        if weekly.get(key) != stored.get(key):
+            problems.append(f"province {key}: 期望 {weekly.get(key)}，实际 {stored.get(key)}")
+
+    return problems
+
+
+def rebuild_if_empty(db: Session):
+    """已有数据但汇总表为空时(如升级前的数据库)重建"""
+    if db.query(models.NationDaily.date).first() is None and db.query(models.Data.id).first() is not None:
+        rebuild(db)
+
+
+"""汇总查询"""
+
+
+def get_nation_daily(db: Session, start: date = None, end: date = None):
+    query = db.query(models.NationDaily)
+
+    if start:
+        query = query.filter(models.NationDaily.date >= start)
+
+    if end:
+        query = query.filter(models.NationDaily.date <= end)
+
+    return query.order_by(models.NationDaily.date).all()
+
+
+def get_nation_weekly(db: Session, start: date = None, end: date = None) -> List[dict]:
+    """每周取最后一天的全国累计值，基于按天汇总的结果计算"""
+    weeks = {}
+
+    for bucket in get_nation_daily(db, start, end):
+        weeks[week_of(bucket.date)] = bucket
+
+    return [
+        {"date": week, "confirmed": b.confirmed, "deaths": b.deaths, "recovered": b.recovered}
+        for week, b in weeks.items()
+    ]
+
+
+def get_province_weekly(db: Session, city_id: int = None, start: date = None, end: date = None):
+    query = db.query(models.ProvinceWeekly)
+
+    if city_id is not None:
+        query = query.filter(models.ProvinceWeekly.city_id == city_id)
+
+    if start:
+        query = query.filter(models.ProvinceWeekly.week >= week_of(start))
+
+    if end:
+        query = query.filter(models.ProvinceWeekly.week <= end)
+
+    return query.order_by(models.ProvinceWeekly.city_id, models.ProvinceWeekly.week).all()
+
+
+if __name__ == '__main__':
+    from .database import SessionLocal
+
+    command = sys.argv[1] if len(sys.argv) > 1 else "check"
+
+    with SessionLocal() as session:
+        if command == "rebuild":
+            rebuild(session)
+            print("汇总表已重建")
+        elif command == "check":
+            issues = check(session)
+            print("\n".join(issues) or "汇总表与数据表一致")
+            sys.exit(1 if issues else 0)
+        else:
+            sys.exit(f"未知命令: {command}，可选 rebuild / check")
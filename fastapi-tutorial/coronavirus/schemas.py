@@ -8,6 +8,8 @@
 # ===================================
 
 from datetime import date, datetime
+from enum import Enum
+from typing import Dict, List, Optional
 from pydantic import BaseModel
 
 
@@ -28,6 +30,14 @@ class ReadData(BaseModel):
         orm_mode = True
 
 
+class Data(ReadData):
+    """数据的完整字段，`get_data` 的响应"""
+    date: date
+    confirmed: int
+    deaths: int
+    recovered: int
+
+
 class CreateCity(BaseModel):
     province: str
     country: str
@@ -42,3 +52,118 @@ class ReadCity(BaseModel):
 
     class Config:
         orm_mode = True
+
+
+class City(ReadCity):
+    """城市的完整字段，作为进程内缓存中的快照，不依赖数据库 session"""
+    province: str
+    country: str
+    country_code: str
+    country_population: int
+
+    class Config:
+        orm_mode = True
+        allow_mutation = False
+
+
+class IngestStats(BaseModel):
+    """批量写入的统计信息，`skipped` 为增量同步时内容没有变化而跳过的 location 数量"""
+    rows: int = 0
+    seconds: float = 0.0
+    skipped: int = 0
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.seconds if self.seconds else 0.0
+
+    def __add__(self, other: "IngestStats") -> "IngestStats":
+        return IngestStats(
+            rows=self.rows + other.rows,
+            seconds=self.seconds + other.seconds,
+            skipped=self.skipped + other.skipped
+        )
+
+
+class ExportFormat(str, Enum):
+    ndjson = "ndjson"
+    csv = "csv"
+
+
+class NationTotal(BaseModel):
+    date: date
+    confirmed: int
+    deaths: int
+    recovered: int
+
+    class Config:
+        orm_mode = True
+
+
+class ProvinceWeekly(BaseModel):
+    city_id: int
+    week: date
+    as_of: date
+    confirmed: int
+    deaths: int
+    recovered: int
+
+    class Config:
+        orm_mode = True
+
+
+class SyncMode(str, Enum):
+    incremental = "incremental"
+    full = "full"
+
+
+class SyncJobStatus(str, Enum):
+    queued = "queued"
+    running = "running"
+    succeeded = "succeeded"
+    failed = "failed"
+
+
+class SyncJob(BaseModel):
+    id: int
+    source: str
+    mode: SyncMode
+    status: SyncJobStatus
+    locations: int
+    rows: int
+    skipped: int
+    error: Optional[str] = None
+    worker: Optional[str] = None
+    created_at: datetime
+    started_at: Optional[datetime] = None
+    heartbeat_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+
+    class Config:
+        orm_mode = True
+
+
+class SyncJobAccepted(BaseModel):
+    message: str
+    job_id: int
+
+
+class Metric(str, Enum):
+    confirmed = "confirmed"
+    deaths = "deaths"
+    recovered = "recovered"
+
+
+class Indicator(str, Enum):
+    new_cases = "new_cases"
+    moving_average = "moving_average"
+    growth_rate = "growth_rate"
+    doubling_time = "doubling_time"
+
+
+class AnalyticsSeries(BaseModel):
+    """按列组织的结果：`series` 中每个省份的数组与 `dates` 一一对应，无法计算的位置为 null"""
+    indicator: Indicator
+    metric: Metric
+    window: int
+    dates: List[date]
+    series: Dict[str, List[Optional[float]]]
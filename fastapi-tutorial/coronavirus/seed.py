@@ -0,0 +1,246 @@
+# coding: utf8
+# ===================================
+# Author: yumingmin
+# File: seed.py
+# Cate: FastAPI
+# Create time: 2022/7/26 09:30
+# Update time:
+# ===================================
+
+"""生成模拟数据，用于本地压测和检查索引、查询计划(不依赖远程的 JHU 同步)
+* N 个省份 × M 天，每个省份由 1~3 波 logistic 曲线叠加出每日新增，再乘以 `1 + noise * 正态噪声`，
+  累加后的 confirmed 单调不减；deaths 按各省的病死率从每日新增中二项抽样后累加，recovered 为 14 天前的确诊减去死亡
+* 按省份分块用 NumPy 生成，每块写入后即释放，内存占用与总行数无关；相同的 `seed` 生成相同的数据
+* 写入使用 Core 的 executemany(不经过 ORM 和 pydantic 校验)；数据表为空时先删除索引，写完再重建，
+  汇总表直接由生成的数组计算，不再扫描一遍数据表(已有数据时改为调用 `rollups.rebuild`)；最后更新版本号
+* 预设的测试库: 10k(34 省 × 300 天)、1m(1000 × 1000)、10m(10000 × 1000)
+运行:
+  python -m coronavirus.seed --provinces 34 --days 300                      # 写入配置的数据库
+  python -m coronavirus.seed --fixture 1m --output fixtures/coronavirus-1m.sqlite3  # 生成测试库文件
+"""
+
+import argparse
+import os
+import time
+from datetime import date, timedelta
+from typing import Iterator, List, NamedTuple, Tuple
+
+import numpy as np
+from sqlalchemy import create_engine, event, insert, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from . import models, rollups, schemas
+from .cache import city_cache
+from .database import engine as default_engine
+from .http_cache import response_cache
+from .migrations import upgrade
+from .versions import CITY, DATA, bump_version
+
+START = date(2020, 1, 22)
+# 每块生成的省份数，一块的数据量为 BLOCK_PROVINCES * days 行
+BLOCK_PROVINCES = 64
+CHUNK_SIZE = 20000
+
+
+class Fixture(NamedTuple):
+    provinces: int
+    days: int
+
+
+FIXTURES = {
+    "10k": Fixture(34, 300),
+    "1m": Fixture(1000, 1000),
+    "10m": Fixture(10000, 1000),
+}
+
+
+def province_name(index: int) -> str:
+    return f"province-{index}"
+
+
+def generate_block(rng: np.random.Generator, provinces: int, days: int, noise: float) -> Tuple[np.ndarray, ...]:
+    """返回 (confirmed, deaths, recovered)，形状都是 (provinces, days)，沿天数方向单调不减"""
+    t = np.arange(days, dtype=np.float64)
+    daily = np.zeros((provinces, days))
+
+    for wave in range(3):
+        present = rng.random(provinces) < (1.0 if wave == 0 else 0.5)
+        size = rng.lognormal(mean=8.0, sigma=1.5, size=provinces) * present
+        center = rng.uniform(0, days, size=provinces)
+        rate = rng.uniform(0.05, 0.3, size=provinces)
+        cumulative = size[:, None] / (1.0 + np.exp(-rate[:, None] * (t[None, :] - center[:, None])))
+        daily += np.diff(cumulative, axis=1, prepend=0.0)
+
+    if noise > 0:
+        daily *= 1.0 + noise * rng.standard_normal(daily.shape)
+
+    new_confirmed = np.rint(np.clip(daily, 0, None)).astype(np.int64)
+    confirmed = np.cumsum(new_confirmed, axis=1)
+
+    fatality = rng.uniform(0.005, 0.04, size=provinces)
+    deaths = np.cumsum(rng.binomial(new_confirmed, fatality[:, None]), axis=1)
+
+    recovered = np.zeros_like(confirmed)
+    lag = min(14, days)
+    recovered[:, lag:] = np.maximum(confirmed[:, :days - lag] - deaths[:, lag:], 0)
+    recovered = np.minimum(np.maximum.accumulate(recovered, axis=1), confirmed - deaths)
+    return confirmed, deaths, recovered
+
+
+def generate(
+    provinces: int, days: int, noise: float = 0.1, seed: int = 0
+) -> Iterator[Tuple[List[str], np.ndarray, np.ndarray, np.ndarray]]:
+    """按块产出 (省份名称, confirmed, deaths, recovered)，数组的第 i 列是第 i 天，日期由调用方决定"""
+    rng = np.random.default_rng(seed)
+
+    for first in range(0, provinces, BLOCK_PROVINCES):
+        count = min(BLOCK_PROVINCES, provinces - first)
+        names = [province_name(i) for i in range(first, first + count)]
+        yield (names, *generate_block(rng, count, days, noise))
+
+
+def _is_empty(engine: Engine) -> bool:
+    with engine.connect() as conn:
+        return conn.execute(select(models.Data.id).limit(1)).first() is None
+
+
+def _week_ends(dates: List[date]) -> List[int]:
+    """每周(周一开始)最后一天在 `dates` 中的下标，即 `ProvinceWeekly.as_of`"""
+    weeks = [rollups.week_of(day) for day in dates]
+    return [i for i in range(len(dates)) if i == len(dates) - 1 or weeks[i + 1] != weeks[i]]
+
+
+def load(
+    engine: Engine = default_engine,
+    provinces: int = 34,
+    days: int = 300,
+    noise: float = 0.1,
+    seed: int = 0,
+    start: date = START,
+    chunk_size: int = CHUNK_SIZE
+) -> schemas.IngestStats:
+    """生成并写入 `provinces` 个省份 × `days` 天的数据，返回写入的数据行数和耗时
+    省份名称为 province-0、province-1……，数据库中已有同名省份时违反唯一约束
+    """
+    started = time.perf_counter()
+    upgrade(engine)
+    empty = _is_empty(engine)
+    # 数据表为空时删除二级索引，写入后再一次性建索引，比逐行维护索引快
+    indexes = list(models.Data.__table__.indexes) if empty else []
+
+    for index in indexes:
+        index.drop(bind=engine, checkfirst=True)
+
+    dates = [start + timedelta(days=day) for day in range(days)]
+    week_ends = _week_ends(dates)
+    nation = np.zeros((3, days), dtype=np.int64)
+    city_table, data_table = models.City.__table__, models.Data.__table__
+    rows = 0
+
+    try:
+        for names, confirmed, deaths, recovered in generate(provinces, days, noise, seed):
+            with engine.begin() as conn:
+                conn.execute(insert(city_table), [
+                    {"province": name, "country": "China", "country_code": "CN", "country_population": 1400050000}
+                    for name in names
+                ])
+                ids = dict(conn.execute(
+                    select(city_table.c.province, city_table.c.id).where(city_table.c.province.in_(names))
+                ).all())
+                values = []
+
+                for i, name in enumerate(names):
+                    city_id = ids[name]
+                    values.extend(
+                        {"city_id": city_id, "date": day, "confirmed": c, "deaths": d, "recovered": r}
+                        for day, c, d, r in zip(dates, confirmed[i].tolist(), deaths[i].tolist(), recovered[i].tolist())
+                    )
+
+                    if len(values) >= chunk_size:
+                        conn.execute(insert(data_table), values)
+                        rows += len(values)
+                        values = []
+
+                if values:
+                    conn.execute(insert(data_table), values)
+                    rows += len(values)
+
+                if empty:
+                    conn.execute(insert(models.ProvinceWeekly.__table__), [
+                        {
+                            "city_id": ids[name], "week": rollups.week_of(dates[day]), "as_of": dates[day],
+                            "confirmed": int(confirmed[i, day]), "deaths": int(deaths[i, day]),
+                            "recovered": int(recovered[i, day])
+                        }
+                        for i, name in enumerate(names) for day in week_ends
+                    ])
+                    nation += np.stack([confirmed.sum(axis=0), deaths.sum(axis=0), recovered.sum(axis=0)])
+    finally:
+        for index in indexes:
+            index.create(bind=engine, checkfirst=True)
+
+    with Session(bind=engine) as db:
+        if empty and provinces:
+            db.execute(insert(models.NationDaily.__table__), [
+                {"date": day, "confirmed": c, "deaths": d, "recovered": r, "provinces": provinces}
+                for day, c, d, r in zip(dates, *nation.tolist())
+            ])
+        else:
+            rollups.rebuild(db, commit=False)
+
+        bump_version(db, CITY, DATA)
+        db.commit()
+
+    city_cache.invalidate()
+    response_cache.invalidate()
+    return schemas.IngestStats(rows=rows, seconds=time.perf_counter() - started)
+
+
+def build_fixture(path: str, name: str, noise: float = 0.1, seed: int = 0) -> schemas.IngestStats:
+    """生成一个新的 SQLite 测试库文件；构建期间关闭日志和同步写盘，已存在的文件会被覆盖"""
+    for suffix in ("", "-wal", "-shm", "-journal"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+    engine = create_engine(f"sqlite:///{path}")
+
+    @event.listens_for(engine, "connect")
+    def fast_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+
+        for pragma in ("journal_mode=OFF", "synchronous=OFF", "cache_size=-262144"):
+            cursor.execute(f"PRAGMA {pragma}")
+
+        cursor.close()
+
+    fixture = FIXTURES[name]
+
+    try:
+        return load(engine, fixture.provinces, fixture.days, noise, seed)
+    finally:
+        engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--provinces", type=int, default=34)
+    parser.add_argument("--days", type=int, default=300)
+    parser.add_argument("--noise", type=float, default=0.1, help="每日新增的相对噪声(标准差)")
+    parser.add_argument("--seed", type=int, default=0, help="随机数种子，相同的种子生成相同的数据")
+    parser.add_argument("--fixture", choices=sorted(FIXTURES), help="生成预设大小的 SQLite 测试库")
+    parser.add_argument("--output", help="测试库文件路径，默认为 fixtures/coronavirus-<fixture>.sqlite3")
+    args = parser.parse_args()
+
+    if args.fixture:
+        output = args.output or os.path.join("fixtures", f"coronavirus-{args.fixture}.sqlite3")
+        stats = build_fixture(output, args.fixture, args.noise, args.seed)
+        print(f"{output}: {stats.rows} 行，{stats.seconds:.1f} 秒，{stats.rows_per_second:.0f} 行/秒")
+        return
+
+    stats = load(default_engine, args.provinces, args.days, args.noise, args.seed)
+    print(f"写入 {stats.rows} 行，{stats.seconds:.1f} 秒，{stats.rows_per_second:.0f} 行/秒")
+
+
+if __name__ == '__main__':
+    main()
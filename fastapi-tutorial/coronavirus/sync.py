@@ -0,0 +1,276 @@
+# coding: utf8
+# ===================================
+# Author: yumingmin
+# File: sync.py
+# Cate: FastAPI
+# Create time: 2022/7/19 10:20
+# Update time:
+# ===================================
+
+"""从 JHU 同步数据
+* 全量(full)：清空后重新写入，整个过程在一个事务中，提交前读者看到的仍是旧数据
+* 增量(incremental，默认)：城市按 province、数据按 (city, date) 对比，只写入新增或变化的行，不删除任何数据，城市的 id 保持不变
+* 增量同步记录每个省份已同步的最后一天和截至这一天的 timeline 哈希：
+  历史部分的哈希没有变化时只追加新的日期，完全没有变化时整个省份跳过；哈希变化时才读出已有数据逐行对比
+* 同步由 `jobs` 中的后台 worker 执行，`bg_task` 每写完一批调用一次 `progress` 上报进度
+"""
+
+import asyncio
+import hashlib
+import logging
+import time
+from datetime import date
+from typing import Callable, Dict, List, Optional, Tuple
+
+from pydantic import HttpUrl
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from . import async_crud, crud, models, rollups, schemas
+from .cache import city_cache
+from .http_cache import response_cache
+from .fetcher import JHUFetcher
+from .versions import CITY, DATA, bump_version
+
+logger = logging.getLogger(__name__)
+
+# 同步数据时每批写入的 location 数量
+SYNC_BATCH_SIZE = 8
+
+# timeline 中的一天：(日期, 确诊, 死亡)
+Entry = Tuple[date, int, int]
+
+# 进度回调：progress(累计的写入统计, 累计处理的 location 数)，在线程池中执行，自己创建 session 写入并提交，不在同步的事务中
+Progress = Callable[[schemas.IngestStats, int], None]
+
+
+def location_city(location: dict) -> dict:
+    return {
+        "province": location["province"],
+        "country": location["country"],
+        "country_code": "CN",
+        "country_population": location["country_population"]
+    }
+
+
+def location_timeline(location: dict) -> List[Entry]:
+    """按日期排序的 timeline"""
+    deaths = location["timelines"]["deaths"]["timeline"]
+    return sorted(
+        (date.fromisoformat(day.split("T")[0]), confirmed, deaths.get(day, 0))
+        for day, confirmed in location["timelines"]["confirmed"]["timeline"].items()
+    )
+
+
+def timeline_hash(entries: List[Entry]) -> str:
+    digest = hashlib.sha256()
+
+    for day, confirmed, deaths in entries:
+        digest.update(f"{day.isoformat()}:{confirmed}:{deaths}\n".encode())
+
+    return digest.hexdigest()
+
+
+def data_row(city_id: int, entry: Entry) -> dict:
+    day, confirmed, deaths = entry
+    return {"city_id": city_id, "date": day, "confirmed": confirmed, "deaths": deaths, "recovered": 0}
+
+
+def record_state(db: Session, states: Dict[int, models.SyncState], city_id: int, timeline: List[Entry]):
+    state = states.get(city_id)
+
+    if state is None:
+        state = states[city_id] = models.SyncState(city_id=city_id)
+        db.add(state)
+
+    state.last_date = timeline[-1][0] if timeline else None
+    state.content_hash = timeline_hash(timeline)
+
+
+def ingest_full(db: Session, locations: List[dict], clear: bool = False) -> schemas.IngestStats:
+    """全量写入一批 location，不提交事务；`clear=True` 时先清空原有数据"""
+    if clear:
+        rollups.clear(db)
+        db.query(models.SyncState).delete()
+        db.query(models.Data).delete()  # 先删数据再删城市，避免数据引用不存在的城市
+        db.query(models.City).delete()
+        bump_version(db, CITY, DATA)
+
+    stats = crud.bulk_create_cities(db, (location_city(location) for location in locations), commit=False)
+    city_ids = crud.get_city_ids(db)
+    timelines = {location["province"]: location_timeline(location) for location in locations}
+    data = (
+        data_row(city_ids[province], entry)
+        for province, timeline in timelines.items()
+        for entry in timeline
+    )
+    stats += crud.bulk_create_city_data(db, data, commit=False)
+    states = {}
+
+    for province, timeline in timelines.items():
+        record_state(db, states, city_ids[province], timeline)
+
+    return stats
+
+
+def _upsert_cities(db: Session, locations: List[dict]) -> Tuple[Dict[str, int], int]:
+    """新增不存在的城市，修改字段有变化的城市，返回 ({province: id}, 写入行数)"""
+    provinces = [location["province"] for location in locations]
+    existing = {city.province: city for city in db.query(models.City).filter(models.City.province.in_(provinces))}
+    new = [location_city(location) for location in locations if location["province"] not in existing]
+    written = crud.bulk_create_cities(db, new, commit=False).rows
+
+    for location in locations:
+        city = existing.get(location["province"])
+        fields = location_city(location)
+        population = str(fields["country_population"])  # 数据库中人口是字符串
+
+        if city is not None and (city.country, city.country_population) != (fields["country"], population):
+            city.country = fields["country"]
+            city.country_population = fields["country_population"]
+            written += 1
+
+    if written:
+        db.flush()
+        bump_version(db, CITY, DATA)
+
+    ids = db.query(models.City.province, models.City.id).filter(models.City.province.in_(provinces))
+    return dict(ids.all()), written
+
+
+def ingest_incremental(db: Session, locations: List[dict]) -> schemas.IngestStats:
+    """增量写入一批 location，不提交事务"""
+    start = time.perf_counter()
+    city_ids, written = _upsert_cities(db, locations)
+    states = {
+        state.city_id: state
+        for state in db.query(models.SyncState).filter(models.SyncState.city_id.in_(city_ids.values()))
+    }
+    inserts, changes, skipped = [], [], 0
+
+    for location in locations:
+        city_id = city_ids[location["province"]]
+        timeline = location_timeline(location)
+        state = states.get(city_id)
+        since = None
+
+        if state is not None and state.last_date is not None:
+            history = [entry for entry in timeline if entry[0] <= state.last_date]
+
+            if timeline_hash(history) == state.content_hash:
+                if len(history) == len(timeline):
+                    skipped += 1
+                    continue
+
+                # 历史部分没有变化，只需要对比 last_date 之后的日期
+                since = state.last_date
+
+        # 读出需要对比的已有数据(走 city_id, date 索引)，逐行对比
+        query = db.query(
+            models.Data.id, models.Data.date, models.Data.confirmed, models.Data.deaths, models.Data.recovered
+        ).filter(models.Data.city_id == city_id)
+
+        if since is not None:
+            query = query.filter(models.Data.date > since)
+
+        current = {row.date: row for row in query}
+
+        for entry in timeline:
+            if since is not None and entry[0] <= since:
+                continue
+
+            new = data_row(city_id, entry)
+            old = current.get(entry[0])
+
+            if old is None:
+                inserts.append(new)
+            elif (old.confirmed, old.deaths, old.recovered) != (new["confirmed"], new["deaths"], new["recovered"]):
+                changes.append((dict(old._mapping, city_id=city_id), new))
+
+        record_state(db, states, city_id, timeline)
+
+    stats = crud.bulk_create_city_data(db, inserts, commit=False) + crud.bulk_update_city_data(db, changes)
+    db.flush()
+    return schemas.IngestStats(rows=stats.rows + written, seconds=time.perf_counter() - start, skipped=skipped)
+
+
+async def bg_task(
+    url: HttpUrl,
+    db: Session,
+    batch_size: int = SYNC_BATCH_SIZE,
+    mode: schemas.SyncMode = schemas.SyncMode.incremental,
+    progress: Optional[Progress] = None
+):
+    """这里注意一个坑，不要在后台任务的参数中 db: Session = Depends(get_db) 这样导入依赖，`db` 由调用方创建并负责关闭
+    * 只请求一次带 timelines 的数据，城市信息也从中获取
+    * 下载和写入通过有界队列并行：每解析出 `batch_size` 个 location 就在线程池中批量写入，同时继续下载
+    * 全量同步只提交一次事务，失败时回滚，读者不会看到清空后写了一半的数据
+    * 增量同步不删除数据，每批写完就提交，缩短持有写锁的时间；中途失败时已提交的批次保留，下次同步会跳过它们
+    * 每批写完后调用 `progress` 上报进度，增量同步在本批提交之后调用，进度的写入不用等待同步自己的写锁
+    """
+    queue = asyncio.Queue(maxsize=2)
+    start = time.perf_counter()
+
+    async def produce():
+        batch = []
+
+        try:
+            async with JHUFetcher(url) as fetcher:
+                async for location in fetcher.locations(country_code="CN", timelines=True):
+                    batch.append(location)
+
+                    if len(batch) >= batch_size:
+                        await queue.put(batch)
+                        batch = []
+
+            if batch:
+                await queue.put(batch)
+        except Exception:
+            await queue.put(None)
+            raise
+
+        await queue.put(None)
+
+    producer = asyncio.create_task(produce())
+    stats = schemas.IngestStats()
+    first = True
+    locations = 0
+
+    try:
+        while True:
+            batch = await queue.get()
+
+            if batch is None:
+                break
+
+            if mode == schemas.SyncMode.full:
+                stats += await async_crud.run(db, ingest_full, batch, first)
+            else:
+                stats += await async_crud.run(db, ingest_incremental, batch)
+
+            first = False
+            locations += len(batch)
+
+            if mode == schemas.SyncMode.incremental:
+                await async_crud.commit(db)
+                city_cache.invalidate()
+                response_cache.invalidate()
+
+            if progress is not None:
+                await run_in_threadpool(progress, stats, locations)
+
+        await producer  # 下载失败时在这里抛出异常
+        await async_crud.commit(db)
+        city_cache.invalidate()
+        response_cache.invalidate()
+    except BaseException:
+        producer.cancel()
+        await async_crud.rollback(db)
+        raise
+
+    seconds = time.perf_counter() - start
+    logger.info(
+        "%s同步写入 %d 行，跳过 %d 个未变化的省份，耗时 %.2fs，%.0f 行/秒",
+        mode.value, stats.rows, stats.skipped, seconds, stats.rows / seconds if seconds else 0
+    )
+    return stats
@@ -0,0 +1,55 @@
+# coding: utf8
+# ===================================
+# Author: yumingmin
+# File: versions.py
+# Cate: FastAPI
+# Create time: 2022/7/16 09:40
+# Update time:
+# ===================================
+
+"""数据版本号
+* 写入数据的事务中调用 `bump_version`，版本号和数据一起提交
+* 多个 uvicorn worker 的进程内缓存互相不可见，通过读取数据库中的版本号判断缓存是否需要失效
+* `city`：城市表的版本；`data`：所有写入路径(城市、数据、同步)都会加 1，用于 HTTP 条件请求的 ETag / Last-Modified
+"""
+
+from datetime import datetime
+from typing import Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from . import models
+
+CITY = "city"
+DATA = "data"
+NAMES = (CITY, DATA)
+
+
+def get_version(db: Session, name: str) -> int:
+    return db.query(models.Version.value).filter(models.Version.name == name).scalar() or 0
+
+
+def get_version_info(db: Session, name: str) -> Tuple[int, Optional[datetime]]:
+    """返回 (版本号, 最近一次修改的时间)"""
+    row = db.query(models.Version.value, models.Version.update_at).filter(models.Version.name == name).first()
+    return (row.value, row.update_at) if row is not None else (0, None)
+
+
+def bump_version(db: Session, *names: str):
+    """不提交事务；版本号的行由 `migrations.upgrade` 预先创建"""
+    now = datetime.utcnow().replace(microsecond=0)
+
+    for name in names:
+        updated = db.query(models.Version).filter(models.Version.name == name).update(
+            {models.Version.value: models.Version.value + 1, models.Version.update_at: now}, synchronize_session=False
+        )
+
+        if not updated:
+            db.add(models.Version(name=name, value=1, update_at=now))
+            db.flush()
+
+
+def ensure_versions(db: Session):
+    existing = {name for (name,) in db.query(models.Version.name)}
+    db.add_all(models.Version(name=name, value=0) for name in NAMES if name not in existing)
+    db.commit()
@@ -5,19 +5,25 @@
 # Create Time: 2022/7/4 
 # Update Time: 2022/7/4 18:35
 # ================================
-import time
+import os
+import tempfile
 
 import uvicorn
 from requests import RequestException
 from starlette.exceptions import HTTPException as StarletteHTTPException
-from fastapi import FastAPI, Request
-from fastapi.staticfiles import StaticFiles
+from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import PlainTextResponse
 from fastapi.exceptions import RequestValidationError
 
 from tutorial import app03, app04, app05, app06, app07, app08
 from coronavirus import application
+from coronavirus.config import settings
+from coronavirus.database import async_engine, engine
+from coronavirus.metrics import instrument_pool
+from core import CompressionMiddleware, FastJSONResponse, PrecompressedStaticFiles, TimingMiddleware
+from core import instrument_engine, instrument_routes, metrics
+from core.profiler import SQLProfileMiddleware, profile_endpoint, profiler
 
 
 app = FastAPI(
@@ -25,19 +31,12 @@ app = FastAPI(
     description="FastAPI 教程于新冠病毒追踪器示例，Github: http://github.com/liaogx/fastapi-tutorial",
     version="1.0.0",
     docs_url="/docs",
-    redoc_url="/redocs"
+    redoc_url="/redocs",
+    # 默认使用 orjson 序列化 JSON 响应
+    default_response_class=FastJSONResponse
 )
 
 
-@app.middleware("http")
-async def add_process_time_header(request: Request, call_next):
-    start_time = time.time()
-    response = await call_next(request)
-    process_time = time.time() - start_time
-    response.headers['X-Process-Time'] = str(process_time)
-    return response
-
-
 app.add_middleware(
     CORSMiddleware,
     allow_origins=[
@@ -49,6 +48,24 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# 按 Accept-Encoding 压缩 JSON、HTML 等文本响应，小于 500 字节的不压缩
+app.add_middleware(CompressionMiddleware)
+
+# SQL 分析：每个请求的语句数和耗时、疑似 N+1、慢查询日志
+profiler.configure(
+    slow_threshold=settings.sql_slow_query_threshold,
+    sample_rate=settings.sql_slow_query_sample_rate,
+    n_plus_one_threshold=settings.sql_n_plus_one_threshold,
+    debug=settings.profile_debug
+)
+app.add_middleware(SQLProfileMiddleware, profiler=profiler)
+
+# 纯 ASGI 的计时中间件，添加 Server-Timing(total、db、validation、render) 和 X-Process-Time 响应头
+app.add_middleware(TimingMiddleware)
+
+# 最外层：统计每个路由的请求数和耗时，由 /metrics 导出
+app.add_middleware(metrics.MetricsMiddleware)
+
 app.include_router(app03, prefix="/ch03", tags=["第三章 请求参数和验证"])
 app.include_router(app04, prefix="/ch04", tags=["第四章 响应处理和FastAPI配置"])
 app.include_router(app05, prefix="/ch05", tags=["第五章 FastAPI的依赖注入系统"])
@@ -57,8 +74,39 @@ app.include_router(app07, prefix="/ch07", tags=["第七章 FastAPI的数据库
 app.include_router(app08, prefix="/ch08", tags=["第八章 中间件、CORS、后台任务、测试用例"])
 app.include_router(application, prefix="/coronavirus", tags=["新冠病毒疫情跟踪器API"])
 
+# SQL 执行时间和 FastAPI 校验时间的计时、SQL 分析，路由全部注册之后再调用
+instrument_engine(engine)
+profiler.instrument_engine(engine)
+
+if async_engine is not None:
+    instrument_engine(async_engine)
+    profiler.instrument_engine(async_engine)
+
+instrument_routes(app.routes)
+metrics.instrument_routes(app.routes)
+instrument_pool(engine)
+
+# Prometheus 文本格式的监控指标，多个 worker 通过 METRICS_DIR 目录合并
+app.add_route("/metrics", metrics.metrics_endpoint, include_in_schema=False)
+
+# 只在开发环境查看单个请求的 SQL 分析结果，id 见响应头 X-SQL-Profile-Id
+if profiler.debug:
+    app.add_route("/debug/sql/{profile_id:int}", profile_endpoint(profiler), include_in_schema=False)
+
+
+@app.on_event("startup")
+def start_metrics_flush():
+    metrics.REGISTRY.start()
+
+
+@app.on_event("shutdown")
+def stop_metrics_flush():
+    metrics.REGISTRY.stop()
+
+
 # 挂载静态文件目录，这个不会在 API 交互文档中显示
-app.mount(path="/static", app=StaticFiles(directory="static"), name="static")
+# 有 `python -m core.precompress static` 生成的 .br/.gz 文件时直接返回，不在每次请求时压缩
+app.mount(path="/static", app=PrecompressedStaticFiles(directory="static"), name="static")
 
 
 # @app.exception_handler(StarletteHTTPException)
@@ -72,5 +120,10 @@ app.mount(path="/static", app=StaticFiles(directory="static"), name="static")
 
 
 if __name__ == '__main__':
+    # 多个 worker 共用一个目录汇总监控指标，子进程继承这个环境变量
+    os.environ.setdefault("METRICS_DIR", tempfile.mkdtemp(prefix="fastapi-tutorial-metrics-"))
+    # 多个 worker 共用一个 SQLite 文件中的令牌桶，限流对整个服务生效
+    os.environ.setdefault("RATE_LIMIT_DB", os.path.join(os.environ["METRICS_DIR"], "ratelimit.sqlite3"))
+
     # 使用 uvicorn 运行服务: uvicorn run:app --reload
     uvicorn.run("run:app", host="127.0.0.1", port=8000, reload=True, debug=True, workers=4)
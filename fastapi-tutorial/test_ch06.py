@@ -0,0 +1,184 @@
+# coding: utf8
+# ===================================
+# Author: yumingmin
+# File: test_ch06.py
+# Cate: FastAPI
+# Create time: 2022/7/26 14:00
+# Update time:
+# ===================================
+
+import asyncio
+import threading
+import time
+from datetime import timedelta
+
+import pytest
+from fastapi.testclient import TestClient
+from passlib.context import CryptContext
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session, sessionmaker
+
+from run import app
+from tutorial import ch06
+from tutorial.ch06 import (
+    PasswordHasher, PasswordHasherBusy, TokenCache, created_access_token, password_hasher, set_user_disabled,
+    token_cache
+)
+from tutorial.ch06_users import create_tables, get_db, get_user_by_username, import_users, update_user
+
+"""第六章 JWT 认证的测试用例
+* 会修改用户的用例使用 `users_db`：每个用例一个临时的用户库，不影响其他用例和 ch06_users.sqlite3
+"""
+
+client = TestClient(app)
+
+
+@pytest.fixture
+def users_db(tmp_path):
+    bind = create_engine(f"sqlite:///{tmp_path / 'users.sqlite3'}", connect_args={"check_same_thread": False})
+    create_tables(bind)
+    SessionTest = sessionmaker(bind=bind, autoflush=False, autocommit=False)
+
+    async def get_test_db():
+        db = SessionTest()
+
+        try:
+            yield db
+        finally:
+            db.close()
+
+    app.dependency_overrides[get_db] = get_test_db
+    token_cache.reset()
+
+    try:
+        yield SessionTest
+    finally:
+        app.dependency_overrides.pop(get_db, None)
+        token_cache.reset()
+        bind.dispose()
+
+
+def test_jwt_token_cache_and_invalidation(users_db):
+    token_cache.clear()
+    token = created_access_token({"sub": "john snow"}, expire_delta=timedelta(minutes=5))
+    headers = {"Authorization": f"Bearer {token}"}
+
+    hits = token_cache.hits
+    assert client.post("/ch06/jwt/users/me", headers=headers).json()["username"] == "john snow"
+    assert client.post("/ch06/jwt/users/me", headers=headers).json()["username"] == "john snow"
+    assert token_cache.hits == hits + 1 and len(token_cache) == 1
+
+    # 禁用用户后缓存失效，下一个请求重新查询到禁用状态
+    with users_db() as db:
+        set_user_disabled(db, "john snow")
+
+    assert len(token_cache) == 0
+    assert client.post("/ch06/jwt/users/me", headers=headers).status_code == 400
+
+    assert client.post("/ch06/jwt/users/me", headers={"Authorization": "Bearer invalid"}).status_code == 401
+
+
+def test_jwt_token_revoked_by_another_worker(users_db, monkeypatch):
+    monkeypatch.setattr(token_cache, "check_interval", 0)
+    token = created_access_token({"sub": "john snow"}, expire_delta=timedelta(minutes=5))
+    headers = {"Authorization": f"Bearer {token}"}
+    assert client.post("/ch06/jwt/users/me", headers=headers).status_code == 200
+    assert len(token_cache) == 1
+
+    # 另一个 worker 禁用用户：只清除它自己进程中的缓存，本进程的缓存通过用户表的版本号发现变化
+    with monkeypatch.context() as other_worker, users_db() as db:
+        other_worker.setattr(ch06, "token_cache", TokenCache())
+        set_user_disabled(db, "john snow")
+
+    assert len(token_cache) == 1
+    assert client.post("/ch06/jwt/users/me", headers=headers).status_code == 400
+
+
+def test_jwt_token_cache_respects_exp():
+    token_cache.clear()
+    token = created_access_token({"sub": "john snow"}, expire_delta=timedelta(minutes=5))
+    user = object()
+
+    # 已过期的 token 不写入缓存；条目的过期时间不晚于 exp
+    token_cache.set(token, {"sub": "john snow", "exp": int(time.time()) - 1}, user)
+    assert token_cache.get(token) is None
+
+    token_cache.set(token, {"sub": "john snow", "exp": time.time() + 0.05}, user)
+    assert token_cache.get(token)[1] is user
+    time.sleep(0.1)
+    assert token_cache.get(token) is None and len(token_cache) == 0
+
+
+def test_login_upgrades_weak_hash(users_db):
+    context = CryptContext(schemes=["bcrypt"], bcrypt__default_rounds=4)
+
+    with users_db() as db:
+        update_user(db, "john snow", hashed_password=context.hash("secret"))
+
+    response = client.post("/ch06/jwt/token", data={"username": "john snow", "password": "secret"})
+    assert response.status_code == 200 and response.json()["token_type"] == "bearer"
+
+    # 成本低于配置值的哈希在登录成功后升级，密码不变
+    with users_db() as db:
+        upgraded = get_user_by_username(db, "john snow").hashed_password
+    assert upgraded.startswith("$2b$12$") and password_hasher.context.verify("secret", upgraded)
+
+    response = client.post("/ch06/jwt/token", data={"username": "john snow", "password": "wrong"})
+    assert response.status_code == 401
+
+
+def test_password_hasher_rejects_when_saturated():
+    hasher = PasswordHasher(CryptContext(schemes=["bcrypt"]), max_workers=1, max_queue=1)
+    release = threading.Event()
+
+    async def scenario():
+        running = [asyncio.ensure_future(hasher.run(release.wait)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        assert hasher.pending == 2
+
+        with pytest.raises(PasswordHasherBusy):
+            await hasher.run(release.wait)
+
+        release.set()
+        await asyncio.gather(*running)
+        assert hasher.pending == 0
+
+    asyncio.run(scenario())
+
+
+def test_login_rate_limited_per_username():
+    statuses = [client.post("/ch06/token", data={"username": "jj", "password": "efg"}).status_code for _ in range(6)]
+    assert statuses == [200] * 5 + [429]
+    assert client.post("/ch06/token", data={"username": "jay", "password": "abc"}).status_code == 200
+
+
+def test_user_lookup_memoized_per_request(users_db):
+    statements = []
+
+    @event.listens_for(users_db.kw["bind"], "before_cursor_execute")
+    def listener(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    # get_current_user 和 get_current_active_user 共用一次查询
+    assert client.get("/ch06/users/me", headers={"Authorization": "Bearer jay"}).json()["username"] == "jay"
+    assert len([statement for statement in statements if "FROM users" in statement]) == 1
+
+    assert client.get("/ch06/users/me", headers={"Authorization": "Bearer nobody"}).status_code == 400
+    # jay 的密码不是 bcrypt 哈希，JWT 登录失败而不是 500
+    assert client.post("/ch06/jwt/token", data={"username": "jay", "password": "abc"}).status_code == 401
+
+
+def test_bulk_import_users(tmp_path):
+    bind = create_engine(f"sqlite:///{tmp_path / 'users.sqlite3'}")
+    users = [{"username": f"u{i % 12}", "email": f"u{i}@example.com", "password": f"p{i}"} for i in range(15)]
+    stats = import_users(users, bind, processes=2, rounds=4, chunk_size=4)
+    assert stats["imported"] == 12 and stats["skipped"] == 3
+
+    # 再次导入时已存在的用户全部跳过，不重新计算哈希
+    assert import_users(users[:5], bind, processes=2, rounds=4)["imported"] == 0
+
+    with Session(bind=bind) as db:
+        user = get_user_by_username(db, "u3")
+        assert user.hashed_password.startswith("$2b$04$") and password_hasher.context.verify("p3", user.hashed_password)
+        # 演示用户也在
+        assert get_user_by_username(db, "john snow") is not None
@@ -0,0 +1,293 @@
+# coding: utf8
+# ===================================
+# Author: yumingmin
+# File: test_core.py
+# Cate: FastAPI
+# Create time: 2022/7/24 15:00
+# Update time:
+# ===================================
+
+"""core 中公共组件的测试用例"""
+
+import gzip
+import json
+import logging
+import os
+import shutil
+import time
+
+from fastapi import Depends, FastAPI
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from fastapi.testclient import TestClient
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.pool import StaticPool
+
+from core import CompressionMiddleware, FastJSONResponse, PrecompressedStaticFiles, TimingMiddleware
+from core import instrument_engine, instrument_routes, metrics
+from core.compression import negotiate
+from core.precompress import precompress
+from core.profiler import SQLProfileMiddleware, SQLProfiler, profile_endpoint
+from core.ratelimit import MemoryStore, Rate, RateLimiter, RateLimitMiddleware, SQLiteStore, form_username
+
+
+def compression_app():
+    app = FastAPI()
+    app.add_middleware(CompressionMiddleware, encodings=("gzip",))
+
+    @app.get("/small")
+    def small():
+        return {"message": "hi"}
+
+    @app.get("/large")
+    def large():
+        return PlainTextResponse("x" * 2000, headers={"ETag": '"abc"'})
+
+    @app.get("/stream")
+    def stream():
+        return StreamingResponse((f"{i}\n" for i in range(1000)), media_type="application/x-ndjson")
+
+    @app.get("/image")
+    def image():
+        return PlainTextResponse("x" * 2000, media_type="image/png")
+
+    return TestClient(app)
+
+
+def test_negotiate_accept_encoding():
+    assert negotiate("gzip, br", ("br", "gzip")) == "br"
+    assert negotiate("gzip;q=1.0, br;q=0.5", ("br", "gzip")) == "gzip"
+    assert negotiate("br;q=0, *;q=0.1", ("br", "gzip")) == "gzip"
+    assert negotiate("identity", ("br", "gzip")) is None
+
+
+def test_compression_thresholds_and_content_types():
+    client = compression_app()
+    headers = {"Accept-Encoding": "gzip"}
+
+    small = client.get("/small", headers=headers)
+    assert "content-encoding" not in small.headers and small.headers["vary"] == "Accept-Encoding"
+
+    large = client.get("/large", headers=headers)
+    assert large.headers["content-encoding"] == "gzip" and large.text == "x" * 2000
+    assert int(large.headers["content-length"]) < 100
+    assert large.headers["etag"] == 'W/"abc"'
+
+    stream = client.get("/stream", headers=headers)
+    assert stream.headers["content-encoding"] == "gzip" and stream.text.count("\n") == 1000
+
+    assert "content-encoding" not in client.get("/image", headers=headers).headers
+    assert "content-encoding" not in client.get("/large", headers={"Accept-Encoding": "identity"}).headers
+
+
+def test_precompressed_static_files(tmp_path):
+    shutil.copy("static/js/semantic.min.js", tmp_path / "app.js")
+    assert [os.path.basename(target) for target, _, _ in precompress(str(tmp_path)) if target.endswith(".gz")] == [
+        "app.js.gz"
+    ]
+    assert list(precompress(str(tmp_path))) == []  # 已经是最新的，不重复生成
+
+    app = FastAPI()
+    app.add_middleware(CompressionMiddleware)
+    app.mount("/static", PrecompressedStaticFiles(directory=str(tmp_path)))
+    client = TestClient(app)
+
+    response = client.get("/static/app.js", headers={"Accept-Encoding": "gzip"}, stream=True)
+    body = response.raw.read(decode_content=False)  # 不自动解压，检查返回的就是预压缩文件
+    assert response.headers["content-encoding"] == "gzip"
+    assert "javascript" in response.headers["content-type"]
+    assert body == (tmp_path / "app.js.gz").read_bytes()
+    assert gzip.decompress(body) == (tmp_path / "app.js").read_bytes()
+
+    etag = response.headers["etag"]
+    assert client.get("/static/app.js", headers={"Accept-Encoding": "gzip", "If-None-Match": etag}).status_code == 304
+
+
+def parse_server_timing(value):
+    metrics = {}
+
+    for item in value.split(","):
+        name, _, duration = item.strip().partition(";dur=")
+        metrics[name] = float(duration)
+
+    return metrics
+
+
+def test_timing_middleware_server_timing():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    instrument_engine(engine)
+    instrument_engine(engine)  # 重复注册不会重复计时
+
+    app = FastAPI(default_response_class=FastJSONResponse)
+    app.add_middleware(TimingMiddleware)
+
+    def get_rows():
+        with engine.connect() as conn:
+            return conn.execute(text("WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < 200000) "
+                                     "SELECT count(*) FROM n")).scalar()
+
+    @app.get("/rows")
+    def rows(count: int = Depends(get_rows)):
+        return {"count": count}
+
+    @app.get("/stream")
+    def stream():
+        return StreamingResponse((f"{i}\n" for i in range(100)), media_type="text/plain")
+
+    instrument_routes(app.routes)
+    client = TestClient(app)
+
+    response = client.get("/rows")
+    metrics = parse_server_timing(response.headers["server-timing"])
+    assert response.json() == {"count": 200000}
+    assert list(metrics) == ["total", "db", "validation", "render"]
+    assert metrics["db"] > 0 and metrics["validation"] > 0 and metrics["render"] > 0
+    assert metrics["db"] + metrics["validation"] + metrics["render"] <= metrics["total"]
+    assert float(response.headers["x-process-time"]) * 1000 >= metrics["total"] - 0.001
+
+    # 流式响应不被缓冲，仍然带有计时响应头
+    response = client.get("/stream")
+    assert response.text.count("\n") == 100 and "server-timing" in response.headers
+
+    # 请求之外执行的 SQL 不做记录
+    assert get_rows() == 200000
+
+
+def test_metrics_route_labels_and_multiprocess_merge(tmp_path):
+    app = FastAPI()
+    app.add_middleware(metrics.MetricsMiddleware)
+
+    @app.get("/items/{item_id}")
+    def item(item_id: int):
+        return {"id": item_id}
+
+    metrics.instrument_routes(app.routes)
+    client = TestClient(app)
+    assert client.get("/items/1").status_code == 200 and client.get("/items/2").status_code == 200
+    assert client.get("/missing").status_code == 404
+
+    registry = metrics.Registry(str(tmp_path))
+    requests = metrics.Counter("requests_total", "请求数", ("route",), registry=registry)
+    latency = metrics.Histogram("latency_seconds", "耗时", registry=registry, buckets=(0.1, 1.0))
+    in_flight = metrics.Gauge("in_flight", "正在处理", registry=registry, live=True)
+    requests.labels("/a").inc(2)
+    latency.observe(0.5)
+    in_flight.inc()
+
+    # 另一个(已经退出的) worker 写下的文件：计数器和直方图累加，live Gauge 忽略
+    dead_pid = 2 ** 22 + 1
+    (tmp_path / f"metrics-{dead_pid}.json").write_text(json.dumps({"pid": dead_pid, "families": [
+        ["requests_total", "counter", "请求数", [["requests_total", [["route", "/a"]], 3]], False],
+        ["latency_seconds", "histogram", "耗时", [
+            ["latency_seconds_bucket", [["le", "0.1"]], 1], ["latency_seconds_bucket", [["le", "1"]], 1],
+            ["latency_seconds_bucket", [["le", "+Inf"]], 1], ["latency_seconds_sum", [], 0.05],
+            ["latency_seconds_count", [], 1]
+        ], False],
+        ["in_flight", "gauge", "正在处理", [["in_flight", [], 5]], True],
+    ]}))
+
+    text = registry.render()
+    assert 'requests_total{route="/a"} 5' in text
+    assert 'latency_seconds_bucket{le="0.1"} 1' in text and 'latency_seconds_bucket{le="1"} 2' in text
+    assert "latency_seconds_count 2" in text and "latency_seconds_sum 0.55" in text
+    assert "in_flight 1" in text
+    assert (tmp_path / f"metrics-{os.getpid()}.json").exists()
+
+    text = metrics.REGISTRY.render()
+    assert 'http_requests_total{method="GET",route="/items/{item_id}",status="200"} 2' in text
+    assert 'http_requests_total{method="GET",route="<unmatched>",status="404"} 1' in text
+    assert 'http_requests_in_flight{method="GET",route="/items/{item_id}"} 0' in text
+
+
+def test_sql_profiler_n_plus_one_and_slow_log(caplog):
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    profiler = SQLProfiler(slow_threshold=0, n_plus_one_threshold=3, debug=True)
+    profiler.instrument_engine(engine)
+
+    app = FastAPI()
+    app.add_middleware(SQLProfileMiddleware, profiler=profiler)
+    app.add_route("/debug/sql/{profile_id:int}", profile_endpoint(profiler))
+
+    @app.get("/cities")
+    def cities():
+        with engine.connect() as conn:
+            ids = [row[0] for row in conn.execute(text("SELECT 1 UNION ALL SELECT 2 UNION ALL SELECT 3"))]
+            result = [conn.execute(text("SELECT :id * 10"), {"id": i}).scalar() for i in ids]  # 逐个查询
+
+            # 分批的 executemany 不是 N+1
+            conn.execute(text("CREATE TEMP TABLE t (id INTEGER)"))
+
+            for i in ids:
+                conn.execute(text("INSERT INTO t (id) VALUES (:id)"), [{"id": i}, {"id": i + 10}])
+
+            return result
+
+    client = TestClient(app)
+
+    with caplog.at_level(logging.WARNING):
+        response = client.get("/cities")
+
+    assert response.json() == [10, 20, 30]
+    assert response.headers["x-sql-profile"].startswith("statements=8;")
+    assert response.headers["x-sql-profile"].endswith("n_plus_one=1")
+    assert any("疑似 N+1" in record.getMessage() and "GET /cities" in record.getMessage() for record in caplog.records)
+    assert any(record.name == "sql.slow" and "参数: (2,)" in record.getMessage() for record in caplog.records)
+
+    profile = client.get(f"/debug/sql/{response.headers['x-sql-profile-id']}").json()
+    assert profile["statements"] == 8 and profile["n_plus_one"] == {"SELECT ? * 10": 3}
+    assert sorted((item["count"], item["executemany"]) for item in profile["by_statement"]) == [
+        (1, 0), (1, 0), (3, 0), (3, 3)
+    ]
+    assert len(profile["slow"]) == 8
+    assert client.get("/debug/sql/999999").status_code == 404
+
+
+def test_rate_limit_stores(tmp_path):
+    rate = Rate(2, 1.0)
+
+    for store in (MemoryStore(shards=4), SQLiteStore(str(tmp_path / "ratelimit.sqlite3"))):
+        assert store.acquire("a", rate).allowed and store.acquire("a", rate).allowed
+        rejected = store.acquire("a", rate)
+        assert not rejected.allowed and 0 < rejected.retry_after <= 0.5
+        assert store.acquire("b", rate).allowed  # 不同的键互不影响
+        time.sleep(0.55)
+        assert store.acquire("a", rate).allowed
+
+    # 两个 SQLiteStore 模拟两个 worker，共用同一个文件中的令牌桶
+    first, second = SQLiteStore(str(tmp_path / "shared.sqlite3")), SQLiteStore(str(tmp_path / "shared.sqlite3"))
+    assert first.acquire("c", Rate(2, 60)).allowed and second.acquire("c", Rate(2, 60)).allowed
+    assert not first.acquire("c", Rate(2, 60)).allowed
+
+    # 键的数量超过上限时清理
+    store = MemoryStore(shards=1, max_keys=10)
+    for i in range(100):
+        store.acquire(str(i), rate)
+    assert sum(len(buckets) for buckets, _ in store._shards) <= 10
+
+    assert Rate.parse("10/minute") == Rate(10, 60.0) and Rate.parse("") is None
+
+
+def test_rate_limiter_dependency_and_middleware():
+    app = FastAPI()
+    user_limiter = RateLimiter("test_user", Rate(2, 60), key=form_username, store=MemoryStore())
+    app.add_middleware(RateLimitMiddleware, limiter=RateLimiter("test_ip", Rate(3, 60), store=MemoryStore()),
+                       prefixes=("/limited",))
+
+    @app.post("/login", dependencies=[Depends(user_limiter)])
+    def login():
+        return {"ok": True}
+
+    @app.get("/limited")
+    def limited():
+        return {"ok": True}
+
+    client = TestClient(app)
+    assert [client.post("/login", data={"username": "a"}).status_code for _ in range(3)] == [200, 200, 429]
+    assert client.post("/login", data={"username": "b"}).status_code == 200
+
+    response = client.post("/login", data={"username": "a"})
+    assert response.headers["Retry-After"] == "30" and response.json() == {"detail": "Too many requests"}
+
+    assert [client.get("/limited").status_code for _ in range(4)] == [200, 200, 200, 429]
+    assert client.get("/limited").headers["Retry-After"] == "20"
+    assert client.post("/login", data={"username": "c"}).status_code == 200
@@ -0,0 +1,623 @@
+# coding: utf8
+# ===================================
+# Author: yumingmin
+# File: test_coronavirus.py
+# Cate: FastAPI
+# Create time: 2022/7/12 21:40
+# Update time: 
+# ===================================
+
+import asyncio
+import json
+import threading
+import time
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from fastapi import FastAPI
+from fastapi.encoders import jsonable_encoder
+from fastapi.staticfiles import StaticFiles
+from sqlalchemy import create_engine, event, inspect, select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from coronavirus import (
+    analytics, async_crud, crud, jobs, migrations, models, query_plan, rollups, schemas, seed, serializers, versions
+)
+from coronavirus.cache import VersionedCache, city_cache
+from coronavirus.config import Settings
+from coronavirus.database import Base, create_db_engine
+from coronavirus.fetcher import JHUFetcher, LocationsParser
+from coronavirus.http_cache import response_cache
+from coronavirus import application
+from coronavirus.main import get_db, NEXT_CURSOR_HEADER
+from coronavirus.sync import bg_task, ingest_incremental
+from fastapi.testclient import TestClient
+from run import app
+
+FIXTURE = Path(__file__).parent / "fixtures" / "jhu_cn_timelines.json"
+
+"""coronavirus 应用的测试用例
+* 使用内存数据库，避免污染 coronavirus.sqlite3
+"""
+
+
+def memory_session():
+    # StaticPool 让线程池中的写入和测试线程共用同一个内存数据库连接
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=engine)
+    city_cache.invalidate()  # 进程内的缓存不能跨测试用的数据库共享
+    response_cache.invalidate()
+    return sessionmaker(bind=engine, autoflush=False, autocommit=False)()
+
+
+CITIES = [
+    {"province": "Beijing", "country": "China", "country_code": "CN", "country_population": 1400050000},
+    {"province": "Shanghai", "country": "China", "country_code": "CN", "country_population": 1400050000},
+]
+
+
+def test_bulk_create_cities_and_data():
+    db = memory_session()
+    stats = crud.bulk_create_cities(db, CITIES, chunk_size=1)
+    assert stats.rows == 2
+
+    city_ids = crud.get_city_ids(db)
+    assert set(city_ids) == {"Beijing", "Shanghai"}
+
+    rows = (
+        {"city_id": city_ids["Beijing"], "date": f"2022-01-{day:02d}", "confirmed": day, "deaths": 0}
+        for day in range(1, 11)
+    )
+    stats = crud.bulk_create_city_data(db, rows, chunk_size=3)
+    assert stats.rows == 10
+    assert stats.rows_per_second > 0
+
+    data = db.query(models.Data).order_by(models.Data.date).all()
+    assert len(data) == 10
+    assert data[0].date == date(2022, 1, 1)
+    assert data[-1].confirmed == 10
+    assert data[0].city.province == "Beijing"
+
+
+def test_locations_parser_incremental():
+    payload = json.dumps({"latest": {"confirmed": 1}, "locations": [{"province": "湖北", "n": i} for i in range(5)]})
+    parser = LocationsParser()
+    items = []
+
+    for byte in payload.encode("utf-8"):
+        items.extend(parser.feed(bytes([byte])))
+
+    parser.close()
+    assert [item["n"] for item in items] == list(range(5))
+    assert items[0]["province"] == "湖北"
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    """本地替身服务：第一次请求返回 503，之后分块返回录制好的 JHU 数据"""
+    failures = 1
+
+    def do_GET(self):
+        if FixtureHandler.failures > 0:
+            FixtureHandler.failures -= 1
+            self.send_error(503)
+            return
+
+        body = FIXTURE.read_bytes()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+
+        for i in range(0, len(body), 256):
+            self.wfile.write(body[i:i + 256])
+            self.wfile.flush()
+
+    def log_message(self, *args):
+        pass
+
+
+def fixture_server():
+    FixtureHandler.failures = 1
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FixtureHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}/v2/locations"
+
+
+def test_fetcher_retries_and_streams():
+    server, url = fixture_server()
+
+    async def collect():
+        async with JHUFetcher(url, backoff=0, chunk_size=128) as fetcher:
+            return [location async for location in fetcher.locations()]
+
+    try:
+        locations = asyncio.run(collect())
+    finally:
+        server.shutdown()
+
+    assert [location["province"] for location in locations] == ["Anhui", "Beijing", "Hubei"]
+
+
+def test_bg_task_ingests_fixture():
+    server, url = fixture_server()
+    db = memory_session()
+
+    try:
+        stats = asyncio.run(bg_task(url, db, batch_size=2))
+    finally:
+        server.shutdown()
+
+    assert stats.rows == 3 + 15
+    assert db.query(models.City).count() == 3
+    assert rollups.check(db) == []
+    hubei = db.query(models.Data).join(models.City).filter(models.City.province == "Hubei")
+    assert hubei.order_by(models.Data.date.desc()).first().confirmed == 1058
+
+
+def seed_timeline(db, days=10):
+    crud.bulk_create_cities(db, CITIES)
+    rows = (
+        {"city_id": city_id, "date": date.fromordinal(date(2022, 1, 1).toordinal() + day), "confirmed": day}
+        for city_id in crud.get_city_ids(db).values()
+        for day in range(days)
+    )
+    crud.bulk_create_city_data(db, rows)
+
+
+def test_keyset_pages_match_offset_pages():
+    db = memory_session()
+    seed_timeline(db)
+    seen, cursor = [], None
+
+    while True:
+        page, cursor = crud.get_data_page(db, cursor=cursor, limit=3)
+        seen.extend(row.id for row in page)
+
+        if cursor is None:
+            break
+
+    assert seen == [row.id for row in crud.get_data(db, skip=0, limit=100)]
+    assert len(seen) == 20
+
+    page, cursor = crud.get_data_page(db, city="Shanghai", limit=100)
+    assert len(page) == 10 and cursor is None
+
+
+def test_get_data_cursor_header(monkeypatch):
+    db = memory_session()
+    seed_timeline(db)
+    app.dependency_overrides[get_db] = lambda: db
+    client = TestClient(app)
+
+    try:
+        response = client.get("/coronavirus/get_data", params={"limit": 15})
+        assert len(response.json()) == 15
+        cursor = response.headers[NEXT_CURSOR_HEADER]
+
+        response = client.get("/coronavirus/get_data", params={"limit": 15, "cursor": cursor})
+        assert len(response.json()) == 5
+        assert NEXT_CURSOR_HEADER not in response.headers
+
+        assert client.get("/coronavirus/get_data", params={"cursor": "bad"}).status_code == 400
+        # 长度正确但类型不对的排序键同样拒绝，不会拿去和整数、日期列比较
+        for key in (["a", "b", "c"], [1, "2022-13-01", 1], [True, "2022-01-01", 1]):
+            response = client.get("/coronavirus/get_data", params={"cursor": crud.encode_cursor(key)})
+            assert response.status_code == 400
+
+        assert client.get("/coronavirus/get_cities", params={"cursor": crud.encode_cursor(["1"])}).status_code == 400
+
+        # 查询中的 ValueError 不是游标的问题，返回 500
+        async def broken_page(*args, **kwargs):
+            raise ValueError("broken")
+
+        monkeypatch.setattr(async_crud, "get_data_page", broken_page)
+        client = TestClient(app, raise_server_exceptions=False)
+        assert client.get("/coronavirus/get_data", params={"cursor": cursor}).status_code == 500
+        assert len(client.get("/coronavirus/get_data", params={"skip": 18}).json()) == 2
+    finally:
+        app.dependency_overrides.clear()
+
+
+def test_hot_queries_use_indexes():
+    db = memory_session()
+    cursor = crud.encode_cursor((1, "2022-01-01", 1))
+    hot_queries = [
+        db.query(models.City).filter(models.City.id == 1),
+        db.query(models.City).filter(models.City.province == "Beijing"),
+        crud._cities_page_query(db, crud.encode_cursor((1,))).limit(10),
+        crud._data_page_query(db).limit(10),
+        crud._data_page_query(db, cursor=cursor).limit(10),
+        crud._data_page_query(db, city="Beijing", cursor=cursor).limit(10),
+        crud._data_page_query(db, cursor=cursor, rows=True).limit(10),
+    ]
+
+    for query in hot_queries:
+        query_plan.assert_indexed(db, query)
+
+    assert query_plan.full_scans(["SCAN data", "SCAN data USING INDEX ix_data_city_id_date"]) == ["SCAN data"]
+
+
+def test_upgrade_builds_missing_indexes():
+    engine = create_engine("sqlite://", poolclass=StaticPool)
+    Base.metadata.create_all(bind=engine)
+    engine.execute("DROP INDEX ix_data_city_id_date")
+    engine.execute("ALTER TABLE version DROP COLUMN update_at")
+    assert "ix_data_city_id_date" not in {index["name"] for index in inspect(engine).get_indexes("data")}
+
+    migrations.upgrade(engine)
+    migrations.upgrade(engine)
+    assert "ix_data_city_id_date" in {index["name"] for index in inspect(engine).get_indexes("data")}
+    assert "update_at" in {column["name"] for column in inspect(engine).get_columns("version")}
+
+
+def test_async_session_endpoints(tmp_path):
+    url = f"sqlite:///{tmp_path / 'async.sqlite3'}"
+    engine = create_engine(url)
+    Base.metadata.create_all(bind=engine)
+    seed_timeline(sessionmaker(bind=engine)())
+    async_engine = create_async_engine(url.replace("sqlite://", "sqlite+aiosqlite://"))
+
+    async def get_async_db():
+        async with AsyncSession(async_engine, expire_on_commit=False) as db:
+            yield db
+
+    app.dependency_overrides[get_db] = get_async_db
+    client = TestClient(app)
+
+    try:
+        assert len(client.get("/coronavirus/get_data", params={"city": "Beijing"}).json()) == 10
+        assert client.get("/coronavirus/get_city/Shanghai").status_code == 200
+        city = dict(CITIES[0], province="Tianjin")
+        assert client.post("/coronavirus/create_city", json=city).status_code == 200
+        assert client.post("/coronavirus/create_city", json=city).status_code == 400
+    finally:
+        app.dependency_overrides.clear()
+
+
+def test_engine_profile(tmp_path):
+    engine = create_db_engine(f"sqlite:///{tmp_path / 'prod.sqlite3'}", Settings(env="prod", db_pool_size=2))
+    assert engine.echo is False
+    assert engine.pool.size() == 2
+
+    with engine.connect() as connection:
+        assert connection.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+        assert connection.exec_driver_sql("PRAGMA synchronous").scalar() == 1  # NORMAL
+
+    assert create_db_engine("sqlite://", Settings(env="dev")).echo is True
+
+
+def test_city_cache_read_through_and_invalidation():
+    db = memory_session()
+    cache = VersionedCache(versions.CITY, check_interval=0)
+    load = lambda: crud._city_snapshot(db.query(models.City).filter(models.City.province == "Beijing").first())
+
+    assert cache.get_or_load(db, "Beijing", load) is None  # 不缓存不存在的城市
+    crud.create_city(db, schemas.CreateCity(**CITIES[0]))
+    city = cache.get_or_load(db, "Beijing", load)
+    assert cache.get_or_load(db, "Beijing", load) == city
+    assert (cache.hits, cache.misses) == (1, 2)
+
+    # 模拟其他 worker 写入：版本号变化后本进程的缓存失效
+    versions.bump_version(db, versions.CITY)
+    db.commit()
+    cache.get_or_load(db, "Beijing", load)
+    assert cache.misses == 3
+
+    assert crud.get_city_by_name(db, "Beijing").id == city.id
+    assert crud.get_city(db, city.id).province == "Beijing"
+
+
+def test_home_page_constant_queries():
+    db = memory_session()
+    seed_timeline(db)
+    statements = []
+    event.listen(db.get_bind(), "before_cursor_execute", lambda *args: statements.append(args[2]))
+
+    # 只挂载 coronavirus 路由，不经过 run.app 中的 http 中间件
+    home = FastAPI()
+    home.include_router(application, prefix="/coronavirus")
+    home.mount(path="/static", app=StaticFiles(directory="static"), name="static")
+    home.dependency_overrides[get_db] = lambda: db
+    client = TestClient(home)
+    counts = []
+
+    for limit in (1, 5, 20):
+        statements.clear()
+        response = client.get("/coronavirus/", params={"limit": limit})
+        assert response.status_code == 200
+        assert response.text.count("<td>Beijing</td>") == min(limit, 10)
+        counts.append(len([statement for statement in statements if "FROM version" not in statement]))
+
+    assert counts == [1, 1, 1]
+
+
+def test_export_streams_ndjson_and_csv():
+    db = memory_session()
+    seed_timeline(db)
+    app.dependency_overrides[get_db] = lambda: db
+    client = TestClient(app)
+
+    try:
+        response = client.get("/coronavirus/export", params={"city": "Shanghai", "start": "2022-01-03"})
+        assert response.headers["content-type"] == "application/x-ndjson"
+        lines = [json.loads(line) for line in response.text.splitlines()]
+        assert len(lines) == 8
+        assert lines[0]["province"] == "Shanghai" and lines[0]["date"] == "2022-01-03"
+
+        response = client.get("/coronavirus/export", params={"format": "csv", "end": "2022-01-02"})
+        rows = response.text.splitlines()
+        assert rows[0] == "id,city_id,province,date,confirmed,deaths,recovered,update_at"
+        assert len(rows) == 1 + 4
+    finally:
+        app.dependency_overrides.clear()
+
+
+def test_rollups_maintained_incrementally():
+    db = memory_session()
+    seed_timeline(db)  # 2022-01-01 ~ 2022-01-10，每天 confirmed 为 0 ~ 9
+    assert rollups.check(db) == []
+
+    beijing = crud.get_city_by_name(db, "Beijing")
+    crud.create_city_data(db, schemas.CreateData(date="2022-01-11", confirmed=100), city_id=beijing.id)
+    assert rollups.check(db) == []
+
+    # 删除一周的最后一天，该周的汇总退回到前一天
+    row = db.query(models.Data).filter(models.Data.city_id == beijing.id, models.Data.date == date(2022, 1, 9)).one()
+    removed = {"city_id": row.city_id, "date": row.date, "confirmed": row.confirmed, "deaths": 0, "recovered": 0}
+    db.delete(row)
+    db.flush()
+    rollups.apply(db, removed=[removed])
+    db.commit()
+    assert rollups.check(db) == []
+
+    app.dependency_overrides[get_db] = lambda: db
+    client = TestClient(app)
+
+    try:
+        daily = client.get("/coronavirus/rollups/nation/daily", params={"start": "2022-01-10"}).json()
+        assert [(d["date"], d["confirmed"]) for d in daily] == [("2022-01-10", 18), ("2022-01-11", 100)]
+        weekly = client.get("/coronavirus/rollups/provinces/weekly", params={"city": "Beijing"}).json()
+        assert [(w["week"], w["as_of"], w["confirmed"]) for w in weekly] == [
+            ("2021-12-27", "2022-01-02", 1), ("2022-01-03", "2022-01-08", 7), ("2022-01-10", "2022-01-11", 100)
+        ]
+        assert len(client.get("/coronavirus/rollups/nation/weekly").json()) == 3
+    finally:
+        app.dependency_overrides.clear()
+
+    db.query(models.NationDaily).delete()
+    assert rollups.check(db)
+    version = versions.get_version(db, versions.DATA)
+    rollups.rebuild(db)
+    assert rollups.check(db) == []
+    # 重建后版本号更新，缓存的汇总响应失效
+    assert versions.get_version(db, versions.DATA) == version + 1
+
+
+def test_incremental_sync_writes_only_changes():
+    db = memory_session()
+    locations = json.loads(FIXTURE.read_text())["locations"]
+    assert ingest_incremental(db, locations).rows == 3 + 15
+    db.commit()
+    city_ids = crud.get_city_ids(db)
+
+    stats = ingest_incremental(db, locations)
+    assert (stats.rows, stats.skipped) == (0, 3)
+
+    hubei, beijing = locations[2]["timelines"], locations[1]["timelines"]
+    hubei["confirmed"]["timeline"]["2020-01-27T00:00:00Z"] = 1423
+    hubei["deaths"]["timeline"]["2020-01-27T00:00:00Z"] = 76
+    beijing["confirmed"]["timeline"]["2020-01-23T00:00:00Z"] = 23  # 修订历史数据
+    stats = ingest_incremental(db, locations)
+    db.commit()
+
+    assert (stats.rows, stats.skipped) == (2, 1)
+    assert crud.get_city_ids(db) == city_ids
+    assert db.query(models.Data).count() == 16
+    assert crud.get_data_page(db, city="Beijing", limit=2)[0][1].confirmed == 23
+    assert db.query(models.SyncState).get(city_ids["Hubei"]).last_date == date(2020, 1, 27)
+    assert rollups.check(db) == []
+
+
+def test_sync_jobs_coalesce_claim_and_requeue():
+    db = memory_session()
+    factory = sessionmaker(bind=db.bind, autoflush=False, autocommit=False)
+    server, url = fixture_server()
+
+    first, created = jobs.enqueue(db, url)
+    assert created
+    assert jobs.enqueue(db, url, schemas.SyncMode.full) == (first.copy(update={"mode": schemas.SyncMode.full}), False)
+
+    # 领取是原子的：排队中的任务只能被一个 worker 领取，执行中的任务也不会被重复领取
+    claimed = jobs.claim(db, "worker-a")
+    assert claimed.id == first.id
+    assert jobs.claim(db, "worker-b") is None
+    second, created = jobs.enqueue(db, url)
+    assert created and jobs.claim(db, "worker-b") is None
+
+    # worker-a 失联：超时后重新排队，已有排队中的任务时合并
+    claimed.heartbeat_at = jobs.utcnow() - timedelta(hours=1)
+    db.commit()
+    assert jobs.requeue_stale(db, stale_after=60) == 1
+    assert jobs.get_job(db, first.id).status == schemas.SyncJobStatus.failed
+
+    worker = jobs.SyncWorker(session_factory=factory, batch_size=2)
+
+    try:
+        job = worker.run_once()
+    finally:
+        server.shutdown()
+
+    assert job.id == second.id
+    assert (job.status, job.locations, job.rows, job.worker) == (schemas.SyncJobStatus.succeeded, 3, 18, worker.name)
+    assert db.query(models.Data).count() == 15
+    assert worker.run_once() is None
+
+
+def test_sync_job_progress_commits_separately(tmp_path):
+    config = Settings(db_pool_size=2, db_max_overflow=0)
+    engine = create_db_engine(f"sqlite:///{tmp_path / 'jobs.sqlite3'}", config)
+    Base.metadata.create_all(bind=engine)
+    factory = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+    progress = jobs.report(1, factory)
+
+    with factory() as db:
+        job, _ = jobs.enqueue(db, "http://example.com")
+        # 模拟未提交的全量同步持有写锁：上报很快放弃，不等待 busy_timeout
+        db.query(models.City).delete()
+        started = time.perf_counter()
+        progress(schemas.IngestStats(rows=10), 2)
+        assert time.perf_counter() - started < 1
+        db.rollback()
+
+    # 进度单独提交，其他 session 立即可见
+    progress(schemas.IngestStats(rows=10, skipped=1), 2)
+
+    with factory() as db:
+        job = jobs.get_job(db, job.id)
+        assert (job.locations, job.rows, job.skipped) == (2, 10, 1) and job.heartbeat_at is not None
+
+    # 连接池中的连接都恢复了原来的 busy_timeout
+    with engine.connect() as first, engine.connect() as second:
+        timeouts = {conn.exec_driver_sql("PRAGMA busy_timeout").scalar() for conn in (first, second)}
+        assert timeouts == {config.sqlite_busy_timeout}
+
+
+def test_sync_endpoint_enqueues_job():
+    db = memory_session()
+    app.dependency_overrides[get_db] = lambda: db
+    client = TestClient(app)
+
+    try:
+        response = client.get("/coronavirus/sync_coronavirus_data/jhu")
+        assert response.status_code == 202
+        job_id = response.json()["job_id"]
+        assert client.get("/coronavirus/sync_coronavirus_data/jhu").json()["job_id"] == job_id
+
+        job = client.get(f"/coronavirus/sync_jobs/{job_id}").json()
+        assert (job["status"], job["mode"], job["rows"]) == ("queued", "incremental", 0)
+        assert client.get(f"/coronavirus/sync_jobs/{job_id + 1}").status_code == 404
+    finally:
+        app.dependency_overrides.clear()
+
+
+def test_analytics_vectorized_and_incremental():
+    db = memory_session()
+    crud.bulk_create_cities(db, CITIES)
+    beijing, shanghai = crud.get_city_ids(db).values()
+    confirmed = [1, 2, 4, 8, 8, 16, 32, 64, 128, 256]
+    crud.bulk_create_city_data(db, (
+        {"city_id": beijing, "date": date(2022, 1, 1 + day), "confirmed": value}
+        for day, value in enumerate(confirmed) if day != 4  # 缺失的一天用前一天填充
+    ))
+    store = analytics.TimeSeriesStore(refresh_interval=0)
+    snapshot = store.snapshot(db)
+
+    new = analytics.compute(snapshot, schemas.Indicator.new_cases, city="Beijing")
+    assert new["series"]["Beijing"] == [1, 1, 2, 4, 0, 8, 16, 32, 64, 128]
+    assert analytics.compute(snapshot, schemas.Indicator.new_cases)["series"]["Shanghai"] == [0] * 10
+
+    average = analytics.compute(snapshot, schemas.Indicator.moving_average, window=3, start=date(2022, 1, 9))
+    assert average["series"]["Beijing"] == [round(112 / 3, 6), round(224 / 3, 6)]
+    doubling = analytics.compute(snapshot, schemas.Indicator.doubling_time, window=2)["series"]["Beijing"]
+    assert doubling[:2] == [None, None] and doubling[-1] == 1.0
+    assert analytics.compute(snapshot, schemas.Indicator.growth_rate, city="Wuhan") is None
+
+    # 增量刷新：新增一天，同时修改 Beijing 的 sync_state 哈希触发整个省份重新读取
+    crud.create_city_data(db, schemas.CreateData(date=date(2022, 1, 11), confirmed=512), city_id=shanghai)
+    db.query(models.Data).filter(models.Data.city_id == beijing, models.Data.date == date(2022, 1, 10)).update(
+        {"confirmed": 300}
+    )
+    db.add(models.SyncState(city_id=beijing, last_date=date(2022, 1, 10), content_hash="changed"))
+    db.commit()
+    snapshot = store.snapshot(db)
+
+    new = analytics.compute(snapshot, schemas.Indicator.new_cases)
+    assert new["dates"][-1] == "2022-01-11"
+    assert new["series"]["Beijing"][-2:] == [172, 0]
+    assert new["series"]["Shanghai"][-1] == 512
+    assert (snapshot.cumulative == analytics.build(dict(db.query(models.City.id, models.City.province)), db.execute(
+        select(*analytics.COLUMNS)).all(), snapshot.max_id, snapshot.hashes).cumulative).all()
+
+
+def test_conditional_get_etag_and_body_cache(monkeypatch):
+    db = memory_session()
+    monkeypatch.setattr(response_cache, "check_interval", 60)
+    seed_timeline(db, days=3)
+    statements = []
+    event.listen(db.get_bind(), "before_cursor_execute", lambda *args: statements.append(args[2]))
+    app.dependency_overrides[get_db] = lambda: db
+    client = TestClient(app)
+
+    try:
+        response = client.get("/coronavirus/get_data", params={"city": "Beijing", "limit": 2})
+        etag, last_modified = response.headers["ETag"], response.headers["Last-Modified"]
+        assert response.headers[NEXT_CURSOR_HEADER]
+
+        # 数据没有变化：304 和缓存的响应体都不查询数据库
+        statements.clear()
+        assert client.get("/coronavirus/get_data", params={"city": "Beijing", "limit": 2}, headers={
+            "If-None-Match": etag
+        }).status_code == 304
+        assert client.get("/coronavirus/get_data", params={"city": "Beijing", "limit": 2}, headers={
+            "If-Modified-Since": last_modified
+        }).status_code == 304
+        cached = client.get("/coronavirus/get_data", params={"city": "Beijing", "limit": 2})
+        assert cached.content == response.content
+        assert cached.headers[NEXT_CURSOR_HEADER] == response.headers[NEXT_CURSOR_HEADER]
+        assert statements == []
+
+        other = client.get("/coronavirus/get_data", params={"city": "Shanghai", "limit": 2})
+        assert other.headers["ETag"] != etag
+
+        # 写入后版本号加 1，旧的 ETag 失效
+        client.post("/coronavirus/create_data", params={"city": "Beijing"}, json={"date": "2022-02-01", "confirmed": 1})
+        response = client.get("/coronavirus/get_data", params={"city": "Beijing", "limit": 2}, headers={
+            "If-None-Match": etag
+        })
+        assert response.status_code == 200 and response.headers["ETag"] != etag
+    finally:
+        app.dependency_overrides.clear()
+
+
+def test_row_serializer_matches_pydantic():
+    db = memory_session()
+    seed_timeline(db, days=2)
+    city = db.query(models.City).first()
+    data = crud.get_data(db, limit=3)
+
+    # 人口在库中是字符串，生成函数时按 schema 的类型转换
+    assert serializers.row_serializer(schemas.City, models.City)(city) == schemas.City.from_orm(city).dict()
+    assert serializers.row_serializer(schemas.Data, models.Data) is serializers.row_serializer(schemas.Data, models.Data)
+
+    response = serializers.json_response(schemas.Data, data, models.Data, headers={NEXT_CURSOR_HEADER: "x"})
+    expected = jsonable_encoder([schemas.Data.from_orm(row) for row in data])
+    assert json.loads(response.body) == expected
+    assert response.headers[NEXT_CURSOR_HEADER] == "x"
+
+
+def test_seed_generates_consistent_dataset():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    stats = seed.load(engine, provinces=3, days=50, chunk_size=40)
+    assert stats.rows == 150
+
+    db = sessionmaker(bind=engine)()
+    assert crud.get_city_ids(db).keys() == {"province-0", "province-1", "province-2"}
+    # 汇总表由生成的数组直接计算，应与从数据表重新计算的结果一致
+    assert rollups.check(db) == []
+    assert {index.name for index in models.Data.__table__.indexes} <= {
+        index["name"] for index in inspect(engine).get_indexes("data")
+    }
+
+    for city_id in crud.get_city_ids(db).values():
+        rows = db.query(models.Data).filter(models.Data.city_id == city_id).order_by(models.Data.date).all()
+        assert len(rows) == 50 and rows[0].date == seed.START
+        assert all(a.confirmed <= b.confirmed and a.deaths <= b.deaths for a, b in zip(rows, rows[1:]))
+        assert all(row.deaths + row.recovered <= row.confirmed for row in rows)
+
+    # 相同的种子生成相同的数据
+    first = [block[1].tolist() for block in seed.generate(3, 50, seed=7)]
+    assert first == [block[1].tolist() for block in seed.generate(3, 50, seed=7)]
+    assert first != [block[1].tolist() for block in seed.generate(3, 50, seed=8)]
@@ -131,7 +131,8 @@ async def dependency_in_path_operation():
 
 # 在 APIRouter() 中 `dependencies` 参数设置全局依赖
 # 当然也可以在 FastAPI() 中设置 `dependencies` 参数，效果是一样的
-app05 = APIRouter(dependencies=[Depends(verify_token), Depends(verify_key)])
+# 这里使用单独的变量名，不覆盖上面已经注册了路由的 app05
+global_dependencies_router = APIRouter(dependencies=[Depends(verify_token), Depends(verify_key)])
 
 
 """带 yield 的依赖(Dependencies with yield)
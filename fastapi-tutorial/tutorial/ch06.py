@@ -12,13 +12,28 @@
 * 密码授权模式(Resource Owner Password Credentials Grant)
 * 客户端凭证授权模式（Client Credentials Grant）
 """
+import asyncio
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, datetime, timedelta
-from typing import Optional
-from fastapi import APIRouter, Depends, HTTPException, status
+from typing import Callable, Optional, Tuple
+from fastapi import APIRouter, Depends, HTTPException, Request, status
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from pydantic import BaseModel, EmailStr
 from passlib.context import CryptContext
 from jose import JWTError, jwt
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from core.ratelimit import Rate, RateLimiter, form_username
+from .ch06_users import (
+    BCRYPT_ROUNDS, create_tables, get_db, get_user_by_username, get_usernames_changed_since, get_users_version,
+    update_user
+)
 
 app06 = APIRouter()
 
@@ -38,21 +53,11 @@ async def oauth2_password_bearer(token: str = Depends(oauth2_schema)):
     return {"token": token}
 
 
-"""基于 Password 和 Bearer token 的 OAuth2 认证"""
-fake_users_db = {
-    "jay": {
-        "username": "jay",
-        "email": "jay@example.com",
-        "hashed_password": "fakehashedabc",
-        "disabled": False
-    },
-    "jj": {
-        "username": "jj",
-        "email": "jj@example.com",
-        "hashed_password": "fakehashedefg",
-        "disabled": True
-    },
-}
+"""基于 Password 和 Bearer token 的 OAuth2 认证
+* 用户保存在数据库的 users 表中(见 `ch06_users`)，启动时建表并写入演示用户 jay / jj / john snow
+"""
+create_tables()
+
 
 def fake_hash_password(password: str):
     return "fakehashed" + password
@@ -68,22 +73,40 @@ class UserInDB(User):
     hashed_password: str
 
 
-def get_user(db, username: str):
-    if username in db:
-        user_dict = db[username]
-        return UserInDB(**user_dict)
+def get_user(db: Session, username: str) -> Optional[UserInDB]:
+    record = get_user_by_username(db, username)
 
+    if record is None:
+        return None
 
-def fake_decode_token(token: str):
-    user = get_user(fake_users_db, token)
-    return user
+    # 数据库中的数据已经校验过，直接构造，跳过 pydantic 的字段校验
+    return UserInDB.construct(
+        username=record.username, email=record.email, disabled=record.disabled, hashed_password=record.hashed_password
+    )
+
+
+async def load_user(request: Request, db: Session, username: str) -> Optional[UserInDB]:
+    """同一个请求中只查询一次：结果保存在 `request.state` 中，各个依赖和路由函数共用"""
+    users = getattr(request.state, "ch06_users", None)
+
+    if users is None:
+        users = request.state.ch06_users = {}
+
+    if username not in users:
+        users[username] = await run_in_threadpool(get_user, db, username)
+
+    return users[username]
 
 
-def get_current_user(token: str = Depends(oauth2_schema)):
+async def fake_decode_token(request: Request, db: Session, token: str):
+    return await load_user(request, db, token)
+
+
+async def get_current_user(request: Request, token: str = Depends(oauth2_schema), db: Session = Depends(get_db)):
     """`headers={"WWW-Authenticate": "Bearer"}` 为 OAuth2 的规范，
     请求失败时返回
     """
-    user = fake_decode_token(token)
+    user = await fake_decode_token(request, db, token)
 
     if not user:
         raise HTTPException(
@@ -105,17 +128,28 @@ async def get_current_active_user(current_user: User = Depends(get_current_user)
     return current_user
 
 
-@app06.post("/token")
-async def login(form_data: OAuth2PasswordRequestForm = Depends()):
-    user_dict = fake_users_db.get(form_data.username)
+"""登录接口限流：每个客户端 IP 和每个用户名各一个令牌桶，超过时返回 429
+* 按 IP 限制单个客户端尝试的频率，按用户名限制针对同一账号的暴力破解(即使请求来自多个 IP)
+* 两个登录接口共用同一组令牌桶
+"""
+LOGIN_IP_RATE_LIMIT = os.environ.get("CH06_LOGIN_IP_RATE_LIMIT", "20/minute")
+LOGIN_USER_RATE_LIMIT = os.environ.get("CH06_LOGIN_USER_RATE_LIMIT", "5/minute")
+
+login_ip_limiter = RateLimiter("ch06_login_ip", Rate.parse(LOGIN_IP_RATE_LIMIT))
+login_user_limiter = RateLimiter("ch06_login_user", Rate.parse(LOGIN_USER_RATE_LIMIT), key=form_username)
+login_limits = [Depends(login_ip_limiter), Depends(login_user_limiter)]
+
 
-    if not user_dict:
+@app06.post("/token", dependencies=login_limits)
+async def login(request: Request, form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+    user = await load_user(request, db, form_data.username)
+
+    if not user:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Incorrect username"
         )
 
-    user = UserInDB(**user_dict)
     hashed_password = fake_hash_password(form_data.password)
 
     if hashed_password != user.hashed_password:
@@ -145,40 +179,91 @@ class UserToken(BaseModel):
     token_type: str
 
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-oauth2_schema = OAuth2PasswordBearer(tokenUrl="/ch06/jwt/token")
+# 同时计算 bcrypt 的线程数，和已满时最多排队等待的请求数
+PASSWORD_WORKERS = int(os.environ.get("CH06_PASSWORD_WORKERS", 2))
+PASSWORD_QUEUE_SIZE = int(os.environ.get("CH06_PASSWORD_QUEUE_SIZE", 16))
 
-# 之前的数据中 hashed_password 并未经过 Hash 加密，所以选择 jay / jj 会导致 Internal Error
-fake_users_db.update({
-    "john snow": {
-        "username": "john snow",
-        "email": "johnsnow@example.com",
-        "hashed_password": "$2b$12$EixZaYVK1fsbw1ZfbX3OXePaWxn96p36WQoeG6Lruj3vjPGga31lW",
-        "disabled": False,
-    }
-})
+pwd_context = CryptContext(
+    schemes=["bcrypt"], deprecated="auto", bcrypt__default_rounds=BCRYPT_ROUNDS, bcrypt__min_rounds=BCRYPT_ROUNDS
+)
+oauth2_schema = OAuth2PasswordBearer(tokenUrl="/ch06/jwt/token")
 
 
 def verify_password(plain_password, hashed_password):
     """对密码进行校验"""
-    print(plain_password, hashed_password)
     return pwd_context.verify(plain_password, hashed_password)
 
 
-def jwt_get_user(db, username: str):
-    if username in db:
-        user_dict = db[username]
-        return UserInDB(**user_dict)
+"""bcrypt 放到专用线程池中执行
+* 成本为 12 的 bcrypt 约需 250ms CPU，直接在 `async def` 路由中调用会阻塞事件循环，一次登录就让同一 worker 的其他请求全部等待
+* bcrypt 计算时释放 GIL，`PASSWORD_WORKERS` 个线程并行计算，不占用 FastAPI 默认线程池(同步路由和依赖使用的线程池)
+* 正在计算和排队的任务超过 `PASSWORD_WORKERS + PASSWORD_QUEUE_SIZE` 时直接返回 503，登录请求激增时不会无限排队
+"""
 
 
-def jwt_authenticate_user(db, username: str, password: str):
-    user = jwt_get_user(db, username)
+class PasswordHasherBusy(Exception):
+    pass
+
+
+class PasswordHasher:
+    def __init__(self, context: CryptContext, max_workers: int = 2, max_queue: int = 16):
+        self.context = context
+        self.limit = max_workers + max_queue
+        self.pending = 0
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="password-hasher")
+        self._lock = threading.Lock()
+
+    async def run(self, func: Callable, *args):
+        with self._lock:
+            if self.pending >= self.limit:
+                raise PasswordHasherBusy()
+
+            self.pending += 1
+
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+        finally:
+            with self._lock:
+                self.pending -= 1
+
+    async def hash(self, password: str) -> str:
+        return await self.run(self.context.hash, password)
+
+    async def verify_and_update(self, password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+        """返回 (是否匹配, 新的哈希)，哈希的成本低于配置值时新的哈希不为 None"""
+        return await self.run(self.context.verify_and_update, password, hashed_password)
+
+
+password_hasher = PasswordHasher(pwd_context, PASSWORD_WORKERS, PASSWORD_QUEUE_SIZE)
+
+
+jwt_get_user = get_user
+
+
+async def jwt_authenticate_user(db: Session, username: str, password: str):
+    user = await run_in_threadpool(jwt_get_user, db, username)
 
     if not user:
         return False
 
-    if not verify_password(plain_password=password, hashed_password=user.hashed_password):
+    try:
+        verified, new_hash = await password_hasher.verify_and_update(password, user.hashed_password)
+    except ValueError:
+        # jay / jj 的密码不是 bcrypt 哈希，无法识别
         return False
+    except PasswordHasherBusy:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many login attempts in progress",
+            headers={"Retry-After": "1"}
+        )
+
+    if not verified:
+        return False
+
+    if new_hash is not None:
+        await run_in_threadpool(update_user, db, username, hashed_password=new_hash)
+        user.hashed_password = new_hash
 
     return user
 
@@ -197,10 +282,10 @@ def created_access_token(data: dict, expire_delta: Optional[timedelta] = None):
     return encoded_jwt
 
 
-@app06.post("/jwt/token", response_model=UserToken)
-async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
-    user = jwt_authenticate_user(
-        db=fake_users_db,
+@app06.post("/jwt/token", response_model=UserToken, dependencies=login_limits)
+async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+    user = await jwt_authenticate_user(
+        db=db,
         username=form_data.username,
         password=form_data.password
     )
@@ -220,7 +305,141 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
     return {"access_token": access_token, "token_type": "bearer"}
 
 
-async def jwt_get_current_user(token: str = Depends(oauth2_schema)):
+"""JWT 校验缓存
+* 同一个 token 在有效期内反复请求时，跳过 `jwt.decode`(HMAC 校验 + JSON 解析)和用户查询
+* 以 token 的 SHA-256 摘要为键(内存中不保存 token 原文)，缓存解码后的 claims 和 UserInDB，按 LRU 最多保留 `maxsize` 条
+* 条目在 token 的 `exp` 和 `ttl` 中较早的时刻过期，缓存不会让过期的 token 继续有效
+* 禁用、删除用户或修改密码后调用 `token_cache.invalidate_user(username)`，下一个请求重新解码并查询用户；
+  缓存只保存校验结果，`invalidate(token)` 移除单个 token 后它仍可以重新通过校验
+* 多个 worker：缓存在各自进程的内存中，`invalidate_user` 只影响当前进程。命中缓存时每隔 `check_interval` 秒读一次
+  用户表的版本号(`get_users_version`)，变化时移除被其他 worker 修改过的用户的缓存，禁用用户最多延迟 `check_interval` 秒生效
+"""
+
+
+class TokenCache:
+    def __init__(self, maxsize: int = 1024, ttl: float = 300.0, check_interval: float = 1.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.check_interval = check_interval
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[bytes, Tuple[float, dict, UserInDB]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = None
+        self._checked_at = float("-inf")
+
+    @property
+    def version_expired(self) -> bool:
+        """为 True 时下一次 `check_version` 会查询数据库"""
+        return time.monotonic() - self._checked_at >= self.check_interval
+
+    def check_version(self, db: Session):
+        """距离上次检查超过 `check_interval` 秒时读取用户表的版本号，移除之后被修改过的用户的缓存；
+        第一次检查(还不知道缓存写入时的版本)或版本号变小(数据库被重建)时清空缓存
+        """
+        now = time.monotonic()
+
+        if now - self._checked_at < self.check_interval:
+            return
+
+        version = get_users_version(db)
+
+        if self._version is None or version < self._version:
+            self.clear()
+        elif version > self._version:
+            for username in get_usernames_changed_since(db, self._version):
+                self.invalidate_user(username)
+
+        self._version = version
+        self._checked_at = now
+
+    @staticmethod
+    def digest(token: str) -> bytes:
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token: str) -> Optional[Tuple[dict, UserInDB]]:
+        key = self.digest(token)
+
+        with self._lock:
+            item = self._data.get(key)
+
+            if item is not None and item[0] > time.time():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return item[1], item[2]
+
+            if item is not None:
+                del self._data[key]
+
+            self.misses += 1
+            return None
+
+    def set(self, token: str, claims: dict, user: UserInDB):
+        # exp 是 UTC 时间戳，与 time.time() 比较
+        expires = time.time() + self.ttl
+
+        if claims.get("exp") is not None:
+            expires = min(expires, float(claims["exp"]))
+
+        if self.maxsize <= 0 or expires <= time.time():
+            return
+
+        key = self.digest(token)
+
+        with self._lock:
+            self._data[key] = (expires, claims, user)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, token: str):
+        with self._lock:
+            self._data.pop(self.digest(token), None)
+
+    def invalidate_user(self, username: str):
+        """移除该用户所有 token 的缓存，返回移除的条数"""
+        with self._lock:
+            keys = [key for key, (_, claims, _) in self._data.items() if claims.get("sub") == username]
+
+            for key in keys:
+                del self._data[key]
+
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def reset(self):
+        """清空缓存，并在下一次访问时重新读取版本号"""
+        self.clear()
+        self._version = None
+        self._checked_at = float("-inf")
+
+    def __len__(self):
+        return len(self._data)
+
+
+token_cache = TokenCache()
+
+
+def set_user_disabled(db: Session, username: str, disabled: bool = True):
+    """禁用或启用用户，同时让该用户已缓存的 token 失效"""
+    update_user(db, username, disabled=disabled)
+
+    token_cache.invalidate_user(username)
+
+
+async def jwt_get_current_user(request: Request, token: str = Depends(oauth2_schema), db: Session = Depends(get_db)):
+    if token_cache.version_expired:
+        await run_in_threadpool(token_cache.check_version, db)
+
+    cached = token_cache.get(token)
+
+    if cached is not None:
+        return cached[1]
+
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -235,11 +454,12 @@ async def jwt_get_current_user(token: str = Depends(oauth2_schema)):
     except JWTError:
         raise credentials_exception
 
-    user = jwt_get_user(db=fake_users_db, username=username)
+    user = await load_user(request, db, username)
 
     if user is None:
         raise credentials_exception
 
+    token_cache.set(token, payload, user)
     return user
 
 
@@ -0,0 +1,40 @@
+# coding: utf8
+# ================================
+# Author: yumingmin
+# Cate: FastAPI
+# Create Time: 2022/7/26 20:10
+# Update Time:
+# ================================
+
+"""批量导入第六章的用户，多个进程并行计算 bcrypt 哈希(见 `ch06_users.import_users`)
+写入 `CH06_DATABASE_URL` 指向的数据库，默认为 ./ch06_users.sqlite3
+运行:
+  python -m tutorial.ch06_import users.csv --processes 8        # CSV 列: username,email,password[,disabled]
+  python -m tutorial.ch06_import --generate 100000 --rounds 4  # 生成测试用户 user-0 ~ user-99999，密码同用户名
+"""
+
+import argparse
+
+from .ch06_users import BCRYPT_ROUNDS, engine, generate_users, import_users, read_csv
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("csv", nargs="?", help="CSV 文件，列为 username,email,password[,disabled]")
+    parser.add_argument("--generate", type=int, help="不读取 CSV，生成指定数量的测试用户")
+    parser.add_argument("--processes", type=int, help="计算哈希的进程数，默认为 CPU 核数")
+    parser.add_argument("--rounds", type=int, default=BCRYPT_ROUNDS, help="bcrypt 成本因子")
+    parser.add_argument("--chunk-size", type=int, default=500, help="每个进程每次计算、每次写入的用户数")
+    args = parser.parse_args()
+
+    if args.generate is None and args.csv is None:
+        parser.error("需要 CSV 文件或 --generate")
+
+    users = generate_users(args.generate) if args.generate is not None else read_csv(args.csv)
+    stats = import_users(users, engine, args.processes, args.rounds, args.chunk_size)
+    rate = stats["imported"] / stats["seconds"] if stats["seconds"] else 0.0
+    print(f"导入 {stats['imported']} 个用户，跳过 {stats['skipped']} 个，{stats['seconds']:.1f} 秒，{rate:.0f} 个/秒")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+# coding: utf8
+# ================================
+# Author: yumingmin
+# Cate: FastAPI
+# Create Time: 2022/7/26 19:00
+# Update Time:
+# ================================
+
+"""第六章认证使用的用户表
+* 使用单独的 SQLite 文件(环境变量 `CH06_DATABASE_URL`)，引擎的连接池、PRAGMA 与 coronavirus 应用相同(`create_db_engine`)
+* username 上有唯一索引，按用户名查询走索引，几十万用户时仍是一次索引查找
+* 从数据库读出的行是可信的，用 `UserInDB.construct` 直接构造，不再逐个字段校验(EmailStr 的校验开销较大)
+* 批量导入：bcrypt 是 CPU 密集的，分块交给多个进程计算哈希，主进程按块写入，已存在的用户名跳过，命令行见 `ch06_import`
+* `token_version`：每次 `update_user` 把被修改用户的这一列设为全表最大值 + 1，既是该用户的版本号，
+  全表的最大值也是用户表的版本号。各 worker 的 token 缓存据此发现其他 worker 修改(如禁用)了哪些用户
+"""
+
+import csv
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Optional
+
+from passlib.context import CryptContext
+from sqlalchemy import Boolean, Column, Index, Integer, String, func, insert, select, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import Session, sessionmaker
+
+from coronavirus.database import create_db_engine
+from coronavirus.migrations import add_missing_columns
+
+CH06_DATABASE_URL = os.environ.get("CH06_DATABASE_URL", "sqlite:///./ch06_users.sqlite3")
+# bcrypt 的成本因子，低于该值的哈希在登录成功后自动升级
+BCRYPT_ROUNDS = int(os.environ.get("CH06_BCRYPT_ROUNDS", 12))
+
+engine = create_db_engine(CH06_DATABASE_URL)
+SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+
+# 与 coronavirus 的 Base 分开，coronavirus 的迁移不会创建用户表
+Base = declarative_base(name="UsersBase")
+
+
+class UserRecord(Base):
+    __tablename__ = "users"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    username = Column(String(100), nullable=False, comment="用户名")
+    email = Column(String(255), nullable=False, comment="邮箱")
+    hashed_password = Column(String(100), nullable=False, comment="密码哈希")
+    disabled = Column(Boolean, default=False, nullable=False, comment="是否禁用")
+    # 升级前的数据库补建这一列时已有的行为 NULL，等同于 0(从未修改过)
+    token_version = Column(Integer, default=0, comment="最近一次修改后的版本号")
+
+    __table_args__ = (
+        Index("ix_users_username", "username", unique=True),
+        Index("ix_users_token_version", "token_version"),
+    )
+
+
+# 演示用户，之前的数据中 jay / jj 的密码没有经过 bcrypt 哈希，只能用于 /ch06/token
+DEMO_USERS = [
+    {"username": "jay", "email": "jay@example.com", "hashed_password": "fakehashedabc", "disabled": False},
+    {"username": "jj", "email": "jj@example.com", "hashed_password": "fakehashedefg", "disabled": True},
+    {
+        "username": "john snow",
+        "email": "johnsnow@example.com",
+        "hashed_password": "$2b$12$EixZaYVK1fsbw1ZfbX3OXePaWxn96p36WQoeG6Lruj3vjPGga31lW",
+        "disabled": False,
+    },
+]
+
+
+def create_tables(bind: Engine = engine):
+    Base.metadata.create_all(bind=bind)
+    add_missing_columns(bind, Base.metadata)
+
+    for index in UserRecord.__table__.indexes:
+        index.create(bind=bind, checkfirst=True)
+
+    with Session(bind=bind) as db:
+        names = [user["username"] for user in DEMO_USERS]
+        existing = set(db.execute(select(UserRecord.username).where(UserRecord.username.in_(names))).scalars())
+        missing = [user for user in DEMO_USERS if user["username"] not in existing]
+
+        if not missing:
+            return
+
+        # 多个 worker 同时启动时可能同时插入，已被其他进程插入时忽略
+        try:
+            db.execute(insert(UserRecord), missing)
+            db.commit()
+        except IntegrityError:
+            db.rollback()
+
+
+async def get_db():
+    """Session 在第一次执行查询时才获取连接，创建和关闭都不阻塞，用异步生成器避免进出线程池
+    (如 token 命中缓存时不会查询数据库)
+    """
+    db = SessionLocal()
+
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+def get_user_by_username(db: Session, username: str) -> Optional[UserRecord]:
+    return db.execute(select(UserRecord).where(UserRecord.username == username)).scalar_one_or_none()
+
+
+def update_user(db: Session, username: str, **values):
+    """同时更新 `token_version`；SQLite 的写事务是串行的，子查询读到的最大值不会被其他写入同时使用"""
+    version = select(func.coalesce(func.max(UserRecord.token_version), 0) + 1).scalar_subquery()
+    db.execute(update(UserRecord).where(UserRecord.username == username).values(token_version=version, **values))
+    db.commit()
+
+
+def get_users_version(db: Session) -> int:
+    """用户表的版本号，走 token_version 上的索引"""
+    return db.execute(select(func.max(UserRecord.token_version))).scalar() or 0
+
+
+def get_usernames_changed_since(db: Session, version: int) -> List[str]:
+    return list(db.execute(select(UserRecord.username).where(UserRecord.token_version > version)).scalars())
+
+
+"""批量导入"""
+
+
+def hash_chunk(users: List[dict], rounds: int) -> List[dict]:
+    """在子进程中执行：把每个用户的 password 替换为 bcrypt 哈希"""
+    context = CryptContext(schemes=["bcrypt"], bcrypt__default_rounds=rounds)
+    return [
+        {
+            "username": user["username"],
+            "email": user["email"],
+            "hashed_password": context.hash(user["password"]),
+            "disabled": user.get("disabled", False),
+        }
+        for user in users
+    ]
+
+
+def read_csv(path: str) -> Iterator[dict]:
+    with open(path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            disabled = (row.get("disabled") or "").strip().lower() in ("1", "true", "yes")
+            yield {"username": row["username"], "email": row["email"], "password": row["password"], "disabled": disabled}
+
+
+def generate_users(count: int) -> Iterator[dict]:
+    for i in range(count):
+        yield {"username": f"user-{i}", "email": f"user-{i}@example.com", "password": f"user-{i}"}
+
+
+def chunked(users: Iterable[dict], size: int) -> Iterator[List[dict]]:
+    chunk = []
+
+    for user in users:
+        chunk.append(user)
+
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+def import_users(
+    users: Iterable[dict],
+    bind: Engine = engine,
+    processes: Optional[int] = None,
+    rounds: int = BCRYPT_ROUNDS,
+    chunk_size: int = 500
+) -> Dict[str, float]:
+    """导入用户，返回 {"imported": 写入数, "skipped": 已存在或重复的用户数, "seconds": 耗时}
+    * 只对数据库中还不存在的用户名计算哈希；同时在途的块不超过进程数的 2 倍，内存占用与用户总数无关
+    """
+    started = time.perf_counter()
+    create_tables(bind)
+    imported = skipped = 0
+    seen = set()
+
+    def new_users(chunk: List[dict], db: Session) -> List[dict]:
+        nonlocal skipped
+        names = [user["username"] for user in chunk]
+        existing = set(db.execute(select(UserRecord.username).where(UserRecord.username.in_(names))).scalars())
+        fresh = []
+
+        for user in chunk:
+            if user["username"] in existing or user["username"] in seen:
+                skipped += 1
+                continue
+
+            seen.add(user["username"])
+            fresh.append(user)
+
+        return fresh
+
+    processes = processes or os.cpu_count() or 1
+    limit = processes * 2
+
+    with ProcessPoolExecutor(max_workers=processes) as executor, Session(bind=bind) as db:
+        pending = []
+
+        def write(future):
+            nonlocal imported
+            rows = future.result()
+
+            if rows:
+                db.execute(insert(UserRecord), rows)
+                db.commit()
+                imported += len(rows)
+
+        for chunk in chunked(users, chunk_size):
+            fresh = new_users(chunk, db)
+
+            if fresh:
+                pending.append(executor.submit(hash_chunk, fresh, rounds))
+
+            # 按提交顺序写入，最早的块还没算完时等待它
+            while len(pending) >= limit:
+                write(pending.pop(0))
+
+        for future in pending:
+            write(future)
+
+    return {"imported": imported, "skipped": skipped, "seconds": time.perf_counter() - started}